@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+import numpy as np
+import pandas as pd
+
+from src.metrics import traced
+
+
+EXACT = 0
+RELATION = 1
+FOLDED = 2
+
+
+def fold_names(names):
+    """
+    ASCII spelling of names: ø becomes o and the other characters lose their diacritics
+    :param names: pandas.Series of str
+    """
+    return (
+        names.str.replace('ø', 'o').str.replace('Ø', 'O')
+        .str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode('utf-8')
+    )
+
+
+class AliasIndex:
+    """
+    Mineral names and their alternative spellings mapped to the best mineral_id, built once from
+    the output of get_alternative_names and shared by the COD and RRUFF name resolution.
+    A name is resolved by the first tier which knows it:
+        EXACT - the name of a mineral,
+        RELATION - an alternative name or the ASCII spelling of a name, the lowest priority wins,
+        FOLDED - the ASCII spelling of any of the above, case-folded.
+    """
+
+    def __init__(self, alternative_names):
+        _names = alternative_names[['mineral_id', 'name', 'priority']].dropna(subset=['name'])
+        _names = _names.sort_values(by=['name'], kind='mergesort')
+
+        # the ASCII spellings rank after the alternative names, as a null priority
+        _special = _names.loc[_names['name'].str.contains(r'[^\x00-\x7F]'), ['mineral_id', 'name']]
+        _special = _special.drop_duplicates()
+        _special = _special.assign(relation_name=fold_names(_special['name']), priority=np.nan)
+
+        _relations = alternative_names.loc[
+            alternative_names['relation_name'].notna(), ['mineral_id', 'name', 'relation_name', 'priority']
+        ]
+        _relations = pd.concat([_relations.sort_values(by=['name'], kind='mergesort'), _special])
+        _relations = _relations.sort_values(by=['priority'], kind='mergesort', na_position='last')
+
+        _exact = _names.drop_duplicates(subset=['name'])
+        _exact = _exact.assign(key=_exact['name'])
+        _relation = _relations.drop_duplicates(subset=['relation_name'])
+        _relation = _relation.assign(key=_relation['relation_name'])
+        _folded = pd.concat([_exact, _relation])
+        _folded = _folded.assign(key=fold_names(_folded['key']).str.casefold()).drop_duplicates(subset=['key'])
+
+        self.tiers = [_tier.set_index('key')[['mineral_id', 'name']] for _tier in (_exact, _relation, _folded)]
+
+    def __len__(self):
+        return sum(len(_tier) for _tier in self.tiers)
+
+    @traced("alias_lookup")
+    def lookup(self, names):
+        """
+        :param names: pandas.Series of names
+        :return: pandas.DataFrame aligned with names, with the mineral_id and name of the matched
+            mineral and the tier of the match, null and -1 where no tier knows the name
+        """
+        _keys = names.to_numpy(dtype=object)
+        _tiers = np.full(len(names), -1)
+        _ids = np.full(len(names), None, dtype=object)
+        _names = np.full(len(names), None, dtype=object)
+
+        for _tier, _index in enumerate(self.tiers):
+            _missing = np.flatnonzero(_tiers < 0)
+            if not len(_missing):
+                break
+            _lookup = _keys[_missing]
+            if _tier == FOLDED:
+                _lookup = fold_names(pd.Series(_lookup, dtype=object)).str.casefold().to_numpy(dtype=object)
+            _positions = _index.index.get_indexer(_lookup)
+            _found = _positions >= 0
+            _tiers[_missing[_found]] = _tier
+            _ids[_missing[_found]] = _index['mineral_id'].to_numpy(dtype=object)[_positions[_found]]
+            _names[_missing[_found]] = _index['name'].to_numpy(dtype=object)[_positions[_found]]
+
+        return pd.DataFrame({'mineral_id': _ids, 'name': _names, 'tier': _tiers}, index=names.index)
@@ -1,15 +1,40 @@
 # -*- coding: UTF-8 -*-
+import concurrent.futures
+import hashlib
+import io
+import json
 import os
+import re
 import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.parse import quote
 
 import numpy as np
 import pandas as pd
+import polars as pl
 from dotenv import load_dotenv
 from psycopg2 import Error as psycopgError
 from psycopg2.extensions import AsIs, register_adapter
 from psycopg2.extras import execute_values, Json
 from psycopg2.pool import ThreadedConnectionPool
+from sqlalchemy import create_engine
+
+from src.metrics import add_bytes, span, traced
+from src.queries import (
+    get_column_types,
+    lookup_crystal_system_list,
+    lookup_data_context_list,
+    lookup_ima_note_list,
+    lookup_ima_status_list,
+    lookup_mineral_log,
+    lookup_mineral_log_mindat,
+    lookup_mineral_log_upper,
+    lookup_status_list,
+)
+from src.snapshots import load_snapshot, save_snapshot
 
 
 register_adapter(np.int64, AsIs)
@@ -18,9 +43,200 @@ register_adapter(dict, Json)
 load_dotenv(".envs/.local/.mindat")
 load_dotenv(".envs/.prod/.cod")
 
+STAGING_TABLE = "_staging"
+# NULL marker of the staging COPY, an unquoted empty field is read as an empty string as with execute_values
+COPY_NULL = "\\N"
+
+# lookups of the cache and their key -> id queries
+LOOKUPS = {
+    "mineral_log": lookup_mineral_log,
+    "mineral_log_mindat": lookup_mineral_log_mindat,
+    "mineral_log_upper": lookup_mineral_log_upper,
+    "status_list": lookup_status_list,
+    "crystal_system_list": lookup_crystal_system_list,
+    "ima_status_list": lookup_ima_status_list,
+    "ima_note_list": lookup_ima_note_list,
+    "data_context_list": lookup_data_context_list,
+}
+CHECKPOINT_PATH = "db/reports/"
+
+
+def _array_literal(values):
+    if values is None or values is np.nan:
+        return None
+    _values = ['"' + str(_).replace("\\", "\\\\").replace('"', '\\"') + '"' for _ in values]
+    return "{" + ",".join(_values) + "}"
+
+
+def _pd_copy_frame(df):
+    """
+    Map the columns of a pandas.DataFrame to staging table types and serialize nested values
+    """
+    _types = []
+    _df = df.copy(deep=False)
+    for _column in df.columns:
+        _dtype = df[_column].dtype
+        if pd.api.types.is_bool_dtype(_dtype):
+            _types.append("boolean")
+        elif pd.api.types.is_integer_dtype(_dtype):
+            _types.append("bigint")
+        elif pd.api.types.is_float_dtype(_dtype):
+            _types.append("double precision")
+        elif pd.api.types.is_datetime64_any_dtype(_dtype):
+            _types.append("timestamp")
+        else:
+            _valid = df[_column].dropna()
+            _value = _valid.iloc[0] if len(_valid) else None
+            if isinstance(_value, dict):
+                _types.append("jsonb")
+                _df[_column] = df[_column].map(json.dumps, na_action="ignore")
+            elif isinstance(_value, (list, tuple)):
+                _types.append("text[]")
+                _df[_column] = df[_column].map(_array_literal, na_action="ignore")
+            elif isinstance(_value, (bool, np.bool_)):
+                _types.append("boolean")
+            elif isinstance(_value, (int, np.integer)):
+                _types.append("bigint")
+            elif isinstance(_value, (float, np.floating)):
+                _types.append("double precision")
+            else:
+                _types.append("text")
+    return _df, _types
+
+
+def _pl_copy_frame(df):
+    """
+    Map the columns of a polars.DataFrame to staging table types and serialize nested values
+    """
+    _types = []
+    _expressions = []
+    for _column, _dtype in df.schema.items():
+        if _dtype == pl.Boolean:
+            _types.append("boolean")
+        elif _dtype.is_integer():
+            _types.append("bigint")
+        elif _dtype.is_float():
+            _types.append("double precision")
+        elif _dtype == pl.Datetime:
+            _types.append("timestamp")
+        elif _dtype == pl.Date:
+            _types.append("date")
+        elif isinstance(_dtype, pl.Struct):
+            _types.append("jsonb")
+            _expressions.append(pl.col(_column).struct.json_encode())
+        elif isinstance(_dtype, pl.List):
+            _types.append("text[]")
+            _expressions.append(pl.col(_column).map_elements(_array_literal, return_dtype=pl.Utf8))
+        else:
+            _types.append("text")
+    return df.with_columns(_expressions), _types
+
+
+def _copy_buffer(df):
+    """
+    Serialize a pandas or polars DataFrame into a csv buffer for COPY ... FROM STDIN
+    :return: (buffer, list of staging column types)
+    """
+    _buffer = io.StringIO()
+    if isinstance(df, pl.DataFrame):
+        _df, _types = _pl_copy_frame(df)
+        _df.write_csv(_buffer, include_header=False, null_value=COPY_NULL)
+    else:
+        _df, _types = _pd_copy_frame(df)
+        _df.to_csv(_buffer, index=False, header=False, na_rep=COPY_NULL)
+    _buffer.seek(0)
+    return _buffer, _types
+
+
+def _checkpoint_key(df, query):
+    """
+    Identify the data of a write, a checkpoint of different data or query is not resumed
+    """
+    if isinstance(df, pl.DataFrame):
+        _hashes = df.hash_rows(seed=0).to_numpy()
+    else:
+        _df = df.copy(deep=False)
+        for _column in df.columns[df.dtypes == object]:
+            _df[_column] = df[_column].astype(str)
+        _hashes = pd.util.hash_pandas_object(_df, index=False, categorize=False).to_numpy()
+    _hash = hashlib.md5(query.encode("utf-8"))
+    _hash.update(_hashes.tobytes())
+    return _hash.hexdigest()
+
+
+def _checkpoint_path(checkpoint):
+    return os.path.join(CHECKPOINT_PATH, f"{checkpoint}.checkpoint.json")
+
+
+def _load_checkpoint(checkpoint, key):
+    if not os.path.exists(_checkpoint_path(checkpoint)):
+        return 0
+    with open(_checkpoint_path(checkpoint), "r") as f:
+        _checkpoint = json.load(f)
+    if _checkpoint["key"] != key:
+        print("Checkpoint %s belongs to different data, starting over" % checkpoint)
+        return 0
+    return _checkpoint["committed"]
+
+
+def _save_checkpoint(checkpoint, key, committed):
+    with open(_checkpoint_path(checkpoint), "w") as f:
+        json.dump(
+            {"key": key, "committed": committed, "updated_at": datetime.now().isoformat()},
+            f,
+        )
+
+
+def _remove_checkpoint(checkpoint):
+    if os.path.exists(_checkpoint_path(checkpoint)):
+        os.remove(_checkpoint_path(checkpoint))
+
+
+def _inline_params(query, params, mysql=False):
+    """
+    Substitute %(name)s parameters as literals, for readers without parameter binding
+    :param mysql: also escape backslashes and NUL, MySQL reads backslashes in literals as escapes
+    """
+    if not params:
+        return query
+    _literals = {}
+    for name, value in params.items():
+        if isinstance(value, str):
+            if mysql:
+                value = value.replace("\\", "\\\\").replace("\0", "\\0")
+            _literals[name] = "'%s'" % value.replace("'", "''")
+        else:
+            _literals[name] = str(value)
+    return query % _literals
+
+
+def _insert_columns(query):
+    """
+    Target table and columns of an INSERT INTO table (columns) VALUES %s query. execute_values sends
+    its values as untyped literals which take the types of these columns, the staging columns are
+    cast to them, see Migrator._copy
+    :return: (table, list of columns) or None for the other queries, whose VALUES are cast explicitly
+    """
+    _match = re.search(r"INSERT\s+INTO\s+(\w+)(?:\s+AS\s+\w+)?\s*\(([^)]*)\)\s*VALUES\s+%s", query, re.IGNORECASE)
+    if _match is None:
+        return None
+    return _match.group(1), [_column.strip() for _column in _match.group(2).split(",")]
+
+
+def _staged_query(query, types=None):
+    """
+    Replace the VALUES list of an execute_values query with the staging table
+    :param types: cast the staging columns to these types, see _insert_columns
+    """
+    _columns = "*"
+    if types:
+        _columns = ", ".join(f"c{index}::{type_}" for index, type_ in enumerate(types))
+    query = re.sub(r"\(\s*VALUES\s+%s\s*\)", f"(SELECT {_columns} FROM {STAGING_TABLE})", query)
+    return re.sub(r"VALUES\s+%s", f"SELECT {_columns} FROM {STAGING_TABLE}", query)
+
 
 class Migrator:
-    def __init__(self, env="dev"):
+    def __init__(self, env="dev", offline=False, dry_run=False):
         if env == "dev":
             load_dotenv(".envs/.local/.mr")
         elif env == "prod":
@@ -30,7 +246,8 @@ class Migrator:
 
         self.mindat_connection_params = (
             f"mysql+pymysql://"
-            f"{os.getenv('MINDAT_MYSQL_USER')}:{os.getenv('MINDAT_MYSQL_PASSWORD')}@127.0.0.1/"
+            f"{quote(str(os.getenv('MINDAT_MYSQL_USER')), safe='')}:"
+            f"{quote(str(os.getenv('MINDAT_MYSQL_PASSWORD')), safe='')}@127.0.0.1/"
             f"{os.getenv('MINDAT_MYSQL_DATABASE')}"
         )
         self.cod_connection_params = (
@@ -45,9 +262,38 @@ class Migrator:
             "host": os.getenv("POSTGRES_HOST"),
             "port": os.getenv("POSTGRES_PORT"),
         }
+        # read the extracts from the snapshots of a previous run instead of the databases
+        self.offline = offline
+        # run the fetches and diffs but send no DML, the would-be writes are only reported. The
+        # snapshots may be older than the MR database, so an offline run is always a dry run
+        self.dry_run = dry_run or offline
+        self.planned = Counter()
+        self._planned_lock = threading.Lock()
+        # key -> id Series of each of LOOKUPS, see load_lookups
+        self.lookups = {}
+        self._lookups_lock = threading.Lock()
+        # errors of the run, see fail, and the number of errors of the current thread
+        self.failures = []
+        self._failures_lock = threading.Lock()
+        self._local = threading.local()
+
+        # the same databases as uris for connectorx, the credentials are percent-encoded
+        self.mindat_uri = self.mindat_connection_params.replace("mysql+pymysql://", "mysql://")
+        self.cod_uri = self.cod_connection_params.replace("mysql+pymysql://", "mysql://")
+        self.mr_uri = (
+            f"postgresql://"
+            f"{quote(str(os.getenv('POSTGRES_USER')), safe='')}:{quote(str(os.getenv('POSTGRES_PASSWORD')), safe='')}@"
+            f"{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}"
+        )
         self.pool = None
+        # connection of a single-transaction run, see begin
+        self.connection = None
 
     def connect_db(self):
+        if self.offline:
+            # the MR state is read from the snapshots and a dry run writes nothing
+            print("Offline run, the MR database is not connected.")
+            return
 
         try:
             self.pool = ThreadedConnectionPool(
@@ -60,68 +306,392 @@ class Migrator:
 
 
     def disconnect_db(self):
+        if self.connection is not None:
+            self.rollback()
+        if self.pool is None:
+            return
         print("disconnecting from db...")
         self.pool.closeall()
 
+    def begin(self):
+        """
+        Start a run-level transaction: the writes share one connection and nothing is committed
+        before commit, so readers never see a half-synced database. The writes are not
+        checkpointed, and they must not run concurrently. An offline run has no transaction.
+        """
+        if self.pool is None:
+            return
+        self.connection = self.pool.getconn()
+
+    def commit(self):
+        if self.connection is None:
+            return
+        self.connection.commit()
+        self.pool.putconn(self.connection)
+        self.connection = None
+        print("The run transaction was committed")
+
+    def rollback(self):
+        self.connection.rollback()
+        self.pool.putconn(self.connection)
+        self.connection = None
+        print("The run transaction was rolled back")
+
+    @contextmanager
+    def savepoint(self, name):
+        """
+        Roll the writes of a block back when it raises, without aborting the run transaction.
+        Without a run transaction the writes commit on their own and this does nothing.
+        """
+        if self.connection is None:
+            yield
+            return
 
-    def psql_pd_get(self, query, table_name):
+        with self.connection.cursor() as _cursor:
+            _cursor.execute(f"SAVEPOINT {name};")
         try:
+            yield
+        except Exception:
+            with self.connection.cursor() as _cursor:
+                _cursor.execute(f"ROLLBACK TO SAVEPOINT {name};")
+            raise
+        with self.connection.cursor() as _cursor:
+            _cursor.execute(f"RELEASE SAVEPOINT {name};")
+
+    def fail(self, message):
+        """
+        Print an error and record it, a run with errors is incomplete and its watermarks are not saved
+        """
+        print(message)
+        with self._failures_lock:
+            self.failures.append(message)
+        self._local.failures = getattr(self._local, "failures", 0) + 1
+
+    def execute(self, query, params=None):
+        """
+        Run a statement without results, within the run transaction if there is one
+        """
+        _conn = self.connection or self.pool.getconn()
+        try:
+            with _conn.cursor() as _cursor:
+                _cursor.execute(query, params)
+            if self.connection is None:
+                _conn.commit()
+        finally:
+            if self.connection is None:
+                self.pool.putconn(_conn)
+
+
+    @staticmethod
+    def read_arrow(query, uri, params=None):
+        """
+        Read a query with connectorx straight into a pyarrow.Table, which converts to polars with
+        pl.from_arrow and to pandas with Table.to_pandas without building Python rows
+        """
+        import connectorx as cx
+
+        _query = _inline_params(query, params, mysql=uri.startswith("mysql://"))
+        return cx.read_sql(uri, _query.strip().rstrip(";"), return_type="arrow")
+
+    def read_frame(
+        self, query, source, reader="sql", params=None, arrow_dtypes=False, snapshot=None, partial=False, polars=False
+    ):
+        """
+        :param source: "mindat", "cod" or "mr"
+        :param reader: "sql" reads with pandas.read_sql_query, "arrow" with connectorx
+        :param arrow_dtypes: keep the pyarrow-backed columns instead of numpy dtypes, arrow only
+        :param snapshot: name of the extract, it is saved as a snapshot after the read and loaded
+            from the snapshot instead of the database in offline mode
+        :param partial: the query reads only the rows changed since a watermark, the snapshot is
+            recorded as partial. Offline, a partial snapshot is only loaded with partial
+        :param polars: return a polars.DataFrame, the arrow reader hands its table over without
+            converting it to pandas
+        :return: pandas.DataFrame or polars.DataFrame
+        """
+        with span(f"fetch:{snapshot or source}") as _span:
+            if snapshot and self.offline:
+                _frame = load_snapshot(snapshot, partial=partial)
+                if polars:
+                    _frame = pl.from_pandas(_frame, nan_to_null=True)
+            elif self.offline:
+                raise RuntimeError("Offline run, %s can not be read without a snapshot" % source)
+            else:
+                _frame = self._read_frame(query, source, reader, params, arrow_dtypes, polars)
+                if snapshot:
+                    save_snapshot(_frame, snapshot, partial=partial)
+            _span.rows_out = len(_frame)
+            if isinstance(_frame, pl.DataFrame):
+                _span.bytes = int(_frame.estimated_size())
+            else:
+                _span.bytes = int(_frame.memory_usage(index=False, deep=True).sum())
+        return _frame
+
+    def _read_frame(self, query, source, reader, params, arrow_dtypes, polars=False):
+        if reader == "arrow":
+            _uri = {"mindat": self.mindat_uri, "cod": self.cod_uri, "mr": self.mr_uri}[source]
+            _table = self.read_arrow(query, _uri, params)
+            if polars:
+                return pl.from_arrow(_table)
+            return _table.to_pandas(types_mapper=pd.ArrowDtype if arrow_dtypes else None)
+
+        if polars:
+            return pl.from_pandas(
+                self._read_frame(query, source, reader, params, arrow_dtypes), nan_to_null=True
+            )
+
+        if source == "mr":
             conn = self.pool.getconn()
+            try:
+                return pd.read_sql_query(query, conn, params=params)
+            finally:
+                self.pool.putconn(conn)
+
+        _connection_params = {
+            "mindat": self.mindat_connection_params,
+            "cod": self.cod_connection_params,
+        }[source]
+        return pd.read_sql_query(query, _connection_params, params=params)
+
+    def psql_pd_get(self, query, table_name, reader="sql"):
+        try:
             retrieved_ = (
-                pd.read_sql_query(
-                    query,
-                    conn,
-                )
+                self.read_frame(query, "mr", reader=reader, snapshot=table_name)
                 .fillna(value=np.nan)
                 .reset_index(drop=True)
             )
             setattr(self, table_name, retrieved_)
 
         except Exception as e:
-            print("An error occurred when creating %s: %s" % (table_name, e))
+            self.fail("An error occurred when creating %s: %s" % (table_name, e))
 
-        finally:
-            self.pool.putconn(conn)
 
+    def load_lookups(self, names=None, reader="sql"):
+        """
+        Load the name and key to id mappings of mineral_log and of the list tables once, so that
+        the insert and update queries take ids instead of joining on names, see resolve
+        :param names: lookups to load, all of LOOKUPS by default
+        """
+        names = names or list(LOOKUPS)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as executor:
+            _frames = executor.map(
+                lambda name: self.read_frame(LOOKUPS[name], "mr", reader=reader, snapshot=f"lookup_{name}"), names
+            )
+            for name, _frame in zip(names, _frames):
+                _lookup = pd.Series(_frame["id"].to_numpy(), index=_frame["key"].to_numpy())
+                self.lookups[name] = _lookup[~_lookup.index.duplicated(keep="last")]
+
+    def update_lookup(self, name, keys, ids):
+        """
+        Add the keys of freshly inserted rows to a lookup, e.g. after the mineral_log inserts
+        """
+        with self._lookups_lock:
+            _lookup = pd.concat([self.lookups[name], pd.Series(list(ids), index=list(keys), dtype=object)])
+            self.lookups[name] = _lookup[~_lookup.index.duplicated(keep="last")]
 
-    def execute_query(self, df, query):
+    def resolve(self, df, columns, table_name):
+        """
+        Replace names and list keys with their ids from the lookups. The rows with a key missing
+        from a lookup are reported as unmatched and left out, before anything is sent.
+        :param columns: dict of column -> lookup, e.g. {"name": "mineral_log"}
+        :return: df without the unmatched rows, with the columns replaced by ids
+        """
+        _df = df.copy()
+        _matched = np.ones(len(df), dtype=bool)
+        for _column, _lookup in columns.items():
+            _matched &= df[_column].isin(self.lookups[_lookup].index).to_numpy()
+            _df[_column] = df[_column].map(self.lookups[_lookup])
 
-        # TODO: make this method generic
+        if not _matched.all():
+            print("%s rows of %s have no match in the lookups" % ((~_matched).sum(), table_name))
+            self.save_report(df[~_matched], table_name=table_name, operation="unmatched")
+        return _df[_matched]
+
+    @staticmethod
+    def _execute_values(cursor, df, query):
         if isinstance(df, pd.DataFrame):
             df = df.replace({np.nan: None})
 
         tuples = [tuple(x) for x in df.to_numpy()]
+        return execute_values(cursor, query, tuples, fetch=True)
 
-        _conn = self.pool.getconn()
-        _conn = db.pool.getconn()
-        _cursor = _conn.cursor()
-        _cursor.mogrify(insert_chem_measurement % tuples[:10])
+    @staticmethod
+    def _copy(cursor, df, query):
+        _buffer, _types = _copy_buffer(df)
+        add_bytes(len(_buffer.getvalue()))
+
+        _columns = ", ".join(f"c{index} {type_}" for index, type_ in enumerate(_types))
+        _casts = None
+        _insert = _insert_columns(query)
+        if _insert is not None:
+            # INSERT ... SELECT does not cast text to the column types as VALUES literals are
+            _table, _targets = _insert
+            cursor.execute(get_column_types, (_table,))
+            _column_types = dict(cursor.fetchall())
+            _casts = [_column_types.get(_target, _type) for _target, _type in zip(_targets, _types)]
+
+        # a run transaction stages several frames before its commit drops the table
+        cursor.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE};")
+        cursor.execute(f"CREATE TEMPORARY TABLE {STAGING_TABLE} ({_columns}) ON COMMIT DROP;")
+        cursor.copy_expert(
+            f"COPY {STAGING_TABLE} FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}');", _buffer
+        )
+        cursor.execute(_staged_query(query, _casts))
+        return cursor.fetchall()
 
+    @traced("write")
+    def _write(self, df, query, writer, chunk_size=None, checkpoint=None):
+        """
+        Write df in chunks of chunk_size rows, each chunk is committed on its own. With a checkpoint
+        name, the number of committed rows is recorded in db/reports/ and an interrupted write of
+        the same data resumes after the last committed chunk. In dry run mode nothing is sent and
+        df itself is returned, so that the callers report the would-be writes. A database error is
+        recorded with fail and the rows returned by the chunks committed before it are returned.
+        Within a run transaction, see begin, the write is rolled back to its own savepoint and
+        nothing is returned, Migration._sync_step then rolls the whole step back.
+        """
+        if self.dry_run:
+            print("Dry run, %s records would be written" % len(df))
+            return df
+        if self.connection is not None:
+            # nothing is committed before the end of the run
+            checkpoint = None
+
+        chunk_size = chunk_size or max(len(df), 1)
+        _key = _checkpoint_key(df, query) if checkpoint else None
+        _start = _load_checkpoint(checkpoint, _key) if checkpoint else 0
+        if _start:
+            print("Resuming %s from row %s" % (checkpoint, _start))
+
+        retrieved = []
+        for _offset in range(_start, len(df), chunk_size):
+            if isinstance(df, pl.DataFrame):
+                _chunk = df.slice(_offset, chunk_size)
+            else:
+                _chunk = df.iloc[_offset:_offset + chunk_size]
+
+            _conn = self.connection or self.pool.getconn()
+            _cursor = _conn.cursor()
+            if self.connection is not None:
+                _cursor.execute("SAVEPOINT _write;")
+
+            try:
+                retrieved += writer(_cursor, _chunk, query)
+            except psycopgError as e:
+                self.fail("An error occurred after %s of %s records: %s" % (_offset, len(df), e))
+                if self.connection is not None:
+                    _cursor.execute("ROLLBACK TO SAVEPOINT _write;")
+                    return []
+                _conn.rollback()
+                return retrieved
+
+            else:
+                if self.connection is not None:
+                    _cursor.execute("RELEASE SAVEPOINT _write;")
+                else:
+                    _conn.commit()
+                if checkpoint:
+                    _save_checkpoint(checkpoint, _key, _offset + len(_chunk))
+
+            finally:
+                _cursor.close()
+                if self.connection is None:
+                    self.pool.putconn(_conn)
+
+        if checkpoint:
+            _remove_checkpoint(checkpoint)
+        print("The db was updated with %s records" % (len(df) - _start))
+        return retrieved
+
+    @staticmethod
+    def read_chunks(query, connection_params, chunksize, params=None):
+        """
+        Read a query in chunks through a server-side (unbuffered) cursor, so that only one chunk
+        is held in memory at a time
+        :return: generator of pandas.DataFrame
+        """
+        _engine = create_engine(connection_params)
         try:
-            retrieved = execute_values(_cursor, query, tuples, fetch=True)
-        except psycopgError as e:
-            print("An error occurred: %s" % e)
-            _conn.rollback()
-            return 1
+            with _engine.connect().execution_options(stream_results=True) as _conn:
+                for _chunk in pd.read_sql_query(query, _conn, params=params, chunksize=chunksize):
+                    yield _chunk
+        finally:
+            _engine.dispose()
 
-        else:
-            _conn.commit()
-            print("The db was updated with %s records" % len(tuples))
-            return retrieved
+    def execute_query(self, df, query, chunk_size=None, checkpoint=None):
+        return self._write(df, query, self._execute_values, chunk_size, checkpoint)
+
+    def copy_query(self, df, query, chunk_size=None, checkpoint=None):
+        """
+        Bulk variant of execute_query for large frames. Streams the rows with COPY into a temporary
+        staging table and runs the query with its VALUES list replaced by the staging table,
+        so the joins and RETURNING clause are executed server-side.
+        :param df: pandas.DataFrame or polars.DataFrame, columns in the order of the VALUES alias
+        :param query: execute_values query, e.g. insert_mineral_structure
+        :param chunk_size: number of rows committed at once, see _write
+        :param checkpoint: name of the checkpoint file used to resume an interrupted write
+        """
+        return self._write(df, query, self._copy, chunk_size, checkpoint)
+
+    def merge_query(self, df, query, table_name):
+        """
+        Stage the source rows with COPY and let a merge query (e.g. merge_mineral_log) find and
+        apply the inserts, updates and deletes server-side, so the target table is not fetched.
+        The changed rows are returned with the operation as the last column and reported by
+        operation. A dry run applies the merge in a transaction which is rolled back, so the
+        merges of the dependent steps do not see its inserts. Offline, a dry run can not tell the
+        changes apart and reports the staged rows.
+        :param df: pandas.DataFrame, columns in the order of the VALUES alias of query
+        """
+        try:
+            if self.dry_run and self.offline:
+                self.save_report(df, table_name=table_name, operation="merge")
+                return
+            retrieved_ = self._rolled_back_merge(df, query) if self.dry_run else self.copy_query(df, query)
 
+            for operation in ["insert", "update", "delete"]:
+                _rows = [_row[:-1] for _row in retrieved_ if _row[-1] == operation]
+                if _rows:
+                    self.save_report(_rows, table_name=table_name, operation=operation)
+        except Exception as e:
+            self.fail("An error occurred when merging %s: %s" % (table_name, e))
+
+    def _rolled_back_merge(self, df, query):
+        """
+        Stage df and run a merge query in a transaction which is always rolled back, or in a
+        savepoint of the run transaction
+        :return: the rows returned by query, as if it was applied
+        """
+        _conn = self.connection or self.pool.getconn()
+        _cursor = _conn.cursor()
+        try:
+            if self.connection is not None:
+                _cursor.execute("SAVEPOINT _merge;")
+            return self._copy(_cursor, df, query)
         finally:
+            if self.connection is not None:
+                _cursor.execute("ROLLBACK TO SAVEPOINT _merge;")
+            else:
+                _conn.rollback()
             _cursor.close()
-            self.pool.putconn(_conn)
+            if self.connection is None:
+                self.pool.putconn(_conn)
 
-    @staticmethod
-    def save_report(data: pd.DataFrame, table_name: str, operation: str) -> None:
+    @traced("report")
+    def save_report(self, data: pd.DataFrame, table_name: str, operation: str) -> None:
 
-        if not isinstance(data, pd.DataFrame):
+        if isinstance(data, pl.DataFrame):
+            data = data.to_pandas()
+        elif not isinstance(data, pd.DataFrame):
             data = pd.DataFrame(data)
 
         date = datetime.today().strftime("%d.%m.%Y__%H-%M")
         filename = f"{operation}_{table_name}_{date}.csv"
+        if self.dry_run:
+            filename = f"dry_run_{filename}"
+            with self._planned_lock:
+                self.planned[(table_name, operation)] += len(data)
 
         data.to_csv(f"db/reports/{filename}", index=False)
+        add_bytes(os.path.getsize(f"db/reports/{filename}"))
 
 
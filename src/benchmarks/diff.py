@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark of src.diff.diff_frames against the merge/compare logic previously used by
+Migration.sync_mineral_log and Migration.sync_mineral_history.
+
+Usage: python -m src.benchmarks.diff [rows]
+"""
+import re
+import sys
+import uuid
+from timeit import repeat
+
+import numpy as np
+import pandas as pd
+
+from src.diff import diff_frames
+
+
+def _generate(rows, seed=0):
+    _rng = np.random.default_rng(seed)
+    _names = np.array([f"Mineral{i:07d}" for i in range(rows)], dtype=object)
+
+    minerals = pd.DataFrame(
+        {
+            "name": _names,
+            "description": np.where(_rng.random(rows) < 0.2, None, _names + " description"),
+            "mindat_id": np.arange(rows, dtype=np.int64),
+            "ima_symbol": np.where(_rng.random(rows) < 0.5, None, "Sym"),
+            "discovery_year": np.where(_rng.random(rows) < 0.3, np.nan, _rng.integers(1800, 2024, rows)),
+            "ima_year": np.where(_rng.random(rows) < 0.3, np.nan, _rng.integers(1960, 2024, rows)),
+            "approval_year": np.where(_rng.random(rows) < 0.3, np.nan, _rng.integers(1960, 2024, rows)),
+            "publication_year": np.where(_rng.random(rows) < 0.3, np.nan, _rng.integers(1960, 2024, rows)),
+        }
+    )
+
+    # target: 95% of minerals are already synced, 1% of them with stale values
+    _target = minerals.sample(frac=0.95, random_state=seed).reset_index(drop=True)
+    _target["id"] = [str(uuid.UUID(int=i)) for i in range(len(_target))]
+    _stale = _rng.random(len(_target)) < 0.01
+    _target.loc[_stale, "description"] = "stale"
+    _target.loc[_stale, "ima_year"] = 1900
+
+    mineral_log = _target[["id", "name", "description", "mindat_id", "ima_symbol"]].copy()
+    mineral_log["note"] = np.nan
+    mineral_history = _target[
+        ["id", "name", "discovery_year", "ima_year", "approval_year", "publication_year"]
+    ].copy()
+
+    return minerals, mineral_log, mineral_history
+
+
+def _legacy(source, target, columns, values):
+    outer_join = target.merge(source[columns], how="outer", on="name", indicator=True)
+
+    insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
+    insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
+    insert.rename(columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True)
+    insert = insert.drop_duplicates("name")
+    insert = insert[columns]
+
+    update = outer_join[(outer_join._merge == "both")].drop("_merge", axis=1)
+    update = update.drop_duplicates("name")
+    old_ = update[["id"] + [value + "_x" for value in values]]
+    new_ = update[["id"] + [value + "_y" for value in values]]
+    old_ = old_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_))
+    new_ = new_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_))
+    diff = old_.compare(new_, keep_shape=False).dropna(how="all", axis=1)
+
+    update_ = update.loc[diff.index]
+    update_ = update_.rename(columns={value + "_y": value for value in values})
+    update_ = update_[["id"] + values]
+
+    return insert, update_
+
+
+def _engine(source, target, columns, values):
+    insert, update, _ = diff_frames(source[columns], target, keys=["name"], values=values)
+    return insert.drop_duplicates("name")[columns], update[["id"] + values]
+
+
+def _check(legacy, engine):
+    for _legacy, _engine in zip(legacy, engine):
+        assert sorted(_legacy["name" if "name" in _legacy else "id"]) == sorted(
+            _engine["name" if "name" in _engine else "id"]
+        )
+
+
+def main(rows=60000, number=5):
+    minerals, mineral_log, mineral_history = _generate(rows)
+
+    cases = {
+        "sync_mineral_log": (
+            mineral_log,
+            ["name", "description", "mindat_id", "ima_symbol"],
+            ["description", "mindat_id", "ima_symbol"],
+        ),
+        "sync_mineral_history": (
+            mineral_history,
+            ["name", "discovery_year", "ima_year", "approval_year", "publication_year"],
+            ["discovery_year", "ima_year", "approval_year", "publication_year"],
+        ),
+    }
+
+    for case, (target, columns, values) in cases.items():
+        _check(_legacy(minerals, target, columns, values), _engine(minerals, target, columns, values))
+
+        _legacy_time = min(repeat(lambda: _legacy(minerals, target, columns, values), number=1, repeat=number))
+        _engine_time = min(repeat(lambda: _engine(minerals, target, columns, values), number=1, repeat=number))
+        print(
+            f"{case} ({rows} rows): legacy {_legacy_time:0.3f}s, diff_frames {_engine_time:0.3f}s, "
+            f"x{_legacy_time / _engine_time:0.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark and equivalence check of src.formula against the previous per-row implementation
+of simpleformula and the COD/RRUFF regex markup.
+
+Usage:
+    python -m src.benchmarks.formula mindat         # full imaformula set of the mindat database
+    python -m src.benchmarks.formula <file.csv>     # csv with an imaformula column
+    python -m src.benchmarks.formula [rows]         # synthetic formulas
+"""
+import sys
+from timeit import repeat
+
+import numpy as np
+import pandas as pd
+from django.utils.html import strip_tags
+
+from src.formula import plainformula, plainformula_column, simpleformula, simpleformula_column
+
+_ELEMENTS = ["Ca", "Mg", "Fe", "Al", "Si", "O", "H", "Na", "K", "Mn", "Cu", "Zn", "S", "P", "C", "B", "F", "Cl"]
+_MARKUP = ["^2+^", "_2_", "_3_", "#2+#", "#3+#", "(OH)", "@", "[]", "·", "_x_", "≤", "&#9723;", "<i>REE</i>"]
+
+
+def _generate(rows, seed=0):
+    _rng = np.random.default_rng(seed)
+    _tokens = np.array(_ELEMENTS + _MARKUP, dtype=object)
+    # real data repeats formulas a lot, e.g. within mineral groups
+    _unique = ["".join(_rng.choice(_tokens, _rng.integers(3, 12))) for _ in range(max(rows // 3, 1))]
+    return pd.Series(_rng.choice(np.array(_unique, dtype=object), rows), name="imaformula")
+
+
+def _load(source):
+    if source == "mindat":
+        from src.base import Migrator
+
+        _formulas = pd.read_sql_query(
+            "SELECT imaformula FROM minerals;", Migrator().mindat_connection_params
+        )
+        return _formulas["imaformula"].fillna("")
+    if source.endswith(".csv"):
+        return pd.read_csv(source)["imaformula"].fillna("")
+    return _generate(int(source))
+
+
+def _legacy_simpleformula(text):
+    text = text.strip()
+    text = strip_tags(text)
+    text = text.replace("[]", "&#9723;").replace("≤", "<=").replace("≥", ">=")
+
+    extchr = False
+    big = True
+    anyc = False
+    insup = False
+    last_num = False
+    subs = ""
+    sups = ""
+    out = ""
+
+    for c in text:
+        if c == '&':
+            extchr = True
+        if c == ';':
+            extchr = False
+        if c == '^' and not extchr:
+            last_num = False
+            if big:
+                subs = ""
+                big = False
+            anyc = True
+        elif c == '#' and not extchr:
+            insup = not insup
+        elif insup:
+            sups = sups + c
+        else:
+            if not big and (c in "1234567890-+xyn@Σ<>=" or anyc):
+                if c == '@':
+                    c = "."
+                subs = subs + c
+                anyc = False
+            elif sups or subs:
+                if sups:
+                    out = out + "<sup>" + sups + "</sup>"
+                if subs:
+                    out = out + "<sub>" + subs + "</sub>"
+                big = True
+                sups = ""
+                subs = ""
+            if big:
+                if not last_num and c == ".":
+                    c = ' &middot; '
+                out = out + c
+                last_num = c.isnumeric()
+
+    if sups:
+        out = out + "<sup>" + sups + "</sup>"
+    if subs:
+        out = out + "<sub>" + subs + "</sub>"
+
+    return out
+
+
+def _legacy_plainformula(formulas):
+    formulas = formulas.str.replace(r"([A-Za-z\\+\\-\\)\]])([0-9\.Σ=]+(?![+-]))", r"\1<sub>\2</sub>", regex=True)
+    return formulas.str.replace(r"(?<=[A-Za-z])([0-9]?[+-][0-9]?)", r"<sup>\1</sup>", regex=True)
+
+
+def main(source="100000", number=3):
+    formulas = _load(source)
+    plain = formulas.str.replace(r"[_^#@]", "", regex=True)
+
+    assert formulas.apply(_legacy_simpleformula).equals(simpleformula_column(formulas))
+    assert _legacy_plainformula(plain).equals(plainformula_column(plain))
+
+    def _engine():
+        simpleformula.cache_clear()
+        simpleformula_column(formulas)
+
+    _legacy_time = min(repeat(lambda: formulas.apply(_legacy_simpleformula), number=1, repeat=number))
+    _engine_time = min(repeat(_engine, number=1, repeat=number))
+    print(
+        f"simpleformula ({len(formulas)} formulas): legacy {_legacy_time:0.3f}s, "
+        f"engine {_engine_time:0.3f}s, x{_legacy_time / _engine_time:0.1f}"
+    )
+
+    _legacy_time = min(repeat(lambda: _legacy_plainformula(plain), number=1, repeat=number))
+    def _plain_engine():
+        plainformula.cache_clear()
+        plainformula_column(plain)
+
+    _engine_time = min(repeat(_plain_engine, number=1, repeat=number))
+    print(
+        f"plainformula ({len(plain)} formulas): legacy {_legacy_time:0.3f}s, "
+        f"engine {_engine_time:0.3f}s, x{_legacy_time / _engine_time:0.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
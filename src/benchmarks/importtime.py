@@ -0,0 +1,58 @@
+# -*- coding: UTF-8 -*-
+"""
+Import-time budget of the sync entry point, measured with python -X importtime in a fresh
+interpreter. Exits with 1 when importing the module takes longer than the budget. The budget
+is enforced by tests/test_importtime.py, this script lists the slowest imports.
+
+Usage: python -m src.benchmarks.importtime [budget in seconds] [module]
+"""
+import re
+import subprocess
+import sys
+
+BUDGET = 2.0
+MODULE = "sync"
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def measure(module=MODULE):
+    """
+    :return: (cumulative seconds of the module import, list of (package, cumulative seconds)
+        of its direct imports)
+    """
+    _process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    _children = []
+    for line in _process.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        # nested imports are printed before their parent, indented by two spaces per level
+        if len(match.group(3)) == 2:
+            _children.append((match.group(4), int(match.group(2)) / 1e6))
+        elif not match.group(3):
+            if match.group(4) == module:
+                return int(match.group(2)) / 1e6, _children
+            _children = []
+    return 0, []
+
+
+def main(budget=BUDGET, module=MODULE):
+    total, imports = measure(module)
+
+    for package, cumulative in sorted(imports, key=lambda _: _[1], reverse=True)[:10]:
+        print(f"{package}: {cumulative:0.3f} seconds")
+    print(f"import {module}: {total:0.3f} seconds, budget {budget:0.3f} seconds")
+
+    if total > budget:
+        print("Import time budget exceeded")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET, *sys.argv[2:3])
@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark of src.utils.prepare_minerals_polars against src.utils.prepare_minerals on synthetic
+mindat rows, both outputs are checked to be identical first. Colors are served from the colors
+cache after the first run, so the timings compare the column cleaning.
+
+Usage: python -m src.benchmarks.minerals [rows]
+"""
+import re
+import sys
+from timeit import repeat
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+
+from src.queries import get_minerals
+from src.utils import fillna_nan, prepare_minerals, prepare_minerals_polars
+
+
+def _generate(rows, seed=0):
+    _rng = np.random.default_rng(seed)
+    _columns = re.findall(r"(?i)\bas ([A-Za-z_0-9]+)", get_minerals.split("FROM minerals")[0])
+
+    minerals = pd.DataFrame(
+        {_col: np.where(_rng.random(rows) < 0.6, None, f" {_col} {_rng.integers(100)} ") for _col in _columns}
+    )
+    for _col in _columns:
+        if re.search(r"(Min|Max|Calculated)$", _col):
+            minerals[_col] = np.where(_rng.random(rows) < 0.6, np.nan, _rng.random(rows) * 10)
+
+    _colors = np.array(["Brown to red", "green; pale green", "colourless", "", "White"], dtype=object)
+    minerals["mindat_id"] = np.arange(1, rows + 1)
+    minerals["name"] = [f" Mineral{i:07d} " for i in range(rows)]
+    minerals["ima_status"] = _rng.integers(0, 32, rows).astype(float)
+    minerals["ima_note"] = _rng.integers(0, 1024, rows).astype(float)
+    minerals["discovery_year"] = np.where(_rng.random(rows) < 0.3, None, _rng.integers(1800, 2024, rows).astype(str))
+    minerals["description"] = np.where(_rng.random(rows) < 0.5, "", "description")
+    minerals["imaformula"] = np.where(_rng.random(rows) < 0.5, None, "Ca^2#2+#(CO_3_)@H_2_O")
+    minerals["crystal_system"] = _rng.choice(["Monoclinic", "Triclinic", ""], rows)
+    minerals["physical_color"] = _rng.choice(_colors, rows)
+    minerals["physical_streak"] = _rng.choice(_colors, rows)
+    minerals["physical_tenacity"] = _rng.choice(["brittle,sectile", "flexible", ""], rows)
+
+    return minerals.fillna(value=np.nan)
+
+
+def _check(pandas_, polars_):
+    assert list(pandas_.columns) == list(polars_.columns)
+    for _col in pandas_.columns:
+        assert pandas_[_col].dtype == polars_[_col].dtype, _col
+        assert list(map(repr, pandas_[_col])) == list(map(repr, polars_[_col])), _col
+
+
+def _null_chunk(minerals):
+    """
+    A chunk of the streamed minerals in which every string column is null, as read from the cursor
+    """
+    _chunk = minerals.head(100).copy()
+    for _col in _chunk.columns[_chunk.dtypes == object].drop("name"):
+        _chunk[_col] = pd.Series([None] * len(_chunk), index=_chunk.index, dtype=object)
+    return fillna_nan(_chunk)
+
+
+def main(rows=50000, number=3):
+    minerals = _generate(rows)
+
+    _check(prepare_minerals(minerals), prepare_minerals_polars(minerals))
+    # as handed over by the arrow reader
+    _check(
+        prepare_minerals(minerals),
+        prepare_minerals_polars(pl.from_arrow(pa.Table.from_pandas(minerals, preserve_index=False))),
+    )
+    _check(prepare_minerals(_null_chunk(minerals)), prepare_minerals_polars(_null_chunk(minerals)))
+
+    _pandas_time = min(repeat(lambda: prepare_minerals(minerals), number=1, repeat=number))
+    _polars_time = min(repeat(lambda: prepare_minerals_polars(minerals), number=1, repeat=number))
+    print(
+        f"prepare_minerals ({rows} rows): pandas {_pandas_time:0.3f}s, polars {_polars_time:0.3f}s, "
+        f"x{_pandas_time / _polars_time:0.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark of the arrow reader (connectorx) against pandas.read_sql_query for the source and
+target queries, wall time and resident memory of the resulting frames.
+
+Needs the databases configured in .env.
+
+Usage: python -m src.benchmarks.reads [number]
+"""
+import sys
+from timeit import repeat
+
+from src.base import Migrator
+from src.queries import (
+    get_cod,
+    get_mineral_log,
+    get_mineral_relation,
+    get_mineral_status,
+    get_minerals,
+    get_relations,
+)
+
+
+QUERIES = {
+    "minerals": (get_minerals, "mindat"),
+    "relations": (get_relations, "mindat"),
+    "cod": (get_cod, "cod"),
+    "mineral_log": (get_mineral_log, "mr"),
+    "mineral_status": (get_mineral_status, "mr"),
+    "mineral_relation": (get_mineral_relation, "mr"),
+}
+
+
+def _memory(frame):
+    return frame.memory_usage(deep=True).sum() / 2**20
+
+
+def main(number=3):
+    db = Migrator(env="dev")
+    db.connect_db()
+
+    try:
+        for name, (query, source) in QUERIES.items():
+            results = []
+            for reader, arrow_dtypes in [("sql", False), ("arrow", False), ("arrow", True)]:
+                _read = lambda: db.read_frame(query, source, reader=reader, arrow_dtypes=arrow_dtypes)
+                _time = min(repeat(_read, number=1, repeat=number))
+                _frame = _read()
+                results.append(
+                    f"{reader}{'[pyarrow]' if arrow_dtypes else ''} {_time:0.2f}s {_memory(_frame):0.1f}MB"
+                )
+            print(f"{name} ({len(_frame)} rows): " + ", ".join(results))
+
+    finally:
+        db.disconnect_db()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,206 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark of every prepare_* stage and of the diff part of every sync_* method on synthetic
+inputs from src.benchmarks.synthetic. It runs offline: file inputs are written to a temporary
+working directory and the database writes of the sync methods are replaced by no-ops.
+The results are written to JSON so that runs can be compared.
+
+Usage: python -m src.benchmarks.stages [rows] [number] [output.json]
+"""
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime
+from timeit import repeat
+
+import pandas as pd
+import polars as pl
+
+from src.benchmarks import synthetic
+from src.connectors import Migration
+from src.digis.generate_export import _clean_data, _get_data
+from src.utils import (
+    prepare_mineral_structure,
+    prepare_minerals,
+    prepare_minerals_formula,
+    prepare_minerals_relation_status,
+)
+
+
+OUTPUT_PATH = "db/reports/benchmarks/"
+
+SYNC_STEPS = [
+    "sync_mineral_log",
+    "sync_mineral_history",
+    "sync_mineral_crystallography",
+    "sync_mineral_formula",
+    "sync_mineral_ima_status",
+    "sync_mineral_ima_note",
+    "sync_mineral_context",
+    "sync_mineral_status",
+    "sync_mineral_relation",
+    "sync_mineral_relation_suggestion",
+]
+
+
+class _Cursor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Connection:
+    def cursor(self):
+        return _Cursor()
+
+    def commit(self):
+        pass
+
+
+class _Pool:
+    def getconn(self):
+        return _Connection()
+
+    def putconn(self, conn):
+        pass
+
+
+class _OfflineMigration(Migration):
+    """
+    Migration whose writes only count the rows they would send to the database
+    """
+
+    def __init__(self, tables, lookups, alternative_names):
+        # the inserted mineral_log rows have no ids, as in a dry run
+        super().__init__(dry_run=True)
+        self.pool = _Pool()
+        self.lookups = lookups
+        self.written = {}
+        self._alternative_names = alternative_names
+        for _table, _frame in tables.items():
+            setattr(self, _table, _frame)
+
+    def execute_query(self, df, query, chunk_size=None, checkpoint=None):
+        self.written[query] = self.written.get(query, 0) + len(df)
+        return df
+
+    copy_query = execute_query
+
+    @staticmethod
+    def save_report(data, table_name, operation):
+        pass
+
+    def get_alternative_names(self, reader="sql"):
+        return self._alternative_names
+
+
+def _time(function, number):
+    return min(repeat(function, number=1, repeat=number))
+
+
+def _write_inputs(path, rows, names, cod_):
+    os.makedirs(os.path.join(path, "data", "generated"), exist_ok=True)
+    with open(os.path.join(path, "data", "real-formulas-rruff.json"), "w") as f:
+        json.dump(synthetic.rruff(max(rows // 10, 1), names), f)
+    synthetic.cod_mr_mapping(cod_).to_csv(os.path.join(path, "data", "cod-mr-mapping.csv"), index=False)
+    _georoc = os.path.join(path, "data", "georoc.csv")
+    synthetic.georoc(rows).write_csv(_georoc)
+    return _georoc
+
+
+@contextlib.contextmanager
+def _working_directory(path):
+    _cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(_cwd)
+
+
+def run(rows=10000, number=3):
+    """
+    :param rows: number of synthetic minerals, the other inputs are scaled from it
+    :param number: repetitions of each stage, the fastest one is reported
+    :return: dict of stage -> seconds
+    """
+    results = {}
+
+    _minerals = synthetic.minerals(rows)
+    _relations = synthetic.relations(rows)
+    _names = _minerals["name"].str.strip().to_numpy()
+    _cod = synthetic.cod(rows, _names)
+    _alternative_names = synthetic.alternative_names(_names)
+
+    with tempfile.TemporaryDirectory() as path, _working_directory(path):
+        _georoc = _write_inputs(path, rows, _names, _cod)
+
+        results["prepare_minerals"] = _time(lambda: prepare_minerals(_minerals), number)
+        _prepared = prepare_minerals(_minerals)
+
+        results["prepare_minerals_formula"] = _time(
+            lambda: prepare_minerals_formula(_prepared[["mindat_id", "name", "formula", "imaformula", "note"]]),
+            number,
+        )
+        results["prepare_minerals_relation_status"] = _time(
+            lambda: prepare_minerals_relation_status(_prepared[["name", "variety_of", "synonym_of", "polytype_of"]]),
+            number,
+        )
+        results["prepare_mineral_structure"] = _time(
+            lambda: prepare_mineral_structure(_cod.copy(), _alternative_names), number
+        )
+        results["_get_data"] = _time(lambda: _get_data(_georoc), number)
+        _georoc_data = _get_data(_georoc)
+        results["_clean_data"] = _time(lambda: _clean_data(_georoc_data), number)
+
+        _targets = synthetic.targets(_prepared, _relations)
+        migrate = _OfflineMigration(
+            _targets, synthetic.lookups(_targets["mineral_log"], _prepared), _alternative_names
+        )
+        migrate.minerals = _prepared
+        migrate.relations = _relations
+        for _step in SYNC_STEPS:
+            results[_step] = _time(getattr(migrate, _step), number)
+
+    return results
+
+
+def main(rows=10000, number=3, output=None):
+    rows, number = int(rows), int(number)
+    results = run(rows, number)
+
+    for _stage, _seconds in results.items():
+        print(f"{_stage:<36} {_seconds:0.3f}s")
+
+    output = output or os.path.join(OUTPUT_PATH, f"stages_{rows}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "rows": rows,
+                "number": number,
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+                "polars": pl.__version__,
+                "stages": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,398 @@
+# -*- coding: UTF-8 -*-
+"""
+Generators of synthetic inputs shaped like the real extracts: the mindat minerals and relations,
+the target tables returned by Migration.fetch_tables and their lookups, the alternative names, COD rows, RRUFF
+items and GEOROC csv files. All generators are deterministic for a given seed.
+"""
+import json
+import re
+import uuid
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from src.constants import IMA_NOTES_CHOICES, IMA_STATUS_CHOICES
+from src.diff import row_hash
+from src.digis.generate_export import _chem_cols, _meta_cols
+from src.queries import get_minerals
+from src.utils import prepare_mineral_context, prepare_minerals_formula, prepare_minerals_relation_status
+
+
+_STEMS = [
+    "calc", "dolom", "magnes", "sider", "rhodochros", "smithson", "arag", "wither", "strontian", "cerus",
+    "quartz", "albit", "orthoclas", "microclin", "anorth", "bytown", "labrador", "oligoclas", "nephel",
+    "leuc", "diopsid", "augit", "hedenbergit", "enstat", "ferrosil", "tremol", "actinol", "hornblend",
+]
+_ACCENTED = ["é", "ö", "ø", "ü", "á"]
+_ELEMENTS = ["Ca", "Mg", "Fe", "Al", "Si", "Na", "K", "Mn", "Cu", "Zn", "Pb", "Ba", "Sr", "Ti", "Cr", "Ni"]
+_ANIONS = ["(CO_3_)", "(SiO_4_)", "(SO_4_)", "(PO_4_)", "(OH)_2_", "O_3_", "Cl", "F_2_"]
+_COLORS = [
+    "white", "colourless", "grey", "black", "brown", "reddish brown", "red", "pink", "orange", "yellow",
+    "pale green", "emerald green", "green", "blue", "sky-blue", "violet", "purple",
+]
+_CRYSTAL_SYSTEMS = [
+    "Triclinic", "Monoclinic", "Orthorhombic", "Tetragonal", "Hexagonal", "Trigonal", "Cubic", "Amorphous",
+]
+_SPACE_GROUPS = ["P 1", "P -1", "P 21/c", "C 2/m", "P n m a", "I 41/a", "R -3 c", "P 63/m m c", "F m -3 m"]
+
+
+def _names(rows, seed=0):
+    """
+    Unique mineral names, about 1% of them with diacritics
+    """
+    _rng = np.random.default_rng(seed)
+    _stems = _rng.choice(_STEMS, rows)
+    names = [f"{_stem.capitalize()}{np.base_repr(i, 36).lower()}ite" for i, _stem in enumerate(_stems)]
+    for i in np.flatnonzero(_rng.random(rows) < 0.01):
+        names[i] = names[i][:3] + _rng.choice(_ACCENTED) + names[i][3:]
+    return np.array(names, dtype=object)
+
+
+def _flags(rng, rows, choices, p):
+    _flags = np.zeros(rows, dtype=np.int64)
+    for _value in choices.values():
+        _flags |= np.where(rng.random(rows) < p, _value, 0)
+    return _flags
+
+
+def _mindat_formulas(rng, rows, unique):
+    _formulas = [
+        "".join(rng.choice(_ELEMENTS, rng.integers(1, 4)))
+        + "^2+^" * int(rng.random() < 0.2)
+        + "".join(rng.choice(_ANIONS, rng.integers(1, 3)))
+        + "@" * int(rng.random() < 0.2)
+        + "nH_2_O" * int(rng.random() < 0.2)
+        for _ in range(unique)
+    ]
+    return rng.choice(np.array(_formulas, dtype=object), rows)
+
+
+def _color_notes(rng, rows, unique):
+    _notes = [
+        ", ".join(rng.choice(_COLORS, rng.integers(1, 4))) + (" to " + rng.choice(_COLORS)) * int(rng.random() < 0.3)
+        for _ in range(unique)
+    ]
+    return rng.choice(np.array(_notes, dtype=object), rows)
+
+
+def _sometimes(rng, values, p):
+    return np.where(rng.random(len(values)) < p, values, None)
+
+
+def minerals(rows, seed=0):
+    """
+    Raw mindat minerals as returned by the get_minerals query
+    :param rows: number of minerals, e.g. 1000 to 1000000
+    :return: pandas.DataFrame
+    """
+    _rng = np.random.default_rng(seed)
+    _columns = re.findall(r"(?i)\bas ([A-Za-z_0-9]+)", get_minerals.split("FROM minerals")[0])
+    _columns.insert(_columns.index("ima_symbol"), "description")
+    _names_ = _names(rows, seed)
+
+    data = {}
+    for _col in _columns:
+        if re.search(r"(Min|Max|Calculated)$", _col):
+            data[_col] = np.where(_rng.random(rows) < 0.7, np.nan, np.round(_rng.random(rows) * 10, 3))
+        else:
+            data[_col] = _sometimes(_rng, np.array([f" {_col} {_ % 50} " for _ in range(rows)], dtype=object), 0.2)
+
+    data["mindat_id"] = np.arange(1, rows + 1)
+    data["name"] = np.array([f" {_} " if i % 97 == 0 else _ for i, _ in enumerate(_names_)], dtype=object)
+    data["ima_status"] = np.where(_rng.random(rows) < 0.3, np.nan, _flags(_rng, rows, IMA_STATUS_CHOICES, 0.3))
+    data["ima_note"] = np.where(_rng.random(rows) < 0.5, np.nan, _flags(_rng, rows, IMA_NOTES_CHOICES, 0.1))
+    data["formula"] = _sometimes(_rng, _mindat_formulas(_rng, rows, max(rows // 3, 1)), 0.9)
+    data["imaformula"] = _sometimes(_rng, _mindat_formulas(_rng, rows, max(rows // 3, 1)), 0.6)
+    data["note"] = _sometimes(_rng, np.array(["", "Ideal formula"], dtype=object)[_rng.integers(0, 2, rows)], 0.3)
+    data["description"] = _sometimes(_rng, np.array([f"A mineral {_}" for _ in range(rows)], dtype=object), 0.5)
+    data["ima_symbol"] = _sometimes(_rng, np.array([_[:3] for _ in _names_], dtype=object), 0.4)
+    data["crystal_system"] = _sometimes(_rng, _rng.choice(_CRYSTAL_SYSTEMS + [""], rows), 0.8)
+    for _year, _p in [("ima_year", 0.5), ("approval_year", 0.3), ("publication_year", 0.3)]:
+        data[_year] = np.where(_rng.random(rows) < _p, _rng.integers(1960, 2024, rows), 0).astype(float)
+    data["discovery_year"] = _sometimes(
+        _rng, np.array([str(_) if _ % 20 else "ca. 1900" for _ in _rng.integers(1700, 2024, rows)], dtype=object), 0.7
+    )
+    for _relation in ["variety_of", "synonym_of", "polytype_of"]:
+        data[_relation] = _sometimes(_rng, _rng.choice(_names_, rows), 0.05)
+
+    data["physical_color"] = _sometimes(_rng, _color_notes(_rng, rows, max(rows // 5, 1)), 0.7)
+    data["physical_streak"] = _sometimes(_rng, _color_notes(_rng, rows, max(rows // 20, 1)), 0.5)
+    for _col, _values in [
+        ("physical_transparency", ["Transparent", "Transparent,Translucent", "Opaque"]),
+        ("physical_tenacity", ["Brittle", "Brittle,Sectile", "Flexible", ""]),
+        ("physical_lustre", ["Vitreous", "Vitreous,Pearly", "Metallic"]),
+        ("optical_type", ["Biaxial ", " Uniaxial", "Isotropic"]),
+        ("optical_sign", ["(+)", "(-)"]),
+    ]:
+        data[_col] = _sometimes(_rng, _rng.choice(np.array(_values, dtype=object), rows), 0.5)
+
+    return pd.DataFrame(data, columns=_columns).fillna(value=np.nan)
+
+
+def relations(rows, seed=0):
+    """
+    Mindat relations as returned by the get_relations query
+    """
+    _rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "id": np.arange(1, rows + 1),
+            "mineral_id": _rng.integers(1, rows + 1, rows),
+            "relation_id": _rng.integers(1, rows + 1, rows),
+            "relation_type_id": _rng.integers(1, 10, rows),
+        }
+    )
+
+
+def _synced(frame, rng, synced, stale, columns=None):
+    """
+    Keep a fraction of the rows as already synced and change the values of some of them
+    """
+    _frame = frame.loc[rng.random(len(frame)) < synced].reset_index(drop=True)
+    _stale = rng.random(len(_frame)) < stale
+    for _col in columns or []:
+        if pd.api.types.is_numeric_dtype(_frame[_col]):
+            _frame.loc[_stale, _col] = _frame.loc[_stale, _col] + 1
+        else:
+            _frame.loc[_stale, _col] = "stale"
+    return _frame
+
+
+def targets(minerals_, relations_, seed=0, synced=0.95, stale=0.01):
+    """
+    Target tables as returned by Migration.fetch_tables, built from prepared minerals
+    :param minerals_: output of prepare_minerals
+    :param relations_: output of relations
+    :param synced: fraction of the source rows already in the target
+    :param stale: fraction of the synced rows with changed values
+    :return: dict of table name -> pandas.DataFrame
+    """
+    _rng = np.random.default_rng(seed)
+
+    mineral_log = minerals_[["name", "description", "mindat_id", "ima_symbol"]].copy()
+    mineral_log["id"] = [str(uuid.UUID(int=_)) for _ in range(len(mineral_log))]
+    mineral_log["row_hash"] = row_hash(mineral_log, ["description", "mindat_id", "ima_symbol"])
+    mineral_log = _synced(mineral_log[["id", "name", "row_hash"]], _rng, synced, stale, ["row_hash"])
+
+    mineral_history = minerals_[["name", "discovery_year", "ima_year", "approval_year", "publication_year"]].copy()
+    mineral_history.insert(0, "id", np.arange(len(mineral_history)))
+    mineral_history["row_hash"] = row_hash(
+        mineral_history, ["discovery_year", "ima_year", "approval_year", "publication_year"]
+    )
+    mineral_history = _synced(mineral_history[["id", "name", "row_hash"]], _rng, synced, stale, ["row_hash"])
+
+    _formula = prepare_minerals_formula(minerals_[["mindat_id", "name", "formula", "imaformula", "note"]])
+    _formula["row_hash"] = row_hash(_formula, ["formula", "note", "source_id"])
+    _crystallography = minerals_[["name", "crystal_system"]].dropna()
+    _crystallography["row_hash"] = row_hash(_crystallography, ["crystal_system"])
+    _status = prepare_minerals_relation_status(minerals_[["name", "variety_of", "synonym_of", "polytype_of"]])
+    _context = prepare_mineral_context(minerals_[["name", "physical_context", "optical_context"]])
+    _context.insert(0, "id", np.arange(len(_context)))
+
+    return {
+        "mineral_log": mineral_log,
+        "mineral_history": mineral_history,
+        "mineral_formula": _synced(_formula[["name", "row_hash"]], _rng, synced, 0),
+        "mineral_crystallography": _synced(
+            _crystallography[["name", "row_hash"]], _rng, synced, stale, ["row_hash"]
+        ),
+        "mineral_ima_status": _synced(
+            minerals_[["name", "ima_status"]].explode("ima_status").dropna(), _rng, synced, 0
+        ),
+        "mineral_ima_note": _synced(minerals_[["name", "ima_note"]].explode("ima_note").dropna(), _rng, synced, 0),
+        "mineral_status": _synced(_status[["name", "status_id", "direct_status"]], _rng, synced, 0),
+        "mineral_relation": _synced(_status[["name", "status_id", "relation", "direct_status"]], _rng, synced, 0),
+        "mineral_relation_suggestion": _synced(relations_, _rng, synced, stale, ["relation_type_id"]),
+        "mineral_context": _synced(
+            _context[["id", "name", "context_id", "data_hash"]], _rng, synced, stale, ["data_hash"]
+        ),
+    }
+
+
+def _lookup(keys):
+    keys = pd.unique(pd.Series(keys).dropna())
+    return pd.Series(np.arange(1, len(keys) + 1), index=keys)
+
+
+def lookups(mineral_log, minerals_):
+    """
+    Lookups as loaded by Migrator.load_lookups, the list tables hold every key of the minerals
+    :param mineral_log: target mineral_log from targets
+    :param minerals_: output of prepare_minerals
+    """
+    _status = prepare_minerals_relation_status(minerals_[["name", "variety_of", "synonym_of", "polytype_of"]])
+    _mindat = mineral_log.merge(minerals_[["name", "mindat_id"]].drop_duplicates("name"), on="name")
+    _mindat = _mindat.dropna(subset=["mindat_id"])
+    return {
+        "mineral_log": pd.Series(mineral_log["id"].to_numpy(), index=mineral_log["name"].to_numpy()),
+        "mineral_log_mindat": pd.Series(_mindat["id"].to_numpy(), index=_mindat["mindat_id"].to_numpy()),
+        "mineral_log_upper": pd.Series(mineral_log["id"].to_numpy(), index=mineral_log["name"].str.upper().to_numpy()),
+        "status_list": _lookup(_status["status_id"]),
+        "crystal_system_list": _lookup(minerals_["crystal_system"]),
+        "ima_status_list": _lookup(minerals_["ima_status"].explode()),
+        "ima_note_list": _lookup(minerals_["ima_note"].explode()),
+        "data_context_list": pd.Series([1, 2], index=[1, 2]),
+    }
+
+
+def alternative_names(names, seed=0):
+    """
+    Alternative names as returned by the get_alternative_names query: every mineral with
+    priority 1 or 3 and about 10% of them related to another mineral with priority 2
+    """
+    _rng = np.random.default_rng(seed)
+    names = np.asarray(names, dtype=object)
+    _ids = np.array([str(uuid.UUID(int=_)) for _ in range(len(names))], dtype=object)
+
+    _own = pd.DataFrame(
+        {
+            "mineral_id": _ids,
+            "name": names,
+            "relation_id": None,
+            "relation_name": None,
+            "priority": _rng.choice([1, 3], len(names)),
+        }
+    )
+    _related = np.flatnonzero(_rng.random(len(names)) < 0.1)
+    _relations = _rng.integers(0, len(names), len(_related))
+    _related = pd.DataFrame(
+        {
+            "mineral_id": _ids[_related],
+            "name": names[_related],
+            "relation_id": _ids[_relations],
+            "relation_name": names[_relations],
+            "priority": 2,
+        }
+    )
+    return pd.concat([_own, _related], ignore_index=True).sort_values("name").reset_index(drop=True)
+
+
+def _cod_formula(rng):
+    _formula = " ".join(
+        f"{_element}{round(rng.random() * 3, 2) if rng.random() < 0.5 else rng.integers(1, 5)}"
+        for _element in rng.choice(_ELEMENTS + ["O", "H", "C"], rng.integers(2, 6))
+    )
+    return f"- {_formula} -"
+
+
+def cod(rows, names, seed=0):
+    """
+    COD rows as returned by the get_cod query, the mineral names are taken from names
+    """
+    _rng = np.random.default_rng(seed)
+    _ids = 1000000 + np.arange(rows)
+    _formulas = np.array([_cod_formula(_rng) for _ in range(max(rows // 4, 1))], dtype=object)
+
+    data = {
+        "id": _ids,
+        "amcsd_id": _sometimes(_rng, np.array([f"{_:07d}" for _ in _rng.integers(0, rows, rows)], dtype=object), 0.3),
+        "mineral_name": np.array(
+            [_.lower() if _i % 3 else _ for _i, _ in enumerate(_rng.choice(names, rows))], dtype=object
+        ),
+    }
+    for _col, _low, _high in [
+        ("a", 3, 30), ("b", 3, 30), ("c", 3, 30), ("alpha", 60, 120), ("beta", 60, 120), ("gamma", 60, 120),
+        ("volume", 50, 5000),
+    ]:
+        data[_col] = np.round(_rng.uniform(_low, _high, rows), 4)
+        data[_col + "_sigma"] = np.where(_rng.random(rows) < 0.4, np.nan, np.round(_rng.random(rows) / 1000, 4))
+    data["space_group"] = _rng.choice(_SPACE_GROUPS, rows)
+    data["formula"] = _rng.choice(_formulas, rows)
+    data["calculated_formula"] = _sometimes(_rng, _rng.choice(_formulas, rows), 0.3)
+    data["reference"] = [
+        f"Author, A. ({1950 + _ % 70}) Title {_}. <i>Journal</i>, <b>{_ % 90}</b>, 1—10." for _ in range(rows)
+    ]
+    data["links"] = [
+        json.dumps([f"https://www.crystallography.net/cod/{_id}.html"] + [f"https://doi.org/10.0/{_id}"] * (_id % 2))
+        for _id in _ids
+    ]
+    data["note"] = _sometimes(
+        _rng, np.array(["natural", "synthetic", ""], dtype=object)[_rng.integers(0, 3, rows)], 0.4
+    )
+    return pd.DataFrame(data)
+
+
+def cod_mr_mapping(cod_):
+    """
+    Corrections of COD mineral names, the data/cod-mr-mapping.csv file
+    """
+    _sample = cod_.drop_duplicates("mineral_name").iloc[::50]
+    return pd.DataFrame(
+        {
+            "cod_id": _sample["id"].to_numpy(),
+            "mineral_name": _sample["mineral_name"].str.capitalize().to_numpy(),
+            "corr_mineral_name": _sample["mineral_name"].str.capitalize().to_numpy(),
+            "note": "name corrected",
+        }
+    )
+
+
+def _sigma(rng, low, high):
+    _value = rng.uniform(low, high)
+    if rng.random() < 0.3:
+        return f"{_value:.2f}"
+    return f"{_value:.4f}({rng.integers(1, 99)})" + ("" if rng.random() < 0.9 else "~")
+
+
+def rruff(rows, names, seed=0):
+    """
+    RRUFF items as stored in data/real-formulas-rruff.json, the cell parameters in sigma
+    notation, e.g. 4.9896(2)
+    :return: list of dict
+    """
+    _rng = np.random.default_rng(seed)
+    _items = []
+    for i in range(rows):
+        _links = [f"https://rruff.info/{i}"]
+        if _rng.random() < 0.1:
+            _links.append("https://")
+        if _rng.random() < 0.6:
+            _links.append(f"http://rruff.geo.arizona.edu/AMS/result.php?key=_database_code_amcsd%20{i:07d}")
+        _items.append(
+            {
+                "mineral_name": str(_rng.choice(names)),
+                "formula": "".join(_rng.choice(_ELEMENTS, 2)) + "_2_(SiO_4_)" + "*H_2_O" * int(_rng.random() < 0.2),
+                "a": _sigma(_rng, 3, 30),
+                "b": _sigma(_rng, 3, 30),
+                "c": _sigma(_rng, 3, 30),
+                "alpha": "90",
+                "beta": _sigma(_rng, 90, 120),
+                "gamma": "90",
+                "volume": _sigma(_rng, 50, 5000),
+                "space_group": '<span class="o">P2<sub>1</sub>/c</span>',
+                "reference": f"Author A (2000) Title {i}.",
+                "links": _links,
+                "note": "\xa0" if _rng.random() < 0.5 else "Sample description",
+            }
+        )
+    return _items
+
+
+def georoc(rows, seed=0):
+    """
+    A GEOROC csv export with the metadata columns and a part of the chemistry columns
+    :return: polars.DataFrame
+    """
+    _rng = np.random.default_rng(seed)
+    data = {
+        "CITATION": [f"[{_}] Author et al." for _ in _rng.integers(1, max(rows // 50, 2), rows)],
+        "SAMPLE NAME": _sometimes(_rng, np.array([f"S{_} " for _ in range(rows)], dtype=object), 0.9),
+        "TECTONIC SETTING": _rng.choice(
+            ["OCEAN ISLAND", "OCEAN ISLANDI", "CONVERGENT MARGIN", "INTRAPLATE VOLCANICS"], rows
+        ),
+        "ALTERATION": _rng.choice(["F", "FRESH", "SLIGHTLY ALTERED", None], rows),
+        "MINERAL": _rng.choice(["CLINOPYROXENE", "(Al)Kalifeldspar", "OLIVINE", "augite"], rows),
+        "PRIMARY/SECONDARY": _rng.choice(["PRIMARY", "SECONDARY", None], rows),
+        "SPOT": _sometimes(_rng, np.array([f"{_} " for _ in range(rows)], dtype=object), 0.5),
+        "CRYSTAL": _sometimes(_rng, np.array(["core", "1.25"], dtype=object)[_rng.integers(0, 2, rows)], 0.3),
+        "LATITUDE (MIN.)": np.round(_rng.uniform(-90, 90, rows), 4),
+        "LONGITUDE (MIN.)": np.round(_rng.uniform(-180, 180, rows), 4),
+    }
+    for _col in _meta_cols:
+        data.setdefault(
+            _col, _sometimes(_rng, np.array([f"{_col.lower()} {_ % 20}" for _ in range(rows)], dtype=object), 0.3)
+        )
+    for _col in _chem_cols[:40]:
+        data[_col] = np.where(_rng.random(rows) < 0.5, None, np.round(_rng.random(rows) * 50, 3).astype(str))
+    return pl.DataFrame({_col: list(_values) for _col, _values in data.items()})
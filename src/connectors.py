@@ -1,11 +1,10 @@
 # -*- coding: UTF-8 -*-
 import concurrent.futures
+import functools
 import os
-import re
 import sys
 import json
 from datetime import datetime
-from time import perf_counter
 
 import numpy as np
 import pandas as pd
@@ -16,19 +15,30 @@ from psycopg2.extras import execute_values, Json
 from psycopg2.pool import ThreadedConnectionPool
 
 from src.queries import (
+    add_row_hash_columns,
+    delete_mineral_context,
     delete_mineral_relation_suggestion,
     get_alternative_names,
+    get_mineral_context,
     get_mineral_crystallography,
+    get_mineral_crystallography_unhashed,
     get_mineral_formula,
+    get_mineral_formula_unhashed,
     get_mineral_history,
+    get_mineral_history_unhashed,
     get_mineral_ima_status,
     get_mineral_ima_note,
     get_mineral_log,
+    get_mineral_log_unhashed,
     get_mineral_relation,
     get_mineral_relation_suggestion,
     get_mineral_status,
     get_minerals,
+    get_minerals_since,
+    get_minerals_watermark,
     get_relations,
+    get_relations_watermark,
+    get_row_hash_tables,
     get_cod,
     insert_mineral_context,
     insert_mineral_crystallography,
@@ -41,18 +51,40 @@ from src.queries import (
     insert_mineral_relation,
     insert_mineral_relation_suggestion,
     insert_mineral_structure,
+    merge_mineral_context,
+    merge_mineral_context_delete,
+    merge_mineral_crystallography,
+    merge_mineral_formula,
+    merge_mineral_history,
+    merge_mineral_ima_note,
+    merge_mineral_ima_status,
+    merge_mineral_log,
+    merge_mineral_relation,
+    merge_mineral_relation_suggestion,
+    merge_mineral_relation_suggestion_delete,
+    merge_mineral_status,
     update_mineral_history,
+    update_mineral_context,
     update_mineral_crystallography,
     update_mineral_log,
     update_mineral_relation_suggestion,
 )
+from src.diff import diff_frames, row_hash
 from src.utils import (
+    _prepare_cod,
+    compact_minerals,
+    fillna_nan,
+    prepare_mineral_context,
     prepare_minerals,
     prepare_minerals_formula,
+    prepare_minerals_polars,
     prepare_minerals_relation_status,
     prepare_mineral_structure,
 )
 from src.base import Migrator
+from src.metrics import span, traced
+from src.relations import RelationGraph
+from src.scheduler import critical_path, run_dag
 
 register_adapter(np.int64, AsIs)
 register_adapter(dict, Json)
@@ -60,10 +92,63 @@ register_adapter(dict, Json)
 load_dotenv(".envs/.local/.mindat")
 load_dotenv(".envs/.prod/.cod")
 
+WATERMARKS_PATH = "data/generated/watermarks.json"
+
+# fetch queries of the tables which do not have the row_hash column yet, see add_row_hash_columns. Only
+# a dry run gets this far without the columns, see check_row_hash_columns
+UNHASHED_QUERIES = {
+    "mineral_log": get_mineral_log_unhashed,
+    "mineral_history": get_mineral_history_unhashed,
+    "mineral_formula": get_mineral_formula_unhashed,
+    "mineral_crystallography": get_mineral_crystallography_unhashed,
+}
+
+# sources fetched concurrently by Migration.extract
+EXTRACT_SOURCES = ["minerals", "relations", "cod", "tables"]
+
+# sync steps and the steps whose writes they rely on
+SYNC_DEPENDENCIES = {
+    "sync_mineral_log": [],
+    "sync_mineral_history": ["sync_mineral_log"],
+    "sync_mineral_crystallography": ["sync_mineral_log"],
+    "sync_mineral_formula": ["sync_mineral_log"],
+    "sync_mineral_ima_status": ["sync_mineral_log"],
+    "sync_mineral_ima_note": ["sync_mineral_log"],
+    "sync_mineral_context": ["sync_mineral_log"],
+    "sync_mineral_status": ["sync_mineral_log"],
+    "sync_mineral_relation": ["sync_mineral_status"],
+    "sync_mineral_relation_suggestion": ["sync_mineral_log"],
+    "sync_rruff_cod": ["sync_mineral_relation"],
+}
+
+# the sync steps built from each incremental extract, its watermark is saved once they all completed
+WATERMARK_STEPS = {
+    "minerals": [
+        "sync_mineral_log",
+        "sync_mineral_history",
+        "sync_mineral_crystallography",
+        "sync_mineral_formula",
+        "sync_mineral_ima_status",
+        "sync_mineral_ima_note",
+        "sync_mineral_context",
+        "sync_mineral_status",
+        "sync_mineral_relation",
+    ],
+    "relations": ["sync_mineral_relation_suggestion"],
+}
+
 
 class Migration(Migrator):
-    def __init__(self, env="dev"):
-        super().__init__(env)
+    def __init__(self, env="dev", incremental=False, offline=False, dry_run=False, merge=False):
+        super().__init__(env, offline=offline, dry_run=dry_run)
+
+        # detect the changes server-side with the merge_* queries, the target tables are not fetched
+        self.merge = merge
+
+        # pull only the Mindat rows changed since the last successful run
+        self.incremental = incremental
+        self.watermarks = self.load_watermarks() if incremental else {}
+        self._watermarks = {}
 
         self.mineral_log = None
         self.mineral_context = None
@@ -74,15 +159,24 @@ class Migration(Migrator):
         self.mineral_status = None
         self.mineral_relation = None
         self.mineral_relation_suggestion = None
+        self.relation_graph = None
 
         self.minerals = None
         self.relations = None
+        # the relations did not change since the last run and none were pulled, see get_relations
+        self.relations_partial = False
+        # the sync steps which completed without errors, see save_watermarks
+        self.completed = set()
 
         self.cod = None
+        # COD rows prepared by extract as soon as they arrive
+        self.cod_prepared = None
 
-    def fetch_tables(self):
+    def fetch_tables(self, reader="sql"):
+        """
+        :param reader: "sql" or "arrow", see Migrator.read_frame
+        """
 
-        s = perf_counter()
         queries = [
             {"table_name": "mineral_log", "query": get_mineral_log},
             {"table_name": "mineral_history", "query": get_mineral_history},
@@ -96,65 +190,160 @@ class Migration(Migrator):
             {"table_name": "mineral_relation", "query": get_mineral_relation},
             {"table_name": "mineral_ima_status", "query": get_mineral_ima_status},
             {"table_name": "mineral_ima_note", "query": get_mineral_ima_note},
+            {"table_name": "mineral_context", "query": get_mineral_context},
         ]
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        if not self.offline:
+            _hashed = self.get_row_hash_tables()
+            for query in queries:
+                if query["table_name"] in UNHASHED_QUERIES and query["table_name"] not in _hashed:
+                    print("%s has no row_hash column, run with --add-row-hash" % query["table_name"])
+                    query["query"] = UNHASHED_QUERIES[query["table_name"]]
+
+        with span("fetch_tables") as _span, concurrent.futures.ThreadPoolExecutor() as executor:
             future_to_table = {
-                executor.submit(self.psql_pd_get, **query): query for query in queries
+                executor.submit(self.psql_pd_get, reader=reader, **query): query
+                for query in queries
             }
             for future in concurrent.futures.as_completed(future_to_table):
                 try:
                     future.result()
                 except Exception as e:
-                    print("an error occurred when running query: %s" % e)
-
-        elapsed = perf_counter() - s
-        print(f"Tables generated in {elapsed:0.2f} seconds.")
-
-
-    def get_minerals(self):
+                    self.fail("an error occurred when running query: %s" % e)
+            _tables = [getattr(self, query["table_name"]) for query in queries]
+            _span.rows_out = sum(len(_table) for _table in _tables if _table is not None)
+
+        print(f"Tables generated in {_span.wall:0.2f} seconds.")
+
+
+    @staticmethod
+    def load_watermarks():
+        if not os.path.exists(WATERMARKS_PATH):
+            return {}
+        with open(WATERMARKS_PATH, "r") as f:
+            return json.load(f)
+
+    def save_watermarks(self):
+        """
+        Persist the high-water marks of the current run. Nothing is saved when an extract, a step
+        or a write of the run failed, see Migrator.fail, and the watermark of an extract is only
+        saved when every step of WATERMARK_STEPS which uses it completed in this run. Otherwise the
+        next run pulls the same rows again.
+        """
+        if self.failures:
+            print("The watermarks were not saved, %s errors occurred in this run" % len(self.failures))
+            return
+        _watermarks = {}
+        for table_name, watermark in self._watermarks.items():
+            _missing = [step for step in WATERMARK_STEPS[table_name] if step not in self.completed]
+            if _missing:
+                print("The %s watermark was not saved, %s did not run" % (table_name, ", ".join(_missing)))
+            else:
+                _watermarks[table_name] = watermark
+        watermarks = {**self.load_watermarks(), **_watermarks}
+        with open(WATERMARKS_PATH, "w") as f:
+            json.dump(watermarks, f, indent=2)
+
+    def _get_watermark(self, query, table_name):
+        if self.offline:
+            return None
+
+        # read before the extract, rows changed while fetching are pulled again next time
+        _watermark = pd.read_sql_query(query, self.mindat_connection_params)["watermark"].iloc[0]
+        if pd.notna(_watermark):
+            self._watermarks[table_name] = str(_watermark)
+
+        since = self.watermarks.get(table_name) if self.incremental else None
+        return since
+
+    def _partial(self, since):
+        """
+        Whether an extract holds only the changed rows, see Migrator.read_frame: online when it is
+        read since a watermark, offline an incremental run accepts the snapshot of such an extract
+        """
+        return self.incremental if self.offline else bool(since)
+
+    def get_minerals(self, chunksize=None, reader="sql", engine="pandas"):
+        """
+        :param chunksize: stream the minerals with a server-side cursor and prepare them in chunks
+            of this many rows, only the compact prepared output is kept in memory. The chunks are
+            not saved as a snapshot, offline mode prepares the whole snapshot at once
+        :param reader: "sql" or "arrow", see Migrator.read_frame, ignored when chunksize is set
+        :param engine: "pandas" prepares the minerals with prepare_minerals, "polars" with
+            prepare_minerals_polars, which takes the arrow extract as a polars frame. The output
+            is the same
+        """
+        _prepare = prepare_minerals_polars if engine == "polars" else prepare_minerals
 
         try:
-            _minerals = (
-                pd.read_sql_query(
-                    get_minerals,
-                    self.mindat_connection_params,
+            since = self._get_watermark(get_minerals_watermark, "minerals")
+            query = get_minerals_since if since else get_minerals
+            params = {"since": since} if since else None
+
+            if chunksize and not self.offline:
+                with span("fetch:minerals") as _span:
+                    _chunks = [
+                        compact_minerals(_prepare(fillna_nan(_chunk)))
+                        for _chunk in self.read_chunks(
+                            query, self.mindat_connection_params, chunksize, params=params
+                        )
+                    ]
+                    _span.rows_out = sum(len(_chunk) for _chunk in _chunks)
+                self.minerals = (
+                    pd.concat(_chunks, ignore_index=True)
+                    .sort_values("name")
+                    .reset_index(drop=True)
                 )
-                .fillna(value=np.nan)
-                .sort_values("name")
-                .reset_index(drop=True)
+                return
+
+            _minerals = self.read_frame(
+                query,
+                "mindat",
+                reader=reader,
+                params=params,
+                snapshot="minerals",
+                partial=self._partial(since),
+                polars=engine == "polars",
             )
+            if engine == "polars":
+                # the polars plan takes the frame of the reader as it is, without a pandas round trip
+                self.minerals = _prepare(_minerals.sort("name", nulls_last=True, maintain_order=True))
+                return
 
-            self.minerals = prepare_minerals(_minerals)
+            self.minerals = _prepare(fillna_nan(_minerals).sort_values("name").reset_index(drop=True))
 
         except Exception as e:
-            print(f"An error occurred when creating minerals: {e}")
-
-    def get_relations(self):
+            self.fail(f"An error occurred when creating minerals: {e}")
 
+    def get_relations(self, reader="sql"):
+        """
+        The watermark of the relations is a fingerprint of the table, see get_relations_watermark:
+        an incremental run pulls every relation when it changed and none when it did not
+        """
         try:
+            since = self._get_watermark(get_relations_watermark, "relations")
+            if since is not None and since == self._watermarks.get("relations"):
+                print("The relations did not change since the last run")
+                self.relations = pd.DataFrame(columns=["id", "mineral_id", "relation_id", "relation_type_id"])
+                self.relations_partial = True
+                return
+
             relations_ = (
-                pd.read_sql_query(
-                    get_relations,
-                    self.mindat_connection_params,
-                )
+                self.read_frame(get_relations, "mindat", reader=reader, snapshot="relations")
                 .fillna(value=np.nan)
                 .sort_values("id")
                 .reset_index(drop=True)
             )
 
             self.relations = relations_
+            self.relations_partial = False
 
         except Exception as e:
-            print(f"An error occurred when creating relations: {e}")
+            self.fail(f"An error occurred when creating relations: {e}")
 
-    def get_cod(self):
+    def get_cod(self, reader="sql"):
         try:
             _data = (
-                pd.read_sql_query(
-                    get_cod,
-                    self.cod_connection_params,
-                )
+                self.read_frame(get_cod, "cod", reader=reader, snapshot="cod")
                 .fillna(value=np.nan)
                 .sort_values("id")
                 .reset_index(drop=True)
@@ -163,15 +352,114 @@ class Migration(Migrator):
             self.cod = _data
 
         except Exception as e:
-            print(f"An error occurred when creating cod data: {e}")
+            self.fail(f"An error occurred when creating cod data: {e}")
+
+    def extract(self, reader="sql", engine="pandas", chunksize=None, sources=None):
+        """
+        Fetch from Mindat, COD and the MR database at the same time. Each source is prepared in its
+        own worker as soon as it arrives: the minerals by get_minerals, the COD rows by _prepare_cod
+        and the target tables are followed by the lookups.
+        :param sources: list of EXTRACT_SOURCES, all by default
+        :return: dict of source -> seconds, see the extract:<source> spans for the fetch and
+            prepare times of each source
+        """
+        _sources = {
+            "minerals": lambda: self.get_minerals(chunksize=chunksize, reader=reader, engine=engine),
+            "relations": lambda: self.get_relations(reader=reader),
+            "cod": lambda: self._extract_cod(reader),
+            "tables": lambda: self._extract_tables(reader),
+        }
+        sources = sources or EXTRACT_SOURCES
+
+        latencies = {}
+        with span("extract"), concurrent.futures.ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            futures = {executor.submit(self._extract_source, source, _sources[source]): source for source in sources}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    latencies[futures[future]] = future.result()
+                except Exception as e:
+                    self.fail("An error occurred when extracting %s: %s" % (futures[future], e))
+
+        for source, seconds in sorted(latencies.items(), key=lambda _: _[1]):
+            print(f"Extracted {source} in {seconds:0.2f} seconds")
+        return latencies
+
+    @staticmethod
+    def _extract_source(source, function):
+        with span(f"extract:{source}") as _span:
+            function()
+        return _span.wall
+
+    def _extract_cod(self, reader):
+        self.get_cod(reader=reader)
+        if self.cod is not None:
+            self.cod_prepared = _prepare_cod(self.cod.copy())
+
+    def add_row_hash_columns(self):
+        """
+        One-off migration adding the row_hash columns to the synced tables where they are missing,
+        the rows without a hash are rewritten once by the next run. The ALTERs take an exclusive
+        lock on the tables, it only runs with sync.py --add-row-hash.
+        """
+        if self.dry_run:
+            print("Dry run, the row_hash columns were not added")
+            return
+        try:
+            self.execute(add_row_hash_columns)
+            print("The row_hash columns were added")
+        except Exception as e:
+            self.fail("An error occurred when adding the row_hash columns: %s" % e)
+
+    def get_row_hash_tables(self):
+        """
+        :return: set of the tables which have the row_hash column, the others are fetched with
+            UNHASHED_QUERIES until add_row_hash_columns has run
+        """
+        try:
+            return set(self.read_frame(get_row_hash_tables, "mr")["table_name"])
+        except Exception as e:
+            self.fail("An error occurred when checking the row_hash columns: %s" % e)
+            return set(UNHASHED_QUERIES)
+
+    def check_row_hash_columns(self):
+        """
+        The writes and merges of the synced tables set row_hash, stop before the extract when one of
+        them does not have the column yet. A dry run without merge only reads them, with
+        UNHASHED_QUERIES, and offline nothing is read from the MR database
+        """
+        if self.offline or (self.dry_run and not self.merge):
+            return
+        _missing = sorted(set(UNHASHED_QUERIES) - self.get_row_hash_tables())
+        if _missing:
+            sys.exit("%s have no row_hash column, run once with --add-row-hash" % ", ".join(_missing))
+
+    def _extract_tables(self, reader):
+        # the merge mode does not compare with the target tables
+        if not self.merge:
+            self.fetch_tables(reader=reader)
+            self.load_lookups(reader=reader)
+            self.build_relation_graph()
+
+    def build_relation_graph(self):
+        """
+        Build the RelationGraph from the fetched mineral_status and mineral_relation, it replaces the
+        get_alternative_names query for the rest of the run
+        """
+        try:
+            self.relation_graph = RelationGraph.from_frames(self.mineral_status, self.mineral_relation)
+        except Exception as e:
+            self.relation_graph = None
+            print("An error occurred when building the relation graph: %s" % e)
+
+    def get_alternative_names(self, reader="sql"):
+        if self.relation_graph is not None:
+            _lookup = self.lookups["mineral_log"].dropna()
+            return self.relation_graph.alternative_names(pd.Series(_lookup.index, index=_lookup.to_numpy()))
 
-    def get_alternative_names(self):
         try:
-            conn = self.pool.getconn()
             retrieved_ = (
-                pd.read_sql_query(
-                    get_alternative_names,
-                    conn,
+                self.read_frame(
+                    get_alternative_names, "mr", reader=reader, snapshot="alternative_names"
                 )
                 .fillna(value=np.nan)
                 .reset_index(drop=True)
@@ -179,14 +467,64 @@ class Migration(Migrator):
             return retrieved_
 
         except Exception as e:
-            print("An error occurred when retrieving %s: %s" % ("alternative names", e))
+            self.fail("An error occurred when retrieving %s: %s" % ("alternative names", e))
+
+    def sync(self, steps=None, max_workers=None):
+        """
+        Run the sync steps concurrently, respecting SYNC_DEPENDENCIES. Dependencies on steps
+        which are not selected are ignored.
+        :param steps: list of sync method names, all steps by default
+        """
+        steps = steps or list(SYNC_DEPENDENCIES)
+        if not self.merge and not self.lookups:
+            self.load_lookups()
+        if self.connection is not None:
+            # the steps share the run transaction, one at a time
+            max_workers = 1
+        timings = run_dag(
+            {step: traced(step)(functools.partial(self._sync_step, step)) for step in steps},
+            SYNC_DEPENDENCIES,
+            max_workers=max_workers,
+        )
 
-        finally:
-            self.pool.putconn(conn)
+        for step in steps:
+            if step not in timings:
+                self.fail("The step %s did not complete" % step)
+        self.completed.update(timings)
+
+        for step, (start, end) in sorted(timings.items(), key=lambda _: _[1][0]):
+            print(f"{step}: {start:0.2f}s - {end:0.2f}s ({end - start:0.2f} seconds)")
+        path, duration = critical_path(timings, SYNC_DEPENDENCIES)
+        if path:
+            print(f"Critical path: {' -> '.join(path)} ({duration:0.2f} seconds)")
+        if self.dry_run:
+            self.print_planned()
+
+        return timings
+
+    def _sync_step(self, step):
+        """
+        Run a step in its own savepoint. The steps catch their errors, a step which recorded one,
+        see Migrator.fail, raises so that its writes are rolled back within a run transaction
+        and run_dag skips the steps depending on it
+        """
+        self._local.failures = 0
+        with self.savepoint(step):
+            getattr(self, step)()
+            if self._local.failures:
+                raise RuntimeError("%s errors occurred in %s" % (self._local.failures, step))
+
+    def print_planned(self):
+        """
+        Print the number of rows a dry run would have written, by table and operation
+        """
+        print("Dry run, no changes were written:")
+        for (table_name, operation), rows in sorted(self.planned.items()):
+            print(f"  {table_name:<32} {operation:<8} {rows}")
 
     def sync_mineral_ima_status(self):
 
-        assert self.mineral_ima_status is not None
+        assert self.merge or self.mineral_ima_status is not None
         assert self.minerals is not None
 
         columns = [
@@ -195,23 +533,22 @@ class Migration(Migrator):
         ]
         _minerals = self.minerals[['name', 'ima_status']].explode('ima_status').dropna()
 
-        outer_join = self.mineral_ima_status.merge(
-            _minerals[columns], how='outer', on='name', indicator=True
-        )
+        if self.merge:
+            self.merge_query(_minerals[columns], merge_mineral_ima_status, "mineral_ima_status")
+            return
+
+        insert, _, _ = diff_frames(_minerals[columns], self.mineral_ima_status, keys=['name'])
 
         # Insert
-        insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
-        insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
-        insert.rename(
-            columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True
-        )
         insert = insert.drop_duplicates(
             [
                 "name",
                 "ima_status",
             ]
         )
-        insert = insert[columns]
+        insert = self.resolve(
+            insert[columns], {"name": "mineral_log", "ima_status": "ima_status_list"}, "mineral_ima_status"
+        )
 
         if len(insert) > 0:
             try:
@@ -219,13 +556,12 @@ class Migration(Migrator):
                 self.save_report(
                     retrieved_, table_name="mineral_ima_status", operation="insert"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_ima_status", e))
 
     def sync_mineral_ima_note(self):
 
-        assert self.mineral_ima_note is not None
+        assert self.merge or self.mineral_ima_note is not None
         assert self.minerals is not None
 
         columns = [
@@ -234,23 +570,22 @@ class Migration(Migrator):
         ]
         _minerals = self.minerals[['name', 'ima_note']].explode('ima_note').dropna()
 
-        outer_join = self.mineral_ima_status.merge(
-            _minerals[columns], how='outer', on='name', indicator=True
-        )
+        if self.merge:
+            self.merge_query(_minerals[columns], merge_mineral_ima_note, "mineral_ima_note")
+            return
+
+        insert, _, _ = diff_frames(_minerals[columns], self.mineral_ima_note, keys=['name'])
 
         # Insert
-        insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
-        insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
-        insert.rename(
-            columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True
-        )
         insert = insert.drop_duplicates(
             [
                 "name",
                 "ima_note",
             ]
         )
-        insert = insert[columns]
+        insert = self.resolve(
+            insert[columns], {"name": "mineral_log", "ima_note": "ima_note_list"}, "mineral_ima_note"
+        )
 
         if len(insert) > 0:
             try:
@@ -258,12 +593,12 @@ class Migration(Migrator):
                 self.save_report(
                     retrieved_, table_name="mineral_ima_note", operation="insert"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_ima_note", e))
 
     def sync_mineral_context(self):
 
+        assert self.merge or self.mineral_context is not None
         assert self.minerals is not None
 
         columns = [
@@ -271,37 +606,86 @@ class Migration(Migrator):
             'data',
             'context_id',
         ]
-        # minerals = migrate.minerals.copy()
-        _minerals = self.minerals[['name', 'physical_context', 'optical_context']].copy()
-        _physical_context = _minerals[['name', 'physical_context']].dropna()
-        _physical_context['context_id'] = 1
-        _physical_context.rename(columns={'physical_context': 'data'}, inplace=True)
-        _optical_context = _minerals[['name', 'optical_context']].dropna()
-        _optical_context['context_id'] = 2
-        _optical_context.rename(columns={'optical_context': 'data'}, inplace=True)
-        insert = pd.concat([_physical_context, _optical_context], axis=0)
-        insert['data'] = insert['data'].apply(lambda x: {k: v if not isinstance(v, float) or not np.isnan(v) else None for k, v in x.items()})
-        insert = insert[columns]
+        _contexts = prepare_mineral_context(self.minerals[['name', 'physical_context', 'optical_context']])
+
+        if self.merge:
+            # every mineral and context is staged, a null data deletes the stored context
+            _keys = pd.DataFrame(
+                {
+                    'name': np.repeat(self.minerals['name'].to_numpy(), 2),
+                    'context_id': np.tile([1, 2], len(self.minerals)),
+                }
+            )
+            _contexts = _keys.merge(_contexts.drop_duplicates(['name', 'context_id']), how='left')
+            _contexts['data'] = _contexts['data'].map(lambda x: json.dumps(x) if isinstance(x, dict) else None)
+            self.merge_query(
+                _contexts[columns],
+                merge_mineral_context if self.incremental else merge_mineral_context_delete,
+                "mineral_context",
+            )
+            return
+
+        insert, update, delete = diff_frames(
+            _contexts,
+            self.mineral_context,
+            keys=['name', 'context_id'],
+            values=['data_hash'],
+        )
+        if self.incremental:
+            # the contexts of the minerals which did not change are kept
+            delete = delete.loc[delete['name'].isin(self.minerals['name'])]
+
+        # Insert
+        insert = self.resolve(
+            insert[columns], {"name": "mineral_log", "context_id": "data_context_list"}, "mineral_context"
+        )
 
         if len(insert) > 0:
-            _conn = self.pool.getconn()
-            with _conn.cursor() as cursor:
-                cursor.execute("TRUNCATE TABLE mineral_context RESTART IDENTITY")
-                _conn.commit()
-                cursor.close()
-            self.pool.putconn(_conn)
             try:
                 retrieved_ = self.execute_query(insert, insert_mineral_context)
                 self.save_report(
                     retrieved_, table_name="mineral_context", operation="insert"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_context", e))
+
+        # Update
+        update = update[['id', 'data']]
+
+        if len(update) > 0:
+            try:
+                retrieved_ = self.execute_query(update, update_mineral_context)
+                self.save_report(
+                    retrieved_, table_name="mineral_context", operation="update"
+                )
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_context", e))
+
+        # Delete
+        delete = delete[['id']]
+
+        if len(delete) > 0:
+            try:
+                retrieved_ = self.execute_query(delete, delete_mineral_context)
+                self.save_report(
+                    retrieved_, table_name="mineral_context", operation="delete"
+                )
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_context", e))
+
+    def _update_mineral_lookups(self, rows):
+        """
+        :param rows: (id, name, description, mindat_id, ...) rows returned by the mineral_log writes
+        """
+        rows = [_row for _row in rows if _row[1] is not None]
+        self.update_lookup("mineral_log", [_row[1] for _row in rows], [_row[0] for _row in rows])
+        self.update_lookup("mineral_log_upper", [_row[1].upper() for _row in rows], [_row[0] for _row in rows])
+        rows = [_row for _row in rows if pd.notna(_row[3])]
+        self.update_lookup("mineral_log_mindat", [_row[3] for _row in rows], [_row[0] for _row in rows])
 
     def sync_mineral_log(self):
 
-        assert self.mineral_log is not None
+        assert self.merge or self.mineral_log is not None
         assert self.minerals is not None
 
         columns_ = [
@@ -311,81 +695,57 @@ class Migration(Migrator):
             "ima_symbol",
         ]
 
-        outer_join = self.mineral_log.merge(
-            self.minerals[columns_], how="outer", on="name", indicator=True
+        _minerals = self.minerals[columns_].copy()
+        _minerals["row_hash"] = row_hash(_minerals, ["description", "mindat_id", "ima_symbol"])
+
+        if self.merge:
+            self.merge_query(_minerals, merge_mineral_log, "mineral_log")
+            return
+
+        insert, update, _ = diff_frames(
+            _minerals,
+            self.mineral_log,
+            keys=["name"],
+            values=["row_hash"],
         )
 
         # Insert
-        insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
-        insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
-        insert.rename(
-            columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True
-        )
         insert = insert.drop_duplicates("name")
-        insert = insert[columns_]
+        insert = insert[columns_ + ["row_hash"]]
 
         if len(insert) > 0:
             try:
-                self.execute_query(insert, insert_mineral_log)
+                retrieved_ = self.execute_query(insert, insert_mineral_log)
                 self.save_report(insert, table_name="mineral_log", operation="insert")
-            except Exception:
-                # TODO: save log?
-                pass
+                if self.dry_run:
+                    # the would-be names match, without an id
+                    retrieved_ = [(None, _row.name, None, _row.mindat_id) for _row in insert.itertuples()]
+                self._update_mineral_lookups(retrieved_)
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_log", e))
 
         # Update
-        update = outer_join[(outer_join._merge == "both")].drop("_merge", axis=1)
-        update = update.drop_duplicates("name")
-
-        old_ = update[
-            [
-                "id",
-                "description_x",
-                "mindat_id_x",
-                "ima_symbol_x",
-            ]
-        ]
-        new_ = update[
-            [
-                "id",
-                "description_y",
-                "mindat_id_y",
-                "ima_symbol_y",
-            ]
-        ]
-
-        old_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True)
-        new_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True)
-
-        diff = old_.compare(new_, keep_shape=False).dropna(how="all", axis=1)
-
-        if len(diff) > 0:
-            update_ = update.loc[diff.index]
-            update_.rename(
-                columns={
-                    "description_y": "description",
-                    "mindat_id_y": "mindat_id",
-                    "ima_symbol_y": "ima_symbol",
-                },
-                inplace=True,
-            )
-            update_ = update_[["id", "description", "mindat_id", "ima_symbol"]]
+        if len(update) > 0:
+            update_ = update[["id", "description", "mindat_id", "ima_symbol", "row_hash"]]
             try:
                 retrieved_ = self.execute_query(update_, update_mineral_log)
+                if not self.dry_run:
+                    self._update_mineral_lookups(retrieved_)
                 self.save_report(
                     retrieved_, table_name="mineral_log", operation="update"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_log", e))
 
     def sync_mineral_crystallography(self):
 
-        assert self.mineral_crystallography is not None
+        assert self.merge or self.mineral_crystallography is not None
         assert self.minerals is not None
 
         columns_ = [
             "name",
             "crystal_system",
+            "row_hash",
         ]
         minerals_ = self.minerals[['mindat_id', 'name', 'crystal_system']].dropna(
             how="all",
@@ -393,24 +753,28 @@ class Migration(Migrator):
                 "crystal_system",
             ],
         )
+        minerals_["row_hash"] = row_hash(minerals_, ["crystal_system"])
 
-        outer_join = self.mineral_crystallography.merge(
-            minerals_, how="outer", on="name", indicator=True
+        if self.merge:
+            self.merge_query(minerals_[columns_], merge_mineral_crystallography, "mineral_crystallography")
+            return
+
+        insert, update, _ = diff_frames(
+            minerals_, self.mineral_crystallography, keys=["name"], values=["row_hash"]
         )
 
         # Insert
-        insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
-        insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
-        insert.rename(
-            columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True
-        )
         insert = insert.drop_duplicates(
             [
                 "name",
                 "crystal_system",
             ]
         )
-        insert = insert[columns_]
+        insert = self.resolve(
+            insert[columns_],
+            {"name": "mineral_log", "crystal_system": "crystal_system_list"},
+            "mineral_crystallography",
+        )
 
         if len(insert) > 0:
             try:
@@ -418,43 +782,16 @@ class Migration(Migrator):
                 self.save_report(
                     retrieved_, table_name="mineral_crystallography", operation="insert"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_crystallography", e))
 
         # Update
-        update = outer_join[(outer_join._merge == "both")].drop("_merge", axis=1)
-        old_ = update[
-            [
-                "name",
-                "crystal_system_x",
-            ]
-        ]
-        new_ = update[
-            [
-                "name",
-                "crystal_system_y",
-            ]
-        ]
-        old_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True)
-        new_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True)
-
-        diff = old_.compare(new_, keep_shape=False).dropna(how="all", axis=1)
-
-        if len(diff) > 0:
-            update_ = update.loc[diff.index]
-            update_.rename(
-                columns={
-                    "crystal_system_y": "crystal_system",
-                },
-                inplace=True,
+        if len(update) > 0:
+            update_ = self.resolve(
+                update[columns_],
+                {"name": "mineral_log", "crystal_system": "crystal_system_list"},
+                "mineral_crystallography",
             )
-            update_ = update_[
-                [
-                    "name",
-                    "crystal_system",
-                ]
-            ]
             try:
                 retrieved_ = self.execute_query(
                     update_, update_mineral_crystallography
@@ -464,14 +801,12 @@ class Migration(Migrator):
                     table_name="mineral_crystallography",
                     operation="update",
                 )
-            except Exception:
-                # TODO: save log?
-                pass
-
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_crystallography", e))
 
     def sync_mineral_formula(self):
 
-        assert self.mineral_formula is not None
+        assert self.merge or self.mineral_formula is not None
         assert self.minerals is not None
 
         columns_ = [
@@ -479,12 +814,19 @@ class Migration(Migrator):
             "formula",
             "note",
             "source_id",
+            "row_hash",
         ]
         minerals_ = prepare_minerals_formula(
             self.minerals[["mindat_id", "name", "formula", "imaformula", "note"]]
         )
+        minerals_["row_hash"] = row_hash(minerals_, ["formula", "note", "source_id"])
+
+        if self.merge:
+            minerals_ = minerals_.dropna(how="all", subset=["formula", "note"])
+            self.merge_query(minerals_[columns_], merge_mineral_formula, "mineral_formula")
+            return
 
-        outer_join = self.mineral_formula.merge(
+        insert, _, _ = diff_frames(
             minerals_.dropna(
                 how="all",
                 subset=[
@@ -492,24 +834,18 @@ class Migration(Migrator):
                     "note",
                 ],
             ),
-            how="outer",
-            on="name",
-            indicator=True,
+            self.mineral_formula,
+            keys=["name"],
         )
 
         # Insert
-        insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
-        insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
-        insert.rename(
-            columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True
-        )
         insert = insert.drop_duplicates(
             [
                 "name",
                 "source_id",
             ]
         )
-        insert = insert[columns_]
+        insert = self.resolve(insert[columns_], {"name": "mineral_log"}, "mineral_formula")
         insert['type_id'] = 1
         insert['reference'] = insert.apply(lambda row: [], axis=1)
 
@@ -519,45 +855,36 @@ class Migration(Migrator):
                 self.save_report(
                     retrieved_, table_name="mineral_formula", operation="insert"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_formula", e))
 
     def sync_mineral_status(self):
 
-        assert self.mineral_status is not None
+        assert self.merge or self.mineral_status is not None
         assert self.minerals is not None
 
         _columns = [
             "name",
             "status_id",
-            "direct_relation",
+            "direct_status",
         ]
         _minerals = prepare_minerals_relation_status(
             self.minerals[["name", "variety_of", "synonym_of", "polytype_of"]]
         )
 
-        outer_join = self.mineral_status.merge(
-            _minerals[['name', 'status_id', 'direct_status']],
-            how="outer",
-            on=["name", "status_id", "direct_status"],
-            indicator=True,
+        if self.merge:
+            self.merge_query(_minerals[_columns], merge_mineral_status, "mineral_status")
+            return
+
+        insert, _, _ = diff_frames(
+            _minerals[_columns], self.mineral_status, keys=_columns
         )
 
         # Insert
-        insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
-        insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
-        insert.rename(
-            columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True
-        )
-        insert = insert.drop_duplicates(
-            [
-                "name",
-                "status_id",
-                "direct_status",
-            ]
+        insert = insert.drop_duplicates(_columns)
+        insert = self.resolve(
+            insert[_columns], {"name": "mineral_log", "status_id": "status_list"}, "mineral_status"
         )
-        insert = insert[['name', 'status_id', 'direct_status']]
 
         if len(insert) > 0:
             try:
@@ -565,47 +892,49 @@ class Migration(Migrator):
                 self.save_report(
                     retrieved_, table_name="mineral_status", operation="insert"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+                if self.relation_graph is not None and not self.dry_run:
+                    self.relation_graph.add_statuses(
+                        pd.DataFrame(
+                            [_row[1:] for _row in retrieved_],
+                            columns=["mineral_id", "id", "status_id", "needs_revision", "direct_status",
+                                     "status_group_id"],
+                        )
+                    )
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_status", e))
 
     def sync_mineral_relation(self):
 
-        assert self.mineral_relation is not None
+        assert self.merge or self.mineral_relation is not None
         assert self.minerals is not None
 
         _columns = [
             "name",
             "status_id",
             "relation",
-            "direct_relation",
+            "direct_status",
         ]
         _minerals = prepare_minerals_relation_status(
             self.minerals[["name", "variety_of", "synonym_of", "polytype_of"]]
         )
 
-        outer_join = self.mineral_relation.merge(
-            _minerals,
-            how="outer",
-            on=["name", "status_id", "relation"],
-            indicator=True,
+        if self.merge:
+            self.merge_query(_minerals[_columns], merge_mineral_relation, "mineral_relation")
+            return
+
+        insert, _, _ = diff_frames(
+            _minerals[_columns],
+            self.mineral_relation,
+            keys=["name", "status_id", "relation"],
         )
 
         # Insert
-        insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
-        insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
-        insert.rename(
-            columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True
-        )
-        insert = insert.drop_duplicates(
-            [
-                "name",
-                "status_id",
-                "relation",
-                "direct_status",
-            ]
+        insert = insert.drop_duplicates(_columns)
+        insert = self.resolve(
+            insert[_columns],
+            {"name": "mineral_log", "status_id": "status_list", "relation": "mineral_log"},
+            "mineral_relation",
         )
-        insert = insert[['name', 'status_id', "relation", 'direct_status']]
 
         if len(insert) > 0:
             try:
@@ -613,13 +942,19 @@ class Migration(Migrator):
                 self.save_report(
                     retrieved_, table_name="mineral_relation", operation="insert"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+                if self.relation_graph is not None and not self.dry_run:
+                    self.relation_graph.add_relations(
+                        pd.DataFrame(
+                            [_row[4:] for _row in retrieved_],
+                            columns=["mineral_id", "relation_id", "direct_status", "status_group_id"],
+                        )
+                    )
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_relation", e))
 
     def sync_mineral_relation_suggestion(self):
 
-        assert self.mineral_relation_suggestion is not None
+        assert self.merge or self.mineral_relation_suggestion is not None
         assert self.relations is not None
 
         columns_ = [
@@ -629,22 +964,33 @@ class Migration(Migrator):
             "relation_type_id",
         ]
 
-        outer_join = self.mineral_relation_suggestion.merge(
+        if self.merge:
+            self.merge_query(
+                self.relations[columns_].dropna(how="all"),
+                (
+                    merge_mineral_relation_suggestion if self.relations_partial
+                    else merge_mineral_relation_suggestion_delete
+                ),
+                "mineral_relation_suggestion",
+            )
+            return
+
+        insert, update, delete = diff_frames(
             self.relations[columns_].dropna(
                 how="all",
             ),
-            how="outer",
-            on="id",
-            indicator=True,
+            self.mineral_relation_suggestion,
+            keys=["id"],
+            values=["mineral_id", "relation_id", "relation_type_id"],
+            partial=self.relations_partial,
         )
 
         # Insert
-        insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
-        insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
-        insert.rename(
-            columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True
+        insert = self.resolve(
+            insert[columns_],
+            {"mineral_id": "mineral_log_mindat", "relation_id": "mineral_log_mindat"},
+            "mineral_relation_suggestion",
         )
-        insert = insert[columns_]
 
         if len(insert) > 0:
             try:
@@ -657,54 +1003,16 @@ class Migration(Migrator):
                         table_name="mineral_relation_suggestion",
                         operation="insert",
                     )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_relation_suggestion", e))
 
         # Update
-        update = outer_join[(outer_join._merge == "both")].drop("_merge", axis=1)
-
-        old_ = update[
-            [
-                "id",
-                "mineral_id_x",
-                "relation_id_x",
-                "relation_type_id_x",
-            ]
-        ]
-        new_ = update[
-            [
-                "id",
-                "mineral_id_y",
-                "relation_id_y",
-                "relation_type_id_y",
-            ]
-        ]
-
-        old_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True)
-        new_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True)
-
-        diff = old_.compare(new_, keep_shape=False).dropna(how="all", axis=1)
-
-        if len(diff) > 0:
-            update_ = update.loc[diff.index]
-            update_.rename(
-                columns={
-                    "id_y": "id",
-                    "mineral_id_y": "mineral_id",
-                    "relation_id_y": "relation_id",
-                    "relation_type_id_y": "relation_type_id",
-                },
-                inplace=True,
+        if len(update) > 0:
+            update_ = self.resolve(
+                update[columns_],
+                {"mineral_id": "mineral_log_mindat", "relation_id": "mineral_log_mindat"},
+                "mineral_relation_suggestion",
             )
-            update_ = update_[
-                [
-                    "id",
-                    "mineral_id",
-                    "relation_id",
-                    "relation_type_id",
-                ]
-            ]
             try:
                 retrieved_ = self.execute_query(
                     update_, update_mineral_relation_suggestion
@@ -714,13 +1022,11 @@ class Migration(Migrator):
                     table_name="mineral_relation_suggestion",
                     operation="update",
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_relation_suggestion", e))
 
         # Delete
-        delete = outer_join[(outer_join._merge == "left_only")].drop("_merge", axis=1)
-        delete = delete[["id", "mineral_id_x"]]
+        delete = delete[["id", "mineral_id"]]
 
         if len(delete) > 0:
             try:
@@ -732,13 +1038,12 @@ class Migration(Migrator):
                     table_name="mineral_relation_suggestion",
                     operation="delete",
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_relation_suggestion", e))
 
     def sync_mineral_history(self):
 
-        assert self.mineral_history is not None
+        assert self.merge or self.mineral_history is not None
         assert self.minerals is not None
 
         columns_ = [
@@ -749,29 +1054,33 @@ class Migration(Migrator):
             "publication_year",
         ]
 
-        outer_join = self.mineral_history.merge(
-            self.minerals[columns_].dropna(
-                how="all",
-                subset=[
-                    "discovery_year",
-                    "ima_year",
-                    "approval_year",
-                    "publication_year",
-                ],
-            ),
-            how="outer",
-            on="name",
-            indicator=True,
+        _minerals = self.minerals[columns_].dropna(
+            how="all",
+            subset=[
+                "discovery_year",
+                "ima_year",
+                "approval_year",
+                "publication_year",
+            ],
+        )
+        _minerals["row_hash"] = row_hash(
+            _minerals, ["discovery_year", "ima_year", "approval_year", "publication_year"]
         )
 
-        # Insert
-        insert = outer_join[(outer_join._merge == "right_only")].drop("_merge", axis=1)
-        insert.drop(insert.filter(regex="_x$").columns, axis=1, inplace=True)
-        insert.rename(
-            columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True
+        if self.merge:
+            self.merge_query(_minerals, merge_mineral_history, "mineral_history")
+            return
+
+        insert, update, _ = diff_frames(
+            _minerals,
+            self.mineral_history,
+            keys=["name"],
+            values=["row_hash"],
         )
+
+        # Insert
         insert = insert.drop_duplicates("name")
-        insert = insert[columns_]
+        insert = self.resolve(insert[columns_ + ["row_hash"]], {"name": "mineral_log"}, "mineral_history")
 
         if len(insert) > 0:
             try:
@@ -779,56 +1088,19 @@ class Migration(Migrator):
                 self.save_report(
                     retrieved_, table_name="mineral_history", operation="insert"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_history", e))
 
         # Update
-        update = outer_join[(outer_join._merge == "both")].drop("_merge", axis=1)
-        update = update.drop_duplicates("name")
-
-        old_ = update[
-            [
-                "id",
-                "discovery_year_x",
-                "ima_year_x",
-                "approval_year_x",
-                "publication_year_x",
-            ]
-        ]
-        new_ = update[
-            [
-                "id",
-                "discovery_year_y",
-                "ima_year_y",
-                "approval_year_y",
-                "publication_year_y",
-            ]
-        ]
-
-        old_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True)
-        new_.rename(columns=lambda column_: re.sub("_[xy]$", "", column_), inplace=True)
-
-        diff = old_.compare(new_, keep_shape=False).dropna(how="all", axis=1)
-
-        if len(diff) > 0:
-            update_ = update.loc[diff.index]
-            update_.rename(
-                columns={
-                    "discovery_year_y": "discovery_year",
-                    "ima_year_y": "ima_year",
-                    "approval_year_y": "approval_year",
-                    "publication_year_y": "publication_year",
-                },
-                inplace=True,
-            )
-            update_ = update_[
+        if len(update) > 0:
+            update_ = update[
                 [
                     "id",
                     "discovery_year",
                     "ima_year",
                     "approval_year",
                     "publication_year",
+                    "row_hash",
                 ]
             ]
             try:
@@ -836,25 +1108,27 @@ class Migration(Migrator):
                 self.save_report(
                     retrieved_, table_name="mineral_history", operation="update"
                 )
-            except Exception:
-                # TODO: save log?
-                pass
-
+            except Exception as e:
+                self.fail("An error occurred when running %s: %s" % ("sync_mineral_history", e))
 
     def sync_rruff_cod(self):
         _cod = self.cod
         _alternative_names = self.get_alternative_names()
         # alternative_names = migrate.get_alternative_names()
-        insert = prepare_mineral_structure(_cod, _alternative_names)
+        if self.cod_prepared is not None:
+            insert = prepare_mineral_structure(self.cod_prepared, _alternative_names, cod_prepared=True)
+        else:
+            insert = prepare_mineral_structure(_cod, _alternative_names)
 
         try:
-            retrieved_ = self.execute_query(insert, insert_mineral_structure)
+            retrieved_ = self.copy_query(
+                insert, insert_mineral_structure, chunk_size=10000, checkpoint="mineral_structure"
+            )
             self.save_report(
                 retrieved_, table_name="mineral_structure", operation="insert"
             )
-        except Exception:
-            # TODO: save log?
-            pass
+        except Exception as e:
+            self.fail("An error occurred when running %s: %s" % ("sync_rruff_cod", e))
 
 # migrate = Migration()
 # migrate.connect_db()
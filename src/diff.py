@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+import hashlib
+import json
+from collections import namedtuple
+from decimal import Decimal
+from json.encoder import encode_basestring as _encode_string
+
+import numpy as np
+import pandas as pd
+
+from src.metrics import traced
+
+
+Diff = namedtuple("Diff", ["insert", "update", "delete"])
+
+_NULL = "\x00"
+
+
+def _as_numeric(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype("float64").to_numpy()
+    _valid = series.dropna()
+    if len(_valid) and isinstance(_valid.iloc[0], str):
+        return None
+    try:
+        _numeric = pd.to_numeric(series, errors="coerce")
+    except TypeError:
+        return None
+    if _numeric.isna().sum() == series.isna().sum():
+        return _numeric.astype("float64").to_numpy()
+    return None
+
+
+def _normalize(source, target, columns):
+    """
+    Bring the same columns of both frames to a common representation so that equal values
+    produce equal hashes, e.g. int64 1 in the target and float64 1.0 in the source.
+    """
+    _source = {}
+    _target = {}
+    for _column in columns:
+        _s = source[_column]
+        _t = target[_column]
+        _s_numeric = _as_numeric(_s)
+        _t_numeric = _as_numeric(_t)
+        if _s_numeric is not None and _t_numeric is not None:
+            _source[_column] = _s_numeric
+            _target[_column] = _t_numeric
+        else:
+            _source[_column] = _s.astype(object).fillna(_NULL).to_numpy()
+            _target[_column] = _t.astype(object).fillna(_NULL).to_numpy()
+
+    return pd.DataFrame(_source, copy=False), pd.DataFrame(_target, copy=False)
+
+
+def _jsonb_text(value):
+    """
+    Render a JSON value the way Postgres prints jsonb: object keys ordered by their length in
+    bytes and then bytewise, ", " and ": " separators, non-ASCII characters unescaped and numbers
+    without exponents
+    """
+    if isinstance(value, str):
+        return _encode_string(value)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, bool):
+        return json.dumps(value)
+    if isinstance(value, dict):
+        _items = sorted((_key.encode("utf-8"), _key, _value) for _key, _value in value.items())
+        _items.sort(key=lambda _: len(_[0]))
+        return "{%s}" % ", ".join(
+            f"{_encode_string(_key)}: {_jsonb_text(_value)}" for _, _key, _value in _items
+        )
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_jsonb_text(_value) for _value in value) + "]"
+    if isinstance(value, float) and "e" in repr(value):
+        return format(Decimal(repr(value)), "f")
+    return json.dumps(value, ensure_ascii=False)
+
+
+def jsonb_hash(value):
+    """
+    md5 of a value as Postgres prints it as jsonb, equal to md5(column::text) for the same data
+    """
+    return hashlib.md5(_jsonb_text(value).encode("utf-8")).hexdigest()
+
+
+def _hash_text(series):
+    """
+    Text of a column for row_hash: nulls as \\N and integral floats as integers, so that a column
+    read with missing values hashes as its integer counterpart
+    """
+    _numeric = _as_numeric(series)
+    if _numeric is not None:
+        _integral = np.isfinite(_numeric) & (np.mod(_numeric, 1) == 0)
+        _text = np.where(_integral, np.where(_integral, _numeric, 0).astype("int64").astype(str), _numeric.astype(str))
+    else:
+        _text = series.astype(str).to_numpy()
+    return np.where(series.isna().to_numpy(), "\\N", _text)
+
+
+def row_hash(frame, columns):
+    """
+    md5 of the values of each row, stored with the row in the row_hash column of a target table so
+    that the next run compares a single column instead of fetching the values
+    :param columns: the synced columns, in a fixed order
+    :return: pandas.Series of hex digests, aligned with frame
+    """
+    _text = pd.Series("", index=frame.index, dtype=object)
+    for _index, _column in enumerate(columns):
+        _text = _text + ("\x1f" if _index else "") + _hash_text(frame[_column])
+    return _text.map(lambda _: hashlib.md5(_.encode("utf-8")).hexdigest())
+
+
+def _fingerprint(frame):
+    if not len(frame.columns):
+        return np.zeros(len(frame), dtype="uint64")
+    return pd.util.hash_pandas_object(frame, index=False, categorize=False).to_numpy()
+
+
+@traced()
+def diff_frames(source, target, keys, values=None, partial=False):
+    """
+    Compare source and target frames in a single pass using per-row fingerprints.
+
+    :param source: pandas.DataFrame with the new state of the data
+    :param target: pandas.DataFrame with the current state of the database table
+    :param keys: columns identifying a row in both frames
+    :param values: columns compared for rows present in both frames
+    :param partial: the source holds only the rows changed since the last run, so rows missing
+        from it are not deleted
+    :return: Diff with
+        insert - source rows whose key is missing in the target,
+        update - source rows whose values differ from the target, extended with the remaining
+                 target columns (e.g. id), one row per key,
+        delete - target rows whose key is missing in the source
+    """
+    values = values or []
+
+    _source_keys, _target_keys = _normalize(source, target, keys)
+    _source_keys = _fingerprint(_source_keys)
+    _target_keys = _fingerprint(_target_keys)
+
+    _in_target = pd.Index(_source_keys).isin(_target_keys)
+    _in_source = pd.Index(_target_keys).isin(_source_keys)
+
+    insert = source.loc[~_in_target]
+    delete = target.loc[~_in_source] if not partial else target.iloc[0:0]
+
+    if not values:
+        return Diff(insert, source.iloc[0:0], delete)
+
+    _source_values, _target_values = _normalize(source, target, values)
+    _source_values = _fingerprint(_source_values)
+    _target_values = _fingerprint(_target_values)
+
+    _first_source = ~pd.Index(_source_keys).duplicated()
+    _first_target = ~pd.Index(_target_keys).duplicated()
+    _target_map = pd.Series(_target_values[_first_target], index=_target_keys[_first_target])
+
+    _both = _in_target & _first_source
+    _changed = _target_map.reindex(_source_keys[_both]).to_numpy() != _source_values[_both]
+    _mask = np.zeros(len(source), dtype=bool)
+    _mask[np.flatnonzero(_both)[_changed]] = True
+
+    update = source.loc[_mask]
+    _extra = [column for column in target.columns if column not in update.columns]
+    if _extra and len(update):
+        _target_rows = target.loc[_first_target, keys + _extra]
+        _positions = pd.Index(_target_keys[_first_target]).get_indexer(_source_keys[_mask])
+        _target_rows = _target_rows.iloc[_positions][_extra].set_index(update.index)
+        update = pd.concat([update, _target_rows], axis=1)
+    elif _extra:
+        update = update.reindex(columns=list(update.columns) + _extra)
+
+    return Diff(insert, update, delete)
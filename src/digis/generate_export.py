@@ -4,6 +4,7 @@ import time
 
 import polars as pl
 from src.constants import TECTONIC_SETTING_CHOICES, ALTERATION_CHOICES, PRIMARY_SECONDARY_CHOICES, GEOROC_REPLACEMENTS
+from src.metrics import PROMETHEUS_PATH, save_prometheus, save_summary, span, traced
 
 
 PATH = 'data/georoc/'
@@ -52,6 +53,7 @@ def _get_files(path, format='csv'):
     return _files
 
 
+@traced('idealize')
 def _idealize(data):
     """
     Idealize the data by assigning IDs to rows and cleaning up the data
@@ -76,6 +78,7 @@ def _idealize(data):
     return _data
 
 
+@traced('get_data')
 def _get_data(filename):
     # filename = 'data/georoc/Clinopyroxenes Dec 2024.csv'
     _data = pl.scan_csv(filename, ignore_errors=True, encoding='utf8-lossy', null_values=['', ' ']).with_row_index()
@@ -130,6 +133,7 @@ def _get_data(filename):
 
 
 
+@traced('clean_data')
 def _clean_data(data):
     _titlecase_cols = ['ALTERATION', 'PRIMARY/SECONDARY', 'TECTONIC SETTING']
     _uppercase_cols = ['MINERAL', 'ROCK NAME']
@@ -154,6 +158,7 @@ def _clean_data(data):
 
 
 
+@traced('check_validity')
 def _check_validity(data):
     _invalid_ids = data.filter(
         pl.col('ID').is_null()
@@ -226,6 +231,7 @@ def _convert_colnames(data):
     return data.select(pl.all().name.map(lambda x: _map[x] if x in _map else x))
 
 
+@traced('replace_enums')
 def _replace_enums(df):
     """
     Replace string values with their corresponding enum integers using pattern matching.
@@ -258,6 +264,7 @@ def _replace_enums(df):
     return df
 
 
+@traced('convert_types')
 def _convert_types(df):
     types_mapping = {
         'is_primary': pl.Boolean,
@@ -297,7 +304,9 @@ def main():
         sys.exit(1)
 
     uri = f'postgresql://{os.getenv("POSTGRES_USER")}:{os.getenv("POSTGRES_PASSWORD")}@{os.getenv("POSTGRES_HOST")}:{os.getenv("POSTGRES_PORT")}/{os.getenv("POSTGRES_DB")}'
-    mineral_log = pl.read_database_uri('SELECT UPPER(name) AS name FROM mineral_log;', uri=uri)
+    with span('fetch:mineral_log') as _span:
+        mineral_log = pl.read_database_uri('SELECT UPPER(name) AS name FROM mineral_log;', uri=uri)
+        _span.rows_out = len(mineral_log)
 
     MINERAL_CHOICES = (data.filter(
         pl.col('MINERAL').is_not_null(),
@@ -328,7 +337,12 @@ def main():
     data = _convert_types(data)
 
     _filename = f'data/generated/georoc_{time.strftime("%Y%m%d_%H%M%S")}.csv'
-    data.write_csv(_filename)
+    with span('write', rows_in=len(data)) as _span:
+        data.write_csv(_filename)
+        _span.bytes = os.path.getsize(_filename)
+
+    save_summary()
+    save_prometheus(os.path.join(os.path.dirname(PROMETHEUS_PATH), 'digis_export.prom'))
 
 
 if __name__ == '__main__':
@@ -8,6 +8,7 @@ from dotenv import load_dotenv
 from src.constants import TECTONIC_SETTING_CHOICES, ALTERATION_CHOICES, PRIMARY_SECONDARY_CHOICES
 from src.queries import get_chem_measurement, insert_chem_measurement
 from src.base import Migrator
+from src.metrics import PROMETHEUS_PATH, save_prometheus, save_summary, span
 
 
 PATH = 'data/generated/'
@@ -23,12 +24,21 @@ def _get_most_recent_version():
 
 
 def _insert_chem_measurement(data, db):
-    _insert = data.select([
+    # mineral names are upper case, unmatched names are inserted without a mineral
+    _mineral_ids = db.lookups['mineral_log_upper'].to_dict()
+    _unmatched = data.filter(pl.col('mineral').is_not_null() & ~pl.col('mineral').is_in(list(_mineral_ids)))
+    if len(_unmatched):
+        print(f'{len(_unmatched)} rows of chem_measurement have no match in mineral_log')
+        db.save_report(_unmatched, table_name='chem_measurement', operation='unmatched')
+
+    _insert = data.with_columns(
+        pl.col('mineral').replace_strict(_mineral_ids, default=None, return_dtype=pl.Utf8)
+    ).select([
         'external_key', 'mineral', 'mineral_note', 'sample_name', 'grain_size', 'rock_name', 'rock_texture',
         'alteration', 'is_primary', 'tectonic_setting', 'citation', 'latitude_min', 'latitude_max', 'longitude_min',
         'longitude_max', 'elevation_min', 'elevation_max', 'location', 'location_note'
     ])
-    db.execute_query(_insert, insert_chem_measurement)
+    db.copy_query(_insert, insert_chem_measurement, chunk_size=50000, checkpoint='chem_measurement')
 
 
 
@@ -37,22 +47,33 @@ def main():
 
     db = Migrator()
     db.connect_db()
+    db.load_lookups(['mineral_log_upper'])
 
     file = _get_most_recent_version()
-    data = pl.read_csv(PATH + file, ignore_errors=True, encoding='utf8-lossy', null_values=['', ' '])
+    with span('read:georoc') as _span:
+        data = pl.read_csv(PATH + file, ignore_errors=True, encoding='utf8-lossy', null_values=['', ' '])
+        _span.rows_out = len(data)
+        _span.bytes = os.path.getsize(PATH + file)
 
 
     uri = f'postgresql://{os.getenv("POSTGRES_USER")}:{os.getenv("POSTGRES_PASSWORD")}@{os.getenv("POSTGRES_HOST")}:{os.getenv("POSTGRES_PORT")}/{os.getenv("POSTGRES_DB")}'
-    _old = pl.read_database_uri(get_chem_measurement, uri=uri)
-    _new = data.filter(
-        ~pl.col('external_key').is_in(_old['key'])
-    )
+    with span('fetch:chem_measurement') as _span:
+        _old = pl.read_database_uri(get_chem_measurement, uri=uri)
+        _span.rows_out = len(_old)
+    with span('diff', rows_in=len(data)) as _span:
+        _new = data.filter(
+            ~pl.col('external_key').is_in(_old['key'])
+        )
+        _span.rows_out = len(_new)
 
     if len(_new):
         _insert_chem_measurement(_new, db)
 
     db.disconnect_db()
 
+    save_summary()
+    save_prometheus(os.path.join(os.path.dirname(PROMETHEUS_PATH), 'digis_migration.prom'))
+
 
 
 if __name__ == "__main__":
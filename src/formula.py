@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+import re
+from functools import lru_cache
+
+import pandas as pd
+
+
+_TRANSLATION = str.maketrans({"≤": "<=", "≥": ">="})
+_SUBSCRIPTS = frozenset("1234567890-+xyn@Σ<>=")
+# characters copied as they are outside of the sub/superscripts
+_PLAIN_RUN = re.compile(r"[^&;^#.]+")
+
+# plain notation used by COD and RRUFF, e.g. Fe2+1.94Al0.77(BO3)3
+_PLAIN_SUBSCRIPT = re.compile(r"([A-Za-z\\+\\-\\)\]])([0-9\.Σ=]+(?![+-]))")
+_PLAIN_SUPERSCRIPT = re.compile(r"(?<=[A-Za-z])([0-9]?[+-][0-9]?)")
+
+
+def _map_unique(values, function):
+    """
+    Apply function once per distinct non-null value of a pandas.Series
+    """
+    _unique = values.dropna().unique()
+    # an all-null column stays object, map would return float64
+    return values.map(dict(zip(_unique, map(function, _unique)))).astype(object)
+
+
+# Formula markup from Pavel Martynov https://github.com/Medwar/mindatapi/blob/master/src/apps/api/utils.py
+@lru_cache(maxsize=None)
+def simpleformula(text):
+    """
+    Convert the mindat formula markup, e.g. Ca^2#2+#(CO_3_)@H_2_O, to html in a single pass, the
+    runs of plain characters between the markup are copied at once
+    """
+    text = text.strip()
+    if "<" in text and ">" in text:
+        from django.utils.html import strip_tags
+
+        text = strip_tags(text)
+    text = text.replace("[]", "&#9723;").translate(_TRANSLATION)
+
+    extchr = False
+    big = True
+    anyc = False
+    insup = False
+    last_num = False
+    subs = []
+    sups = []
+    out = []
+
+    i = 0
+    while i < len(text):
+        if big and not insup and not sups and not subs:
+            _run = _PLAIN_RUN.match(text, i)
+            if _run:
+                out.append(_run.group())
+                last_num = text[_run.end() - 1].isnumeric()
+                i = _run.end()
+                continue
+        c = text[i]
+        i += 1
+
+        if c == "&":
+            extchr = True
+        if c == ";":
+            extchr = False
+        if c == "^" and not extchr:
+            last_num = False
+            if big:
+                subs = []
+                big = False
+            anyc = True
+        elif c == "#" and not extchr:
+            insup = not insup
+        elif insup:
+            sups.append(c)
+        else:
+            if not big and (c in _SUBSCRIPTS or anyc):
+                if c == "@":
+                    c = "."
+                subs.append(c)
+                anyc = False
+            elif sups or subs:
+                if sups:
+                    out += ["<sup>", *sups, "</sup>"]
+                if subs:
+                    out += ["<sub>", *subs, "</sub>"]
+                big = True
+                sups = []
+                subs = []
+            if big:
+                if not last_num and c == ".":
+                    c = " &middot; "
+                out.append(c)
+                last_num = c.isnumeric()
+
+    if sups:
+        out += ["<sup>", *sups, "</sup>"]
+    if subs:
+        out += ["<sub>", *subs, "</sub>"]
+
+    return "".join(out)
+
+
+@lru_cache(maxsize=None)
+def plainformula(text):
+    """
+    Convert a plain formula, e.g. Fe2+1.94Al0.77(BO3)3, to html
+    """
+    text = _PLAIN_SUBSCRIPT.sub(r"\1<sub>\2</sub>", text)
+    return _PLAIN_SUPERSCRIPT.sub(r"<sup>\1</sup>", text)
+
+
+def simpleformula_column(formulas: pd.Series) -> pd.Series:
+    return _map_unique(formulas, simpleformula)
+
+
+def plainformula_column(formulas: pd.Series) -> pd.Series:
+    return _map_unique(formulas, plainformula)
@@ -0,0 +1,238 @@
+# -*- coding: UTF-8 -*-
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+
+METRICS_PATH = "db/reports/"
+PROMETHEUS_PATH = os.getenv("DB_SYNC_PROMETHEUS_TEXTFILE", "db/reports/db_sync.prom")
+
+_lock = threading.Lock()
+_local = threading.local()
+_spans = []
+_counters = OrderedDict()
+_started_at = datetime.now()
+
+
+class Span:
+    """
+    A named step of a run. cpu is the CPU time of the thread which ran the span, work done by
+    the thread pools of polars or numpy is not included.
+    """
+
+    __slots__ = ("name", "path", "started_at", "wall", "cpu", "rows_in", "rows_out", "bytes", "error")
+
+    def __init__(self, name, parent=None, rows_in=None):
+        self.name = name
+        self.path = f"{parent.path}/{name}" if parent else name
+        self.started_at = datetime.now()
+        self.wall = None
+        self.cpu = None
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes = None
+        self.error = None
+
+    @property
+    def rows_per_second(self):
+        _rows = self.rows_out if self.rows_out is not None else self.rows_in
+        if not _rows or not self.wall:
+            return None
+        return _rows / self.wall
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "path": self.path,
+            "started_at": self.started_at.isoformat(timespec="milliseconds"),
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rows_per_second": self.rows_per_second,
+            "bytes": self.bytes,
+            "error": self.error,
+        }
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def span(name, rows_in=None):
+    """
+    Record the wall time, the CPU time and the row counts of a block. Spans opened inside the
+    block on the same thread are nested under it.
+    :param rows_in: number of input rows, rows_out and bytes can be set on the yielded Span
+    """
+    _parents = _stack()
+    _span = Span(name, parent=_parents[-1] if _parents else None, rows_in=rows_in)
+    _parents.append(_span)
+    _wall = time.perf_counter()
+    _cpu = time.thread_time()
+    try:
+        yield _span
+    except Exception as e:
+        _span.error = str(e)
+        raise
+    finally:
+        _span.wall = time.perf_counter() - _wall
+        _span.cpu = time.thread_time() - _cpu
+        _parents.pop()
+        with _lock:
+            _spans.append(_span)
+
+
+def add_bytes(count):
+    """
+    Add transferred bytes to the innermost open span of the current thread
+    """
+    _parents = _stack()
+    if _parents:
+        _parents[-1].bytes = (_parents[-1].bytes or 0) + count
+
+
+def count(name, value=1):
+    """
+    Add to a run-wide counter, e.g. cache hits, reported once in the summary and the textfile
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def counters():
+    with _lock:
+        return OrderedDict(_counters)
+
+
+def _rows(value):
+    if hasattr(value, "shape"):
+        return value.shape[0]
+    if isinstance(value, list):
+        return len(value)
+    if isinstance(value, tuple) and value and all(hasattr(_, "shape") for _ in value):
+        return sum(_.shape[0] for _ in value)
+    return None
+
+
+def traced(name=None):
+    """
+    Run the decorated function in a span. The input rows are the rows of all frame arguments,
+    the output rows those of the returned frame or tuple of frames.
+    """
+
+    def decorator(function):
+        _name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            _counts = [_rows(_) for _ in list(args) + list(kwargs.values())]
+            _counts = [_ for _ in _counts if _ is not None]
+            with span(_name, rows_in=sum(_counts) if _counts else None) as _span:
+                result = function(*args, **kwargs)
+                _span.rows_out = _rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def spans():
+    with _lock:
+        return list(_spans)
+
+
+def reset():
+    global _started_at
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+    _started_at = datetime.now()
+
+
+def _totals():
+    """
+    Spans aggregated by path, in the order they were opened
+    """
+    totals = OrderedDict()
+    for _span in sorted(spans(), key=lambda _: _.started_at):
+        _total = totals.setdefault(
+            _span.path,
+            {"count": 0, "errors": 0, "wall": 0.0, "cpu": 0.0, "rows_in": 0, "rows_out": 0, "bytes": 0},
+        )
+        _total["count"] += 1
+        _total["errors"] += _span.error is not None
+        _total["wall"] += _span.wall
+        _total["cpu"] += _span.cpu
+        _total["rows_in"] += _span.rows_in or 0
+        _total["rows_out"] += _span.rows_out or 0
+        _total["bytes"] += _span.bytes or 0
+    return totals
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+
+def save_summary(path=None):
+    """
+    Write the spans of the run, their totals by path and the counters to JSON
+    :return: the path of the summary
+    """
+    path = path or os.path.join(METRICS_PATH, f"run_{_started_at:%Y%m%d_%H%M%S}.json")
+    _summary = {
+        "started_at": _started_at.isoformat(timespec="seconds"),
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+        "totals": _totals(),
+        "counters": counters(),
+        "spans": [_.as_dict() for _ in sorted(spans(), key=lambda _: _.started_at)],
+    }
+    _write(path, json.dumps(_summary, indent=2))
+    return path
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def save_prometheus(path=PROMETHEUS_PATH):
+    """
+    Write the totals by span path in the Prometheus textfile format, for the node_exporter
+    textfile collector
+    """
+    _metrics = [
+        ("wall_seconds", "wall", "Wall time of the span"),
+        ("cpu_seconds", "cpu", "CPU time of the thread which ran the span"),
+        ("rows_in", "rows_in", "Input rows of the span"),
+        ("rows_out", "rows_out", "Output rows of the span"),
+        ("bytes", "bytes", "Bytes transferred within the span"),
+        ("count", "count", "Number of times the span ran"),
+        ("errors", "errors", "Number of times the span failed"),
+    ]
+    totals = _totals()
+    lines = []
+    for _metric, _key, _help in _metrics:
+        lines.append(f"# HELP db_sync_span_{_metric} {_help}")
+        lines.append(f"# TYPE db_sync_span_{_metric} gauge")
+        for _path, _total in totals.items():
+            lines.append(f'db_sync_span_{_metric}{{span="{_label(_path)}"}} {_total[_key]}')
+    for _name, _value in counters().items():
+        lines.append(f"# TYPE db_sync_{_name} gauge")
+        lines.append(f"db_sync_{_name} {_value}")
+    lines.append("# HELP db_sync_last_run_timestamp_seconds Time the last run finished")
+    lines.append("# TYPE db_sync_last_run_timestamp_seconds gauge")
+    lines.append(f"db_sync_last_run_timestamp_seconds {time.time():.0f}")
+    _write(path, "\n".join(lines) + "\n")
+    return path
@@ -1,13 +1,42 @@
 # -*- coding: UTF-8 -*-
+import hashlib
+import json
 import re
+import sqlite3
+import threading
 from collections import defaultdict
+from importlib import metadata
 
-import pandas as pd
-import spacy
-
+from src import metrics
 from src.constants import BASE_COLORS_MAP
 
-nlp = spacy.load("en_colorExtractor")
+MODEL = "en_colorExtractor"
+
+CACHE_PATH = "data/generated/colors.sqlite"
+
+_nlp = None
+_nlp_lock = threading.Lock()
+
+
+def get_nlp():
+    """
+    Load the spaCy model on first use, importing src.ner alone does not load it
+    """
+    global _nlp
+    with _nlp_lock:
+        if _nlp is None:
+            import spacy
+
+            _nlp = spacy.load(MODEL)
+    return _nlp
+
+
+def warm_up():
+    """
+    Load the model ahead of time, e.g. before timing a run or forking nlp.pipe workers
+    """
+    get_nlp()
+
 # Convert csv into txt
 # train = pd.read_csv('ml/assets/color_train.csv', names=['text'])
 # train['text'] = train['text'].str.strip()
@@ -21,17 +50,21 @@ nlp = spacy.load("en_colorExtractor")
 # test = test['text']
 # test.to_csv('ml/assets/color_dev.txt', sep='\t', index=False, header=False)
 #
-def recognize_colors(notes):
-    BASE_COLORS_REGEX = '|'.join([f'(?P<{color}>{_}\w*)' for color, _ in BASE_COLORS_MAP])
-    colors = defaultdict(list)
 
+BASE_COLORS_REGEX = re.compile('|'.join([rf'(?P<{color}>{_}\w*)' for color, _ in BASE_COLORS_MAP]))
+
+
+def _normalize_notes(notes):
     # notes = 'colorless, colourless, Brown to brownish-red, rose-red, or yellow, grey-brown, and also pale to dark green, pale green and also greenish'
     notes = notes.lower()
     notes = re.split(r'[;.]', notes)
     notes = [t.strip() for t in notes if t.strip()]
     notes = [re.sub(r'\s+', ' ', t) for t in notes if t.strip()]
-    notes = ', '.join(notes)
-    doc = nlp(notes)
+    return ', '.join(notes)
+
+
+def _extract_colors(doc):
+    colors = defaultdict(list)
 
     for entity in doc.ents:
         text = entity.text
@@ -39,7 +72,7 @@ def recognize_colors(notes):
         _color = None
 
         for _entity in _entities[::-1]:
-            match = re.match(BASE_COLORS_REGEX, _entity)
+            match = BASE_COLORS_REGEX.match(_entity)
             if match:
                 _color = match.lastgroup
                 break
@@ -56,3 +89,110 @@ def recognize_colors(notes):
     # print(colors_list)
 
     return colors_list
+
+
+def _cache_tag():
+    """
+    Identify the model and the base colors the cached results were produced with
+    """
+    # read the version from the installed package so that a warm cache does not load the model
+    try:
+        _version = metadata.version(MODEL)
+    except metadata.PackageNotFoundError:
+        _version = get_nlp().meta.get("version")
+    _tag = [MODEL, _version, BASE_COLORS_MAP]
+    return hashlib.md5(json.dumps(_tag).encode("utf-8")).hexdigest()
+
+
+class ColorsCache:
+    """
+    Persistent cache of recognized colors keyed by the normalized note. Entries produced with
+    another model version or BASE_COLORS_MAP are dropped when the cache is opened. Hits and
+    misses are added to the colors_cache_* counters of src.metrics.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.tag = _cache_tag()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS colors (text TEXT PRIMARY KEY, tag TEXT NOT NULL, colors TEXT NOT NULL)"
+        )
+        self._conn.execute("DELETE FROM colors WHERE tag != ?", (self.tag,))
+        self._conn.commit()
+
+    def get_many(self, texts):
+        """
+        :return: dict of text -> colors list for the cached texts
+        """
+        cached = {}
+        with self._lock:
+            for _offset in range(0, len(texts), 500):
+                _texts = texts[_offset:_offset + 500]
+                _rows = self._conn.execute(
+                    f"SELECT text, colors FROM colors WHERE tag = ? AND text IN ({', '.join('?' * len(_texts))})",
+                    [self.tag, *_texts],
+                )
+                cached.update({text: json.loads(colors) for text, colors in _rows})
+        metrics.count("colors_cache_hits", len(cached))
+        metrics.count("colors_cache_misses", len(texts) - len(cached))
+        return cached
+
+    def set_many(self, colors):
+        """
+        :param colors: dict of text -> colors list
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO colors (text, tag, colors) VALUES (?, ?, ?)",
+                [(text, self.tag, json.dumps(_colors)) for text, _colors in colors.items()],
+            )
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ColorsCache()
+    return _cache
+
+
+def recognize_colors(notes):
+    return _extract_colors(get_nlp()(_normalize_notes(notes)))
+
+
+def recognize_colors_batch(notes, batch_size=256, n_process=1, use_cache=True):
+    """
+    Recognize colors of a whole column at once. Identical notes are processed only once and
+    the documents are streamed through nlp.pipe.
+    :param notes: iterable of str, e.g. pandas.Series
+    :param batch_size: number of texts buffered by nlp.pipe
+    :param n_process: number of processes used by nlp.pipe
+    :param use_cache: look the notes up in the persistent ColorsCache first
+    :return: list of colors lists in the order of notes
+    """
+    _texts = [_normalize_notes(_) for _ in notes]
+    _unique = list(dict.fromkeys(_texts))
+
+    _colors = get_cache().get_many(_unique) if use_cache else {}
+    _missing = [text for text in _unique if text not in _colors]
+    _recognized = {}
+    if _missing:
+        _docs = get_nlp().pipe(_missing, batch_size=batch_size, n_process=n_process)
+        _recognized = {text: _extract_colors(doc) for text, doc in zip(_missing, _docs)}
+    if use_cache:
+        get_cache().set_many(_recognized)
+    _colors.update(_recognized)
+
+    # copy the results, rows with identical notes must not share mutable lists
+    return [
+        [{'primaryColor': _['primaryColor'], 'entities': list(_['entities'])} for _ in _colors[text]]
+        for text in _texts
+    ]
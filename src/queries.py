@@ -1,17 +1,38 @@
 # -*- coding: UTF-8 -*-
-get_mineral_log = (
-    "SELECT ml.id, ml.name, ml.note, ml.created_at, ml.updated_at, ml.seen, ml.description, "
-    "ml.mindat_id, ml.ima_symbol FROM mineral_log ml;"
+# row_hash is the md5 of the synced values of a row, see src.diff.row_hash. The synced tables are
+# fetched as their keys and hashes only. The columns are added once with sync.py --add-row-hash,
+# the ALTERs lock the tables
+add_row_hash_columns = (
+    """
+    ALTER TABLE mineral_log ADD COLUMN IF NOT EXISTS row_hash char(32);
+    ALTER TABLE mineral_history ADD COLUMN IF NOT EXISTS row_hash char(32);
+    ALTER TABLE mineral_formula ADD COLUMN IF NOT EXISTS row_hash char(32);
+    ALTER TABLE mineral_crystallography ADD COLUMN IF NOT EXISTS row_hash char(32);
+    """
+)
+
+get_row_hash_tables = (
+    "SELECT table_name FROM information_schema.columns "
+    "WHERE table_schema = current_schema() AND column_name = 'row_hash';"
+)
+
+get_mineral_log = "SELECT ml.id, ml.name, ml.row_hash FROM mineral_log ml;"
+
+# the hash of data is compared with src.diff.jsonb_hash
+get_mineral_context = (
+    "SELECT mc.id, ml.name, mc.context_id, md5(mc.data::text) AS data_hash "
+    "FROM mineral_context mc "
+    "INNER JOIN mineral_log ml ON mc.mineral_id = ml.id;"
 )
 
 get_mineral_history = (
-    "SELECT mh.id, ml.name, mh.discovery_year, mh.ima_year, mh.approval_year, mh.publication_year "
+    "SELECT mh.id, ml.name, mh.row_hash "
     "FROM mineral_history mh "
     "INNER JOIN mineral_log ml on mh.mineral_id = ml.id;"
 )
 
 get_mineral_formula = (
-    "SELECT ml.name, ml.mindat_id, mf.formula, mf.note, mf.source_id "
+    "SELECT ml.name, mf.row_hash "
     "FROM mineral_formula mf "
     "INNER JOIN mineral_log ml ON mf.mineral_id = ml.id "
     "WHERE mf.source_id > 1;"
@@ -31,19 +52,20 @@ get_mineral_ima_note = (
     "INNER JOIN ima_note_list isl on min.ima_note_id = isl.id;"
 )
 
+# the statuses and relations of every group, they also feed src.relations.RelationGraph
 get_mineral_status = (
     """
-    SELECT ml.name, sl.status_id, ms.direct_status
+    SELECT ml.name, sl.status_id, ms.direct_status, ms.mineral_id, sl.status_group_id
     FROM mineral_status ms
     INNER JOIN mineral_log ml ON ms.mineral_id = ml.id
-    INNER JOIN status_list sl ON sl.id = ms.status_id
-    WHERE sl.status_group_id IN (2, 3, 4);
+    INNER JOIN status_list sl ON sl.id = ms.status_id;
     """
 )
 
 get_mineral_relation = (
     """
-    SELECT ml.name, sl.status_id, ml_.name as relation, ms.direct_status
+    SELECT ml.name, sl.status_id, ml_.name as relation, ms.direct_status, mr.mineral_id, mr.relation_id,
+        sl.status_group_id
     FROM mineral_relation mr
     INNER JOIN mineral_log ml ON mr.mineral_id = ml.id
     INNER JOIN mineral_log ml_ ON mr.relation_id = ml_.id
@@ -53,10 +75,31 @@ get_mineral_relation = (
 )
 
 get_mineral_crystallography = (
-    "SELECT ml.name, ml.mindat_id, csl.name as crystal_system "
+    "SELECT ml.name, mc.row_hash "
     "FROM mineral_crystallography mc "
-    "INNER JOIN mineral_log ml ON mc.mineral_id = ml.id "
-    "INNER JOIN crystal_system_list csl ON mc.crystal_system_id = csl.id;"
+    "INNER JOIN mineral_log ml ON mc.mineral_id = ml.id;"
+)
+
+# the fetches of the tables without a row_hash column yet, every row is compared as changed
+get_mineral_log_unhashed = "SELECT ml.id, ml.name, NULL::char(32) AS row_hash FROM mineral_log ml;"
+
+get_mineral_history_unhashed = (
+    "SELECT mh.id, ml.name, NULL::char(32) AS row_hash "
+    "FROM mineral_history mh "
+    "INNER JOIN mineral_log ml on mh.mineral_id = ml.id;"
+)
+
+get_mineral_formula_unhashed = (
+    "SELECT ml.name, NULL::char(32) AS row_hash "
+    "FROM mineral_formula mf "
+    "INNER JOIN mineral_log ml ON mf.mineral_id = ml.id "
+    "WHERE mf.source_id > 1;"
+)
+
+get_mineral_crystallography_unhashed = (
+    "SELECT ml.name, NULL::char(32) AS row_hash "
+    "FROM mineral_crystallography mc "
+    "INNER JOIN mineral_log ml ON mc.mineral_id = ml.id;"
 )
 
 get_mineral_relation_suggestion = (
@@ -66,7 +109,7 @@ get_mineral_relation_suggestion = (
     "INNER JOIN mineral_log ml_ on ml_.id = mrs.relation_id;"
 )
 
-get_minerals = (
+_select_minerals = (
     """
         SELECT ml.id AS mindat_id, ml.name AS name, ml.ima_status AS ima_status, ml.ima_notes AS ima_note,
         ml.dispformulasimple AS formula, ml.imaformula as imaformula, ml.formulanotes AS note, ml.imayear AS ima_year,
@@ -130,19 +173,50 @@ get_minerals = (
         LEFT JOIN minerals ml1 ON ml.synid = ml1.id
         LEFT JOIN minerals ml2 ON ml.varietyof = ml2.id
         LEFT JOIN minerals ml3 ON ml.polytypeof = ml3.id
+    """
+)
+
+get_minerals = _select_minerals + (
+    """
+        WHERE ml.id IN (
+            SELECT ml.id
+            FROM minerals ml
+            WHERE ml.name REGEXP '^[A-Za-z0-9]+'
+        );
+    """
+)
+
+# minerals changed since the last run, including those whose synonym/variety/polytype parent changed.
+# The rows updated in the second of the watermark or committed shortly after their updttime are
+# pulled again by the next run, the diff skips those which did not change
+get_minerals_since = _select_minerals + (
+    """
         WHERE ml.id IN (
             SELECT ml.id
             FROM minerals ml
             WHERE ml.name REGEXP '^[A-Za-z0-9]+'
+        ) AND (
+            ml.updttime >= %(since)s - INTERVAL 5 MINUTE OR ml1.updttime >= %(since)s - INTERVAL 5 MINUTE OR
+            ml2.updttime >= %(since)s - INTERVAL 5 MINUTE OR ml3.updttime >= %(since)s - INTERVAL 5 MINUTE
         );
     """
 )
 
+get_minerals_watermark = "SELECT MAX(ml.updttime) AS watermark FROM minerals ml;"
+
 get_relations = (
     "SELECT r.rid as id, r.min1 AS mineral_id, r.min2 AS relation_id, r.rel as relation_type_id "
     "FROM relations r;"
 )
 
+# the relations have no update time, an incremental run pulls all of them when this fingerprint of
+# the table changed, so that edited and deleted relations are synced as well
+get_relations_watermark = (
+    "SELECT CONCAT_WS(':', COUNT(*), COALESCE(MAX(r.rid), 0), COALESCE(BIT_XOR(CRC32(CONCAT_WS(',', "
+    "r.rid, COALESCE(r.min1, ''), COALESCE(r.min2, ''), COALESCE(r.rel, '')))), 0)) AS watermark "
+    "FROM relations r;"
+)
+
 get_alternative_names = (
     """
         SELECT _temp.mineral_id, _temp.name, _temp.relation_id, _temp.relation_name,
@@ -237,6 +311,30 @@ get_cod = (
     """
 )
 
+# column -> type of a table, the staging table of a copied INSERT ... VALUES takes them, see Migrator._copy
+get_column_types = (
+    "SELECT a.attname, format_type(a.atttypid, a.atttypmod) "
+    "FROM pg_attribute a "
+    "WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped;"
+)
+
+# name and key -> id mappings of the lookup cache, see Migrator.load_lookups
+lookup_mineral_log = "SELECT ml.name AS key, ml.id FROM mineral_log ml;"
+
+lookup_mineral_log_mindat = "SELECT ml.mindat_id AS key, ml.id FROM mineral_log ml WHERE ml.mindat_id IS NOT NULL;"
+
+lookup_mineral_log_upper = "SELECT UPPER(ml.name) AS key, ml.id FROM mineral_log ml;"
+
+lookup_status_list = "SELECT sl.status_id AS key, sl.id FROM status_list sl;"
+
+lookup_crystal_system_list = "SELECT csl.name AS key, csl.id FROM crystal_system_list csl;"
+
+lookup_ima_status_list = "SELECT isl.key, isl.id FROM ima_status_list isl;"
+
+lookup_ima_note_list = "SELECT inl.key, inl.id FROM ima_note_list inl;"
+
+lookup_data_context_list = "SELECT dcl.id AS key, dcl.id FROM data_context_list dcl;"
+
 get_chem_measurement = (
     """
     SELECT cm.id, cm.external_key as key
@@ -248,38 +346,39 @@ get_chem_measurement = (
 insert_chem_measurement = (
     """
         INSERT INTO chem_measurement AS cm (mineral_id, external_key, resource, sample_name, grain_size, rock_name,
-                                            rock_texture, alteration, is_primary, tectonic_setting, latitude_min, latitude_max, longitude_min, longitude_max, elevation_min, elevation_max,
-                                            citation, location, location_note, created_at)
-        SELECT ml.id, new.key, 1, new.sample_name, new.grain_size, new.rock_name, new.rock_texture, new.alteration::int, new.is_primary::bool, new.tectonic_setting,
-               new.latitude_min::float, new.latitude_max::float, new.longitude_min::float, new.longitude_max::float, new.elevation_min::float, new.elevation_max::float, new.citation, new.location, new.location_note, CURRENT_TIMESTAMP
+                                            rock_texture, alteration, is_primary, tectonic_setting,
+                                            latitude_min, latitude_max, longitude_min, longitude_max,
+                                            elevation_min, elevation_max, citation, location, location_note, created_at)
+        SELECT new.mineral_id::uuid, new.key, 1, new.sample_name, new.grain_size, new.rock_name, new.rock_texture,
+               new.alteration::int, new.is_primary::bool, new.tectonic_setting,
+               new.latitude_min::float, new.latitude_max::float, new.longitude_min::float, new.longitude_max::float,
+               new.elevation_min::float, new.elevation_max::float, new.citation, new.location, new.location_note,
+               CURRENT_TIMESTAMP
         FROM (VALUES %s)
-            AS new (key, name, mineral_note, sample_name, grain_size, rock_name, rock_texture, alteration, is_primary, tectonic_setting, citation, latitude_min, latitude_max, longitude_min, longitude_max, elevation_min, elevation_max, location, location_note)
-        LEFT JOIN mineral_log AS ml ON UPPER(ml.name) = new.name
+            AS new (key, mineral_id, mineral_note, sample_name, grain_size, rock_name, rock_texture, alteration,
+                    is_primary, tectonic_setting, citation, latitude_min, latitude_max, longitude_min, longitude_max,
+                    elevation_min, elevation_max, location, location_note)
         RETURNING cm.id, cm.mineral_id, cm.external_key, cm.resource;
     """
 )
 
 insert_mineral_log = (
-    "INSERT INTO mineral_log AS ml (name, description, mindat_id, ima_symbol) VALUES %s "
+    "INSERT INTO mineral_log AS ml (name, description, mindat_id, ima_symbol, row_hash) VALUES %s "
     "RETURNING ml.id, ml.name, ml.description, ml.mindat_id, ml.ima_symbol;"
 )
 
 insert_mineral_relation_suggestion = (
     "INSERT INTO mineral_relation_suggestion as mrs (id, mineral_id, relation_id, relation_type_id) "
-    "SELECT new.id::int, ml.id, ml_.id, new.relation_type_id::int "
+    "SELECT new.id::int, new.mineral_id::uuid, new.relation_id::uuid, new.relation_type_id::int "
     "FROM (VALUES %s) AS new (id, mineral_id, relation_id, relation_type_id) "
-    "INNER JOIN mineral_log ml ON ml.mindat_id = new.mineral_id "
-    "INNER JOIN mineral_log ml_ ON ml_.mindat_id = new.relation_id "
     "RETURNING mrs.id, mrs.mineral_id, mrs.relation_id, mrs.relation_type_id;"
 )
 
 insert_mineral_crystallography = (
     "WITH ins (id, mineral_id, crystal_system_id) AS ( "
-    "       INSERT INTO mineral_crystallography AS mc (mineral_id, crystal_system_id) "
-    "       SELECT ml.id, csl.id "
-    "       FROM (VALUES %s) AS new (name, crystal_system) "
-    "       INNER JOIN mineral_log AS ml on ml.name = new.name "
-    "       INNER JOIN crystal_system_list AS csl on csl.name = new.crystal_system "
+    "       INSERT INTO mineral_crystallography AS mc (mineral_id, crystal_system_id, row_hash) "
+    "       SELECT new.mineral_id::uuid, new.crystal_system_id, new.row_hash "
+    "       FROM (VALUES %s) AS new (mineral_id, crystal_system_id, row_hash) "
     "       RETURNING mc.id, mc.mineral_id, mc.crystal_system_id"
     ") "
     "SELECT ml.name, ml.id AS mineral_id, ins.id, ins.crystal_system_id "
@@ -289,10 +388,9 @@ insert_mineral_crystallography = (
 
 insert_mineral_formula = (
     "WITH ins (id, mineral_id, formula, note, source_id) AS ( "
-    "       INSERT INTO mineral_formula AS mf (mineral_id, formula, note, source_id) "
-    "       SELECT ml.id, new.formula, new.note, new.source_id "
-    "       FROM (VALUES %s) AS new (name, formula, note, source_id) "
-    "       INNER JOIN mineral_log AS ml on ml.name = new.name "
+    "       INSERT INTO mineral_formula AS mf (mineral_id, formula, note, source_id, row_hash) "
+    "       SELECT new.mineral_id::uuid, new.formula, new.note, new.source_id, new.row_hash "
+    "       FROM (VALUES %s) AS new (mineral_id, formula, note, source_id, row_hash) "
     "       RETURNING mf.id, mf.mineral_id, mf.formula, mf.note, mf.source_id, mf.created_at"
     ") "
     "SELECT ml.name, ml.id AS mineral_id, ins.id, ins.formula, ins.note, ins.source_id, ins.created_at "
@@ -303,10 +401,8 @@ insert_mineral_formula = (
 insert_mineral_ima_status = (
     "WITH ins (id, mineral_id, ima_status_id) AS ( "
     "       INSERT INTO mineral_ima_status AS mis (mineral_id, ima_status_id) "
-    "       SELECT ml.id, isl.id "
-    "       FROM (VALUES %s) AS new (name, ima_status_id) "
-    "       INNER JOIN mineral_log AS ml on ml.name = new.name "
-    "       INNER JOIN ima_status_list AS isl on isl.key = new.ima_status_id "
+    "       SELECT new.mineral_id::uuid, new.ima_status_id "
+    "       FROM (VALUES %s) AS new (mineral_id, ima_status_id) "
     "       RETURNING mis.id, mis.mineral_id, mis.ima_status_id, mis.created_at"
     ") "
     "SELECT ml.name, ml.id AS mineral_id, ins.id, ins.ima_status_id, ins.created_at "
@@ -317,10 +413,8 @@ insert_mineral_ima_status = (
 insert_mineral_ima_note = (
     "WITH ins (id, mineral_id, ima_note_id) AS ( "
     "       INSERT INTO mineral_ima_note AS min (mineral_id, ima_note_id) "
-    "       SELECT ml.id, inl.id "
-    "       FROM (VALUES %s) AS new (name, ima_note) "
-    "       INNER JOIN mineral_log AS ml on ml.name = new.name "
-    "       INNER JOIN ima_note_list AS inl on inl.key = new.ima_note "
+    "       SELECT new.mineral_id::uuid, new.ima_note_id "
+    "       FROM (VALUES %s) AS new (mineral_id, ima_note_id) "
     "       RETURNING min.id, min.mineral_id, min.ima_note_id, min.created_at"
     ") "
     "SELECT ml.name, ml.id AS mineral_id, ins.id, ins.ima_note_id, ins.created_at "
@@ -332,10 +426,8 @@ insert_mineral_context = (
     """
     WITH ins (id, mineral_id, data, context_id) AS (
         INSERT INTO mineral_context AS mc (mineral_id, data, context_id)
-        SELECT ml.id, new.data::jsonb, dcl.id
-        FROM (VALUES %s) AS new (name, data, context_id)
-        INNER JOIN mineral_log AS ml ON ml.name = new.name
-        INNER JOIN data_context_list AS dcl ON dcl.id = new.context_id
+        SELECT new.mineral_id::uuid, new.data::jsonb, new.context_id
+        FROM (VALUES %s) AS new (mineral_id, data, context_id)
         RETURNING mc.id, mc.mineral_id, mc.data, mc.context_id
     )
     SELECT ml.name, ml.id AS mineral_id, ins.id, ins.data, dcl.name AS context
@@ -371,15 +463,15 @@ insert_mineral_status = (
     """
     WITH ins (id, mineral_id, status_id) AS (
         INSERT INTO mineral_status AS ms (mineral_id, status_id, needs_revision, direct_status)
-        SELECT ml.id, sl.id, TRUE AS needs_revision, new.direct_status
-        FROM (VALUES %s) AS new (name, status_id, direct_status)
-        INNER JOIN mineral_log AS ml ON ml.name = new.name
-        INNER JOIN status_list AS sl ON sl.status_id = new.status_id
+        SELECT new.mineral_id::uuid, new.status_id, TRUE AS needs_revision, new.direct_status
+        FROM (VALUES %s) AS new (mineral_id, status_id, direct_status)
         RETURNING ms.id, ms.mineral_id, ms.status_id, ms.needs_revision, ms.direct_status
     )
-    SELECT ml.name, ml.id AS mineral_id, ins.id, ins.status_id, ins.needs_revision, ins.direct_status
+    SELECT ml.name, ml.id AS mineral_id, ins.id, ins.status_id, ins.needs_revision, ins.direct_status,
+        sl.status_group_id
     FROM ins
-    INNER JOIN mineral_log ml ON ml.id = ins.mineral_id;
+    INNER JOIN mineral_log ml ON ml.id = ins.mineral_id
+    INNER JOIN status_list sl ON sl.id = ins.status_id;
     """
 )
 
@@ -387,29 +479,29 @@ insert_mineral_relation = (
     """
     WITH ins (id, mineral_id, mineral_status_id, relation_id) AS (
         INSERT INTO mineral_relation AS mr (mineral_id, mineral_status_id, relation_id)
-        SELECT ml.id, ms.id, ml_.id
-        FROM (VALUES %s) AS new (name, status_id, relation, direct_status)
-        INNER JOIN mineral_log AS ml ON ml.name = new.name
-        INNER JOIN mineral_log AS ml_ ON ml_.name = new.relation
-        INNER JOIN status_list AS sl ON sl.status_id = new.status_id
-        INNER JOIN mineral_status AS ms ON ms.mineral_id = ml.id AND ms.status_id = sl.id AND
+        SELECT ms.mineral_id, ms.id, new.relation_id::uuid
+        FROM (VALUES %s) AS new (mineral_id, status_id, relation_id, direct_status)
+        INNER JOIN mineral_status AS ms ON ms.mineral_id = new.mineral_id::uuid AND ms.status_id = new.status_id AND
             ms.direct_status = new.direct_status
         RETURNING mr.id, mr.mineral_id, mr.mineral_status_id, mr.relation_id
     )
-    SELECT ins.id, ml.name, ins.mineral_status_id, ml_.name
+    SELECT ins.id, ml.name, ins.mineral_status_id, ml_.name, ins.mineral_id, ins.relation_id, ms.direct_status,
+        sl.status_group_id
     FROM ins
     INNER JOIN mineral_log ml ON ml.id = ins.mineral_id
-    INNER JOIN mineral_log ml_ ON ml_.id = ins.relation_id;
+    INNER JOIN mineral_log ml_ ON ml_.id = ins.relation_id
+    INNER JOIN mineral_status ms ON ms.id = ins.mineral_status_id
+    INNER JOIN status_list sl ON sl.id = ms.status_id;
     """
 )
 
 insert_mineral_history = (
     "WITH ins (id, mineral_id, discovery_year, ima_year, approval_year, publication_year) AS ( "
-    "   INSERT INTO mineral_history AS mh (mineral_id, discovery_year, ima_year, approval_year, publication_year) "
-    "   SELECT ml.id, new.discovery_year::smallint, new.ima_year::smallint, new.approval_year::smallint, "
-    "   new.publication_year::smallint "
-    "   FROM (VALUES %s) AS new (name, discovery_year, ima_year, approval_year, publication_year) "
-    "   INNER JOIN mineral_log AS ml ON ml.name = new.name "
+    "   INSERT INTO mineral_history AS mh (mineral_id, discovery_year, ima_year, approval_year, publication_year, "
+    "   row_hash) "
+    "   SELECT new.mineral_id::uuid, new.discovery_year::smallint, new.ima_year::smallint, "
+    "   new.approval_year::smallint, new.publication_year::smallint, new.row_hash "
+    "   FROM (VALUES %s) AS new (mineral_id, discovery_year, ima_year, approval_year, publication_year, row_hash) "
     "   RETURNING mh.id, mh.mineral_id, mh.discovery_year, mh.ima_year, mh.approval_year, mh.publication_year"
     ") "
     "SELECT ml.name, ml.id AS mineral_id, ins.id, ins.discovery_year, ins.ima_year, ins.approval_year, "
@@ -422,8 +514,9 @@ update_mineral_log = (
     "UPDATE mineral_log AS ml SET "
     "description = new.description, "
     "mindat_id = new.mindat_id::int, "
-    "ima_symbol = new.ima_symbol "
-    "FROM (VALUES %s) AS new (id, description, mindat_id, ima_symbol) "
+    "ima_symbol = new.ima_symbol, "
+    "row_hash = new.row_hash "
+    "FROM (VALUES %s) AS new (id, description, mindat_id, ima_symbol, row_hash) "
     "WHERE ml.id::uuid = new.id::uuid "
     "RETURNING ml.id, ml.name, ml.description, ml.mindat_id, ml.ima_symbol;"
 )
@@ -434,9 +527,10 @@ update_mineral_history = (
     "discovery_year = new.discovery_year::smallint, "
     "ima_year = new.ima_year::smallint, "
     "approval_year = new.approval_year::smallint, "
-    "publication_year = new.publication_year::smallint "
+    "publication_year = new.publication_year::smallint, "
+    "row_hash = new.row_hash "
     "FROM (VALUES %s) "
-    "AS new (id, discovery_year, ima_year, approval_year, publication_year) "
+    "AS new (id, discovery_year, ima_year, approval_year, publication_year, row_hash) "
     "WHERE mh.id = new.id "
     "RETURNING mh.id, mh.mineral_id, mh.discovery_year, mh.ima_year, mh.approval_year, mh.publication_year"
     ") "
@@ -449,11 +543,10 @@ update_mineral_history = (
 update_mineral_crystallography = (
     "WITH upd (id, mineral_id, crystal_system_id) AS ("
     "UPDATE mineral_crystallography AS mc SET "
-    "crystal_system_id = csl.id "
-    "FROM (VALUES %s) AS new (mineral_name, crystal_system_name) "
-    "INNER JOIN mineral_log ml ON ml.name = new.mineral_name "
-    "INNER JOIN crystal_system_list csl ON csl.name = new.crystal_system_name "
-    "WHERE mc.mineral_id = ml.id "
+    "crystal_system_id = new.crystal_system_id, "
+    "row_hash = new.row_hash "
+    "FROM (VALUES %s) AS new (mineral_id, crystal_system_id, row_hash) "
+    "WHERE mc.mineral_id = new.mineral_id::uuid "
     "RETURNING mc.id, mc.mineral_id, mc.crystal_system_id"
     ")"
     "SELECT ml.name, ml.id AS mineral_id, upd.id, csl.name as crystal_system_name "
@@ -464,19 +557,357 @@ update_mineral_crystallography = (
 
 update_mineral_relation_suggestion = (
     "UPDATE mineral_relation_suggestion AS mrs SET "
-    "mineral_id = ml.id, "
-    "relation_id = ml_.id, "
+    "mineral_id = new.mineral_id::uuid, "
+    "relation_id = new.relation_id::uuid, "
     "relation_type_id = new.relation_type_id, "
     "is_processed = FALSE "
     "FROM (VALUES %s) AS new (id, mineral_id, relation_id, relation_type_id) "
-    "INNER JOIN mineral_log ml ON ml.mindat_id = new.mineral_id "
-    "INNER JOIN mineral_log ml_ ON ml_.mindat_id = new.relation_id "
     "WHERE mrs.id = new.id "
     "RETURNING mrs.id, mrs.mineral_id, mrs.relation_id, mrs.relation_type_id;"
 )
 
+update_mineral_context = (
+    """
+    WITH upd (id, mineral_id, data, context_id) AS (
+        UPDATE mineral_context AS mc SET data = new.data::jsonb
+        FROM (VALUES %s) AS new (id, data)
+        WHERE mc.id = new.id
+        RETURNING mc.id, mc.mineral_id, mc.data, mc.context_id
+    )
+    SELECT ml.name, ml.id AS mineral_id, upd.id, upd.data, dcl.name AS context
+    FROM upd
+    INNER JOIN mineral_log ml ON ml.id = upd.mineral_id
+    INNER JOIN data_context_list dcl ON dcl.id = upd.context_id;
+    """
+)
+
+delete_mineral_context = (
+    "DELETE FROM mineral_context AS mc WHERE mc.id IN "
+    "(SELECT old.id FROM (VALUES %s) AS old (id)) "
+    "RETURNING mc.id, mc.mineral_id, mc.context_id;"
+)
+
 delete_mineral_relation_suggestion = (
     "DELETE FROM mineral_relation_suggestion AS mrs WHERE mrs.id IN "
     "(SELECT old.id FROM (VALUES %s) AS old (id, mineral_id)) "
     "RETURNING mrs.id, mrs.mineral_id, mrs.relation_id, mrs.relation_type_id;"
 )
+
+# server-side merges, see Migrator.merge_query. The source rows are staged, the changed rows
+# are returned with the operation as the last column
+merge_mineral_log = (
+    """
+    WITH src AS (
+        SELECT DISTINCT ON (src.name) src.name, src.description, src.mindat_id::int AS mindat_id, src.ima_symbol,
+            src.row_hash
+        FROM (VALUES %s) AS src (name, description, mindat_id, ima_symbol, row_hash)
+    ),
+    ins AS (
+        INSERT INTO mineral_log AS ml (name, description, mindat_id, ima_symbol, row_hash)
+        SELECT src.name, src.description, src.mindat_id, src.ima_symbol, src.row_hash
+        FROM src
+        WHERE NOT EXISTS (SELECT 1 FROM mineral_log ml WHERE ml.name = src.name)
+        RETURNING ml.id, ml.name, ml.description, ml.mindat_id, ml.ima_symbol
+    ),
+    upd AS (
+        UPDATE mineral_log AS ml SET
+            description = src.description,
+            mindat_id = src.mindat_id,
+            ima_symbol = src.ima_symbol,
+            row_hash = src.row_hash
+        FROM src
+        WHERE ml.name = src.name AND ml.row_hash IS DISTINCT FROM src.row_hash
+        RETURNING ml.id, ml.name, ml.description, ml.mindat_id, ml.ima_symbol
+    )
+    SELECT ins.*, 'insert' AS operation FROM ins
+    UNION ALL
+    SELECT upd.*, 'update' AS operation FROM upd;
+    """
+)
+
+merge_mineral_history = (
+    """
+    WITH src AS (
+        SELECT DISTINCT ON (ml.id) ml.id AS mineral_id, ml.name, src.discovery_year::smallint AS discovery_year,
+            src.ima_year::smallint AS ima_year, src.approval_year::smallint AS approval_year,
+            src.publication_year::smallint AS publication_year, src.row_hash
+        FROM (VALUES %s) AS src (name, discovery_year, ima_year, approval_year, publication_year, row_hash)
+        INNER JOIN mineral_log AS ml ON ml.name = src.name
+    ),
+    ins AS (
+        INSERT INTO mineral_history AS mh (mineral_id, discovery_year, ima_year, approval_year, publication_year,
+            row_hash)
+        SELECT src.mineral_id, src.discovery_year, src.ima_year, src.approval_year, src.publication_year, src.row_hash
+        FROM src
+        WHERE NOT EXISTS (SELECT 1 FROM mineral_history mh WHERE mh.mineral_id = src.mineral_id)
+        RETURNING mh.id, mh.mineral_id, mh.discovery_year, mh.ima_year, mh.approval_year, mh.publication_year
+    ),
+    upd AS (
+        UPDATE mineral_history AS mh SET
+            discovery_year = src.discovery_year,
+            ima_year = src.ima_year,
+            approval_year = src.approval_year,
+            publication_year = src.publication_year,
+            row_hash = src.row_hash
+        FROM src
+        WHERE mh.mineral_id = src.mineral_id AND mh.row_hash IS DISTINCT FROM src.row_hash
+        RETURNING mh.id, mh.mineral_id, mh.discovery_year, mh.ima_year, mh.approval_year, mh.publication_year
+    )
+    SELECT src.name, ins.*, 'insert' AS operation FROM ins INNER JOIN src ON src.mineral_id = ins.mineral_id
+    UNION ALL
+    SELECT src.name, upd.*, 'update' AS operation FROM upd INNER JOIN src ON src.mineral_id = upd.mineral_id;
+    """
+)
+
+merge_mineral_crystallography = (
+    """
+    WITH src AS (
+        SELECT DISTINCT ON (ml.id) ml.id AS mineral_id, ml.name, csl.id AS crystal_system_id, src.row_hash
+        FROM (VALUES %s) AS src (name, crystal_system, row_hash)
+        INNER JOIN mineral_log AS ml ON ml.name = src.name
+        INNER JOIN crystal_system_list AS csl ON csl.name = src.crystal_system
+    ),
+    ins AS (
+        INSERT INTO mineral_crystallography AS mc (mineral_id, crystal_system_id, row_hash)
+        SELECT src.mineral_id, src.crystal_system_id, src.row_hash
+        FROM src
+        WHERE NOT EXISTS (SELECT 1 FROM mineral_crystallography mc WHERE mc.mineral_id = src.mineral_id)
+        RETURNING mc.id, mc.mineral_id, mc.crystal_system_id
+    ),
+    upd AS (
+        UPDATE mineral_crystallography AS mc SET crystal_system_id = src.crystal_system_id, row_hash = src.row_hash
+        FROM src
+        WHERE mc.mineral_id = src.mineral_id AND mc.row_hash IS DISTINCT FROM src.row_hash
+        RETURNING mc.id, mc.mineral_id, mc.crystal_system_id
+    )
+    SELECT src.name, ins.mineral_id, ins.id, ins.crystal_system_id, 'insert' AS operation
+    FROM ins INNER JOIN src ON src.mineral_id = ins.mineral_id
+    UNION ALL
+    SELECT src.name, upd.mineral_id, upd.id, upd.crystal_system_id, 'update' AS operation
+    FROM upd INNER JOIN src ON src.mineral_id = upd.mineral_id;
+    """
+)
+
+merge_mineral_formula = (
+    """
+    WITH src AS (
+        SELECT DISTINCT ON (ml.id, src.source_id) ml.id AS mineral_id, ml.name, src.formula, src.note,
+            src.source_id::int AS source_id, src.row_hash
+        FROM (VALUES %s) AS src (name, formula, note, source_id, row_hash)
+        INNER JOIN mineral_log AS ml ON ml.name = src.name
+        WHERE NOT EXISTS (SELECT 1 FROM mineral_formula mf WHERE mf.mineral_id = ml.id AND mf.source_id > 1)
+    ),
+    ins AS (
+        INSERT INTO mineral_formula AS mf (mineral_id, formula, note, source_id, row_hash)
+        SELECT src.mineral_id, src.formula, src.note, src.source_id, src.row_hash
+        FROM src
+        RETURNING mf.id, mf.mineral_id, mf.formula, mf.note, mf.source_id, mf.created_at
+    )
+    SELECT ml.name, ins.mineral_id, ins.id, ins.formula, ins.note, ins.source_id, ins.created_at, 'insert' AS operation
+    FROM ins
+    INNER JOIN mineral_log ml ON ml.id = ins.mineral_id;
+    """
+)
+
+merge_mineral_ima_status = (
+    """
+    WITH ins (id, mineral_id, ima_status_id) AS (
+        INSERT INTO mineral_ima_status AS mis (mineral_id, ima_status_id)
+        SELECT DISTINCT ml.id, isl.id
+        FROM (VALUES %s) AS src (name, ima_status_id)
+        INNER JOIN mineral_log AS ml ON ml.name = src.name
+        INNER JOIN ima_status_list AS isl ON isl.key = src.ima_status_id
+        WHERE NOT EXISTS (SELECT 1 FROM mineral_ima_status mis WHERE mis.mineral_id = ml.id)
+        RETURNING mis.id, mis.mineral_id, mis.ima_status_id, mis.created_at
+    )
+    SELECT ml.name, ml.id AS mineral_id, ins.id, ins.ima_status_id, ins.created_at, 'insert' AS operation
+    FROM ins
+    INNER JOIN mineral_log ml ON ml.id = ins.mineral_id;
+    """
+)
+
+merge_mineral_ima_note = (
+    """
+    WITH ins (id, mineral_id, ima_note_id) AS (
+        INSERT INTO mineral_ima_note AS min (mineral_id, ima_note_id)
+        SELECT DISTINCT ml.id, inl.id
+        FROM (VALUES %s) AS src (name, ima_note)
+        INNER JOIN mineral_log AS ml ON ml.name = src.name
+        INNER JOIN ima_note_list AS inl ON inl.key = src.ima_note
+        WHERE NOT EXISTS (SELECT 1 FROM mineral_ima_note min WHERE min.mineral_id = ml.id)
+        RETURNING min.id, min.mineral_id, min.ima_note_id, min.created_at
+    )
+    SELECT ml.name, ml.id AS mineral_id, ins.id, ins.ima_note_id, ins.created_at, 'insert' AS operation
+    FROM ins
+    INNER JOIN mineral_log ml ON ml.id = ins.mineral_id;
+    """
+)
+
+merge_mineral_status = (
+    """
+    WITH ins (id, mineral_id, status_id) AS (
+        INSERT INTO mineral_status AS ms (mineral_id, status_id, needs_revision, direct_status)
+        SELECT DISTINCT ml.id, sl.id, TRUE AS needs_revision, src.direct_status::bool
+        FROM (VALUES %s) AS src (name, status_id, direct_status)
+        INNER JOIN mineral_log AS ml ON ml.name = src.name
+        INNER JOIN status_list AS sl ON sl.status_id = src.status_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM mineral_status ms
+            WHERE ms.mineral_id = ml.id AND ms.status_id = sl.id AND ms.direct_status = src.direct_status::bool AND
+                sl.status_group_id IN (2, 3, 4)
+        )
+        RETURNING ms.id, ms.mineral_id, ms.status_id, ms.needs_revision, ms.direct_status
+    )
+    SELECT ml.name, ml.id AS mineral_id, ins.id, ins.status_id, ins.needs_revision, ins.direct_status,
+        'insert' AS operation
+    FROM ins
+    INNER JOIN mineral_log ml ON ml.id = ins.mineral_id;
+    """
+)
+
+merge_mineral_relation = (
+    """
+    WITH ins (id, mineral_id, mineral_status_id, relation_id) AS (
+        INSERT INTO mineral_relation AS mr (mineral_id, mineral_status_id, relation_id)
+        SELECT DISTINCT ml.id, ms.id, ml_.id
+        FROM (VALUES %s) AS src (name, status_id, relation, direct_status)
+        INNER JOIN mineral_log AS ml ON ml.name = src.name
+        INNER JOIN mineral_log AS ml_ ON ml_.name = src.relation
+        INNER JOIN status_list AS sl ON sl.status_id = src.status_id
+        INNER JOIN mineral_status AS ms ON ms.mineral_id = ml.id AND ms.status_id = sl.id AND
+            ms.direct_status = src.direct_status::bool
+        WHERE NOT EXISTS (
+            SELECT 1 FROM mineral_relation mr
+            INNER JOIN mineral_status ms_ ON mr.mineral_status_id = ms_.id
+            WHERE mr.mineral_id = ml.id AND mr.relation_id = ml_.id AND ms_.status_id = sl.id
+        )
+        RETURNING mr.id, mr.mineral_id, mr.mineral_status_id, mr.relation_id
+    )
+    SELECT ins.id, ml.name, ins.mineral_status_id, ml_.name, 'insert' AS operation
+    FROM ins
+    INNER JOIN mineral_log ml ON ml.id = ins.mineral_id
+    INNER JOIN mineral_log ml_ ON ml_.id = ins.relation_id;
+    """
+)
+
+_merge_mineral_relation_suggestion = (
+    """
+    WITH staged AS (
+        SELECT staged.id::int AS id, staged.mineral_id::int AS mineral_id, staged.relation_id::int AS relation_id,
+            staged.relation_type_id::int AS relation_type_id
+        FROM (VALUES %s) AS staged (id, mineral_id, relation_id, relation_type_id)
+    ),
+    src AS (
+        SELECT DISTINCT ON (staged.id) staged.id, ml.id AS mineral_id, ml_.id AS relation_id, staged.relation_type_id
+        FROM staged
+        INNER JOIN mineral_log ml ON ml.mindat_id = staged.mineral_id
+        INNER JOIN mineral_log ml_ ON ml_.mindat_id = staged.relation_id
+    ),
+    ins AS (
+        INSERT INTO mineral_relation_suggestion AS mrs (id, mineral_id, relation_id, relation_type_id)
+        SELECT src.id, src.mineral_id, src.relation_id, src.relation_type_id
+        FROM src
+        WHERE NOT EXISTS (SELECT 1 FROM mineral_relation_suggestion mrs WHERE mrs.id = src.id)
+        RETURNING mrs.id, mrs.mineral_id, mrs.relation_id, mrs.relation_type_id
+    ),
+    upd AS (
+        UPDATE mineral_relation_suggestion AS mrs SET
+            mineral_id = src.mineral_id,
+            relation_id = src.relation_id,
+            relation_type_id = src.relation_type_id,
+            is_processed = FALSE
+        FROM src
+        WHERE mrs.id = src.id AND
+            (mrs.mineral_id, mrs.relation_id, mrs.relation_type_id) IS DISTINCT FROM
+            (src.mineral_id, src.relation_id, src.relation_type_id)
+        RETURNING mrs.id, mrs.mineral_id, mrs.relation_id, mrs.relation_type_id
+    )
+    """
+)
+
+merge_mineral_relation_suggestion = _merge_mineral_relation_suggestion + (
+    """
+    SELECT ins.*, 'insert' AS operation FROM ins
+    UNION ALL
+    SELECT upd.*, 'update' AS operation FROM upd;
+    """
+)
+
+# full runs also delete the suggestions which are no longer in the source
+merge_mineral_relation_suggestion_delete = _merge_mineral_relation_suggestion + (
+    """
+    , del AS (
+        DELETE FROM mineral_relation_suggestion AS mrs
+        WHERE NOT EXISTS (SELECT 1 FROM staged WHERE staged.id = mrs.id)
+        RETURNING mrs.id, mrs.mineral_id, mrs.relation_id, mrs.relation_type_id
+    )
+    SELECT ins.*, 'insert' AS operation FROM ins
+    UNION ALL
+    SELECT upd.*, 'update' AS operation FROM upd
+    UNION ALL
+    SELECT del.*, 'delete' AS operation FROM del;
+    """
+)
+
+# the contexts of every source mineral are staged, with a null data where a mineral has none
+_merge_mineral_context = (
+    """
+    WITH src AS (
+        SELECT DISTINCT ON (ml.id, src.context_id) ml.id AS mineral_id, src.data::jsonb AS data,
+            src.context_id::int AS context_id
+        FROM (VALUES %s) AS src (name, data, context_id)
+        INNER JOIN mineral_log AS ml ON ml.name = src.name
+    ),
+    ins AS (
+        INSERT INTO mineral_context AS mc (mineral_id, data, context_id)
+        SELECT src.mineral_id, src.data, src.context_id
+        FROM src
+        WHERE src.data IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM mineral_context mc WHERE mc.mineral_id = src.mineral_id AND mc.context_id = src.context_id
+        )
+        RETURNING mc.id, mc.mineral_id, mc.context_id
+    ),
+    upd AS (
+        UPDATE mineral_context AS mc SET data = src.data
+        FROM src
+        WHERE mc.mineral_id = src.mineral_id AND mc.context_id = src.context_id AND src.data IS NOT NULL AND
+            mc.data IS DISTINCT FROM src.data
+        RETURNING mc.id, mc.mineral_id, mc.context_id
+    ),
+    """
+)
+
+merge_mineral_context = _merge_mineral_context + (
+    """
+    del AS (
+        DELETE FROM mineral_context AS mc
+        USING src
+        WHERE mc.mineral_id = src.mineral_id AND mc.context_id = src.context_id AND src.data IS NULL
+        RETURNING mc.id, mc.mineral_id, mc.context_id
+    )
+    SELECT ins.*, 'insert' AS operation FROM ins
+    UNION ALL
+    SELECT upd.*, 'update' AS operation FROM upd
+    UNION ALL
+    SELECT del.*, 'delete' AS operation FROM del;
+    """
+)
+
+# full runs also delete the contexts of the minerals which are no longer in the source
+merge_mineral_context_delete = _merge_mineral_context + (
+    """
+    del AS (
+        DELETE FROM mineral_context AS mc
+        WHERE NOT EXISTS (
+            SELECT 1 FROM src
+            WHERE src.mineral_id = mc.mineral_id AND src.context_id = mc.context_id AND src.data IS NOT NULL
+        )
+        RETURNING mc.id, mc.mineral_id, mc.context_id
+    )
+    SELECT ins.*, 'insert' AS operation FROM ins
+    UNION ALL
+    SELECT upd.*, 'update' AS operation FROM upd
+    UNION ALL
+    SELECT del.*, 'delete' AS operation FROM del;
+    """
+)
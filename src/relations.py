@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+from collections import deque
+
+import pandas as pd
+
+from src.metrics import traced
+
+
+# status groups of the relations followed transitively, see get_alternative_names
+INDIRECT_GROUPS = {2, 4, 5}
+# a mineral with a direct status of these groups and not related to by a direct relation
+STANDALONE_GROUPS = {3, 4, 6, 10, 11}
+# a mineral with a direct status of these groups always has priority 1
+PRIMARY_GROUPS = {3, 4, 6, 11}
+# above this number of added relations the closure is recomputed instead of extended
+_INCREMENTAL_EDGES = 100
+
+
+class RelationGraph:
+    """
+    In-process equivalent of the get_alternative_names query, fed from the mineral_status and
+    mineral_relation frames of fetch_tables and kept up to date with the rows inserted by the
+    sync. Minerals are coded as integers, the transitive closure of the indirect relations is
+    kept per mineral and extended as relations are added.
+    """
+
+    def __init__(self):
+        self._codes = {}
+        self._ids = []
+        self._edges = []
+        self._closure = []
+        self._direct_groups = []
+        self._related = set()
+        self._targeted = set()
+
+    @classmethod
+    @traced("relation_graph")
+    def from_frames(cls, statuses, relations):
+        """
+        :param statuses: mineral_status with mineral_id, status_group_id and direct_status
+        :param relations: mineral_relation with mineral_id, relation_id, status_group_id and direct_status
+        """
+        graph = cls()
+        graph.add_statuses(statuses)
+        graph._add_relations(relations)
+        graph._closure = [graph._reachable(_code) for _code in range(len(graph._ids))]
+        return graph
+
+    def _code(self, mineral_id):
+        _code = self._codes.get(mineral_id)
+        if _code is None:
+            _code = self._codes[mineral_id] = len(self._ids)
+            self._ids.append(mineral_id)
+            self._edges.append(set())
+            self._closure.append(set())
+            self._direct_groups.append(set())
+        return _code
+
+    def add_statuses(self, statuses):
+        _direct = statuses.loc[statuses["direct_status"].astype(bool), ["mineral_id", "status_group_id"]]
+        for _mineral_id, _group in _direct.itertuples(index=False):
+            self._direct_groups[self._code(_mineral_id)].add(int(_group))
+
+    def _add_relations(self, relations):
+        _added = []
+        for _mineral_id, _relation_id, _group, _direct in relations[
+            ["mineral_id", "relation_id", "status_group_id", "direct_status"]
+        ].itertuples(index=False):
+            _mineral, _relation = self._code(_mineral_id), self._code(_relation_id)
+            self._related.update((_mineral, _relation))
+            if int(_group) not in INDIRECT_GROUPS:
+                continue
+            if _direct:
+                self._targeted.add(_relation)
+            elif _relation not in self._edges[_mineral]:
+                self._edges[_mineral].add(_relation)
+                _added.append((_mineral, _relation))
+        return _added
+
+    def add_relations(self, relations):
+        """
+        Add inserted relations and extend the closure of every mineral which reaches them
+        """
+        _added = self._add_relations(relations)
+        if len(_added) > _INCREMENTAL_EDGES:
+            self._closure = [self._reachable(_code) for _code in range(len(self._ids))]
+            return
+        for _mineral, _relation in _added:
+            _reached = {_relation} | self._closure[_relation]
+            for _code, _closure in enumerate(self._closure):
+                if _code == _mineral or _mineral in _closure:
+                    _closure |= _reached
+
+    def _reachable(self, code):
+        _reached = set()
+        _queue = deque(self._edges[code])
+        while _queue:
+            _code = _queue.popleft()
+            if _code not in _reached:
+                _reached.add(_code)
+                _queue.extend(self._edges[_code] - _reached)
+        return _reached
+
+    @traced("relation_graph_alternative_names")
+    def alternative_names(self, names):
+        """
+        :param names: pandas.Series of mineral names indexed by mineral_id
+        :return: pandas.DataFrame as returned by get_alternative_names
+        """
+        _names = [names.get(_id) for _id in self._ids]
+        rows = []
+        for _code, _reached in enumerate(self._closure):
+            for _relation in _reached:
+                rows.append((_code, _relation, 2))
+
+        _standalone = set()
+        for _code, _groups in enumerate(self._direct_groups):
+            if _groups & STANDALONE_GROUPS and _code not in self._targeted:
+                _standalone.add((_code, None, 1))
+            if _groups and _code not in self._related:
+                _standalone.add((_code, None, 3))
+        rows.extend(sorted(_standalone, key=lambda _: (_[0], _[2])))
+
+        alternative_names = pd.DataFrame(
+            [
+                (
+                    self._ids[_code],
+                    _names[_code],
+                    None if _relation is None else self._ids[_relation],
+                    None if _relation is None else _names[_relation],
+                    1 if self._direct_groups[_code] & PRIMARY_GROUPS else _priority,
+                )
+                for _code, _relation, _priority in rows
+                if _names[_code] is not None and (_relation is None or _names[_relation] is not None)
+            ],
+            columns=["mineral_id", "name", "relation_id", "relation_name", "priority"],
+        )
+        return alternative_names.sort_values(by=["name"], kind="mergesort").reset_index(drop=True)
@@ -0,0 +1,83 @@
+# -*- coding: UTF-8 -*-
+import concurrent.futures
+from time import perf_counter
+
+
+def run_dag(tasks, dependencies, max_workers=None):
+    """
+    Run callables concurrently, each one as soon as all of its dependencies have finished.
+    A task whose dependency failed is skipped.
+
+    :param tasks: dict of name -> callable without arguments
+    :param dependencies: dict of name -> list of task names that must finish first
+    :param max_workers: size of the thread pool
+    :return: dict of name -> (start, end) in seconds since the start of the run
+    """
+    _start = perf_counter()
+    _dependencies = {
+        name: [_ for _ in dependencies.get(name, []) if _ in tasks] for name in tasks
+    }
+    timings = {}
+    pending = set(tasks)
+    failed = set()
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                if any(_ in failed for _ in _dependencies[name]):
+                    print("Skipping %s, a dependency failed" % name)
+                    pending.discard(name)
+                    failed.add(name)
+                elif all(_ in timings for _ in _dependencies[name]):
+                    pending.discard(name)
+                    running[executor.submit(_timed, tasks[name], _start)] = name
+
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                name = running.pop(future)
+                try:
+                    timings[name] = future.result()
+                except Exception as e:
+                    print("An error occurred when running %s: %s" % (name, e))
+                    failed.add(name)
+
+    return timings
+
+
+def _timed(task, start):
+    _start = perf_counter() - start
+    task()
+    return _start, perf_counter() - start
+
+
+def critical_path(timings, dependencies):
+    """
+    Find the chain of dependent tasks with the longest total duration
+    :return: (list of task names, total duration in seconds)
+    """
+    _finish = {}
+    _previous = {}
+    for name in sorted(timings, key=lambda _: timings[_][1]):
+        _duration = timings[name][1] - timings[name][0]
+        _deps = [_ for _ in dependencies.get(name, []) if _ in _finish]
+        _before = max(_deps, key=lambda _: _finish[_], default=None)
+        _finish[name] = _duration + (_finish[_before] if _before else 0)
+        _previous[name] = _before
+
+    if not _finish:
+        return [], 0
+
+    name = max(_finish, key=lambda _: _finish[_])
+    duration = _finish[name]
+    path = []
+    while name:
+        path.append(name)
+        name = _previous[name]
+
+    return path[::-1], duration
@@ -0,0 +1,95 @@
+# -*- coding: UTF-8 -*-
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+import pandas as pd
+import polars as pl
+
+
+SNAPSHOTS_PATH = "data/generated/snapshots/"
+INDEX_PATH = os.path.join(SNAPSHOTS_PATH, "index.json")
+
+_lock = threading.Lock()
+
+
+def _content_hash(frame):
+    """
+    Hash of the columns and values of a frame, independent of how it was written to disk
+    """
+    _frame = frame.copy(deep=False)
+    for _column in frame.columns[frame.dtypes == object]:
+        # None and NaN are both read back from Parquet as None
+        _frame[_column] = frame[_column].where(frame[_column].notna(), "\x00").astype(str)
+    _hash = hashlib.md5(json.dumps(list(map(str, frame.columns))).encode("utf-8"))
+    _hash.update(pd.util.hash_pandas_object(_frame, index=False, categorize=False).to_numpy().tobytes())
+    return _hash.hexdigest()
+
+
+def load_index():
+    if not os.path.exists(INDEX_PATH):
+        return {}
+    with open(INDEX_PATH, "r") as f:
+        return json.load(f)
+
+
+def save_snapshot(frame, name, partial=False):
+    """
+    Write a raw extract to SNAPSHOTS_PATH as Parquet, named by its content hash. The index keeps
+    the hash, the number of rows and the time of the extract of the latest snapshot of each name.
+    :param frame: pandas.DataFrame or polars.DataFrame, which is saved as its pandas conversion
+    :param name: e.g. minerals or mineral_log
+    :param partial: the extract holds only the rows changed since a watermark, see load_snapshot
+    """
+    try:
+        if isinstance(frame, pl.DataFrame):
+            frame = frame.to_pandas()
+        _hash = _content_hash(frame)
+        _path = os.path.join(SNAPSHOTS_PATH, f"{name}.{_hash[:16]}.parquet")
+        os.makedirs(SNAPSHOTS_PATH, exist_ok=True)
+        if not os.path.exists(_path):
+            frame.to_parquet(_path + ".tmp", index=False)
+            os.replace(_path + ".tmp", _path)
+
+        with _lock:
+            index = load_index()
+            _previous = index.get(name, {}).get("path")
+            index[name] = {
+                "hash": _hash,
+                "path": _path,
+                "rows": len(frame),
+                "partial": partial,
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+            }
+            with open(INDEX_PATH + ".tmp", "w") as f:
+                json.dump(index, f, indent=2)
+            os.replace(INDEX_PATH + ".tmp", INDEX_PATH)
+
+        if _previous and _previous != _path and os.path.exists(_previous):
+            os.remove(_previous)
+
+    except Exception as e:
+        print("An error occurred when saving %s snapshot: %s" % (name, e))
+
+
+def load_snapshot(name, partial=False):
+    """
+    Load the latest snapshot of an extract, the content hash is verified
+    :param partial: accept a snapshot of an incremental extract, a full run must not take the
+        changed rows for the whole source
+    :return: pandas.DataFrame
+    """
+    _snapshot = load_index().get(name)
+    if not _snapshot:
+        raise FileNotFoundError("No snapshot of %s, run online first" % name)
+    if _snapshot.get("partial") and not partial:
+        raise ValueError("The snapshot of %s holds only the rows of an incremental run, run online first" % name)
+
+    frame = pd.read_parquet(_snapshot["path"])
+    if _content_hash(frame) != _snapshot["hash"]:
+        raise ValueError("The snapshot of %s does not match its hash" % name)
+
+    print("Loaded %s from the snapshot of %s (%s rows)" % (name, _snapshot["created_at"], len(frame)))
+    return frame
@@ -1,15 +1,14 @@
 # -*- coding: UTF-8 -*-
+import glob
+import hashlib
 import os
 
-import re
 import json
 
 import numpy as np
 import pandas as pd
 import polars as pl
 
-from django.utils.html import strip_tags
-
 from src.constants import (
     STATUS_SYNONYM_UNCERTAIN,
     STATUS_UNCERTAIN_VARIETY,
@@ -18,10 +17,60 @@ from src.constants import (
     IMA_NOTES_CHOICES,
     ALTERATION_CHOICES,
 )
-from src.ner import recognize_colors
-
-
-def prepare_minerals(minerals):
+from src.aliases import EXACT, AliasIndex
+from src.diff import jsonb_hash
+from src.formula import plainformula_column, simpleformula, simpleformula_column
+from src.metrics import traced
+from src.ner import recognize_colors_batch
+
+
+RRUFF_PATH = "data/real-formulas-rruff.json"
+RRUFF_CACHE_PATH = "data/generated/"
+# part of the cache key, bump it when the preparation of the RRUFF formulas changes
+_RRUFF_CACHE_VERSION = 1
+
+_STRIP_COLS = [
+    'physical_color',
+    'physical_streak',
+    'physical_cleavageNote',
+    'physical_fractureNote',
+    'physical_luminescence',
+    'physical_lustreNote',
+
+    'optical_type',
+    'optical_sign',
+    'optical_extinction',
+    'optical_dispersion',
+    'optical_anisotropism',
+    'optical_bireflectance',
+    'optical_dispersion',
+    'optical_pleochroism',
+    'optical_pleochroismNote',
+]
+_ARRAY_COLS = [
+    'physical_transparency',
+    'physical_tenacity',
+    'physical_cleavage',
+    'physical_fracture',
+    'physical_lustre',
+]
+_CAPITALIZE_COLS = [
+    'physical_luminescence',
+
+    'optical_color',
+    'optical_tropic',
+    'optical_anisotropism',
+    'optical_bireflectance',
+    'optical_dispersion',
+]
+_COLOR_COLS = [
+    'physical_color',
+    'physical_streak',
+]
+
+
+@traced("prepare_minerals")
+def prepare_minerals(minerals, batch_size=256, n_process=1):
     minerals_ = minerals.copy()
     minerals_ = minerals_.replace(0, np.nan)
     minerals_["discovery_year"] = pd.to_numeric(
@@ -43,7 +92,7 @@ def prepare_minerals(minerals):
 
     minerals_.formula = minerals_.formula.str.strip()
     minerals_.formula = minerals_.formula.replace(r"", np.nan)
-    minerals_.imaformula = minerals_.imaformula.apply(simpleformula)
+    minerals_.imaformula = simpleformula_column(minerals_.imaformula)
     minerals_.imaformula = minerals_.imaformula.str.strip()
     minerals_.imaformula = minerals_.imaformula.replace(r"", np.nan)
 
@@ -57,63 +106,29 @@ def prepare_minerals(minerals):
 
     # minerals_ = migrate.minerals.copy()
 
-    _strip_cols = [
-        'physical_color',
-        'physical_streak',
-        'physical_cleavageNote',
-        'physical_fractureNote',
-        'physical_luminescence',
-        'physical_lustreNote',
-
-        'optical_type',
-        'optical_sign',
-        'optical_extinction',
-        'optical_dispersion',
-        'optical_anisotropism',
-        'optical_bireflectance',
-        'optical_dispersion',
-        'optical_pleochroism',
-        'optical_pleochroismNote',
-    ]
-    _array_cols = [
-        'physical_transparency',
-        'physical_tenacity',
-        'physical_cleavage',
-        'physical_fracture',
-        'physical_lustre',
-    ]
-    _capitalize_cols = [
-        'physical_luminescence',
-
-        'optical_color',
-        'optical_tropic',
-        'optical_anisotropism',
-        'optical_bireflectance',
-        'optical_dispersion',
-    ]
-    _color_cols = [
-        'physical_color',
-        'physical_streak',
-    ]
-
     for _context in ['physical', 'optical']:
         _cols = [col for col in minerals_.columns if _context + '_' in col]
         for _col in _cols:
-            if _col in _strip_cols:
+            if _col in _STRIP_COLS:
                 minerals_[_col] = minerals_[_col].str.strip()
                 # _mask = minerals_[_col].notnull()
                 # minerals_.loc[_mask, _col] = minerals_.loc[_mask, _col].apply(lambda x: x.strip() if x and isinstance(x, str) else np.nan)
-            if _col in _array_cols:
+            if _col in _ARRAY_COLS:
                 _mask = minerals_[_col].notnull()
                 minerals_.loc[_mask, _col] = minerals_.loc[_mask, _col].apply(lambda x: x.split(',') if x else np.nan)
-            if _col in _capitalize_cols:
+            if _col in _CAPITALIZE_COLS:
                 # minerals_[_col] = minerals_[_col].str.strip()
                 minerals_[_col] = minerals_[_col].str.capitalize()
-            if _col in _color_cols:
+            if _col in _COLOR_COLS:
                 minerals_[_col + 'Note'] = minerals_[_col].str.capitalize()
                 _cols += [_col + 'Note']
+                minerals_.loc[minerals_[_col] == '', _col] = np.nan
                 _mask = minerals_[_col].notnull()
-                minerals_.loc[_mask, _col] = minerals_.loc[_mask, _col].apply(lambda x: recognize_colors(x) if x else np.nan)
+                minerals_.loc[_mask, _col] = pd.Series(
+                    recognize_colors_batch(minerals_.loc[_mask, _col], batch_size=batch_size, n_process=n_process),
+                    index=minerals_.index[_mask],
+                    dtype=object,
+                )
 
         _mask = minerals_[_cols].notnull().any(axis=1)
         _temp = minerals_.loc[_mask, _cols].copy()
@@ -123,6 +138,214 @@ def prepare_minerals(minerals):
     return minerals_
 
 
+def _nullif_empty(expr):
+    return pl.when(expr != "").then(expr)
+
+
+def _capitalize(expr):
+    return pl.concat_str([expr.str.slice(0, 1).str.to_uppercase(), expr.str.slice(1).str.to_lowercase()])
+
+
+def _decode_flags(column, choices):
+    _flags = pl.col(column).fill_null(0).cast(pl.Int64)
+    return pl.concat_list(
+        [pl.when((_flags & value) != 0).then(pl.lit(option)) for option, value in choices.items()]
+    ).list.drop_nulls().alias(column)
+
+
+def _to_python(series):
+    """
+    Convert a polars list column to python lists, NaN for missing rows
+    """
+    return [np.nan if _ is None else _ for _ in series.to_arrow().to_pylist()]
+
+
+def _minerals_to_pandas(frame, index, contexts):
+    """
+    Convert the polars result with the conventions of prepare_minerals: NaN for missing values,
+    python lists and dicts in the nested columns.
+    :param contexts: dict of struct column -> the columns holding its fields, the context dicts
+        reuse the converted values of these columns, as DataFrame.to_dict does in prepare_minerals
+    """
+    _nested = [_col for _col, _dtype in frame.schema.items() if isinstance(_dtype, pl.List)]
+    minerals_ = fillna_nan(frame.drop(_nested + list(contexts)).to_pandas())
+    for _col in _nested:
+        minerals_[_col] = pd.Series(_to_python(frame[_col]), dtype=object)
+
+    for _context, _cols in contexts.items():
+        _keys = frame[_context].struct.fields
+        _values = zip(*[minerals_[_col].tolist() for _col in _cols])
+        minerals_[_context] = pd.Series(
+            [
+                np.nan if _missing else dict(zip(_keys, _row))
+                for _missing, _row in zip(frame[_context].is_null().to_list(), _values)
+            ],
+            dtype=object,
+        )
+
+    minerals_ = minerals_[frame.columns]
+    minerals_.index = index
+    return minerals_
+
+
+@traced("prepare_minerals_polars")
+def prepare_minerals_polars(minerals, batch_size=256, n_process=1):
+    """
+    Same output as prepare_minerals, computed as one polars lazy plan: the string cleaning runs
+    on all cores and physical_context/optical_context are built as struct columns.
+    Formulas and colors are still converted once per distinct value in Python.
+    :param minerals: pandas.DataFrame or polars.DataFrame as returned by get_minerals query, e.g.
+        straight from the arrow reader
+    :return: pandas.DataFrame
+    """
+    if isinstance(minerals, pl.DataFrame):
+        _frame, _index = minerals.lazy(), pd.RangeIndex(len(minerals))
+    else:
+        _frame, _index = pl.from_pandas(minerals, nan_to_null=True).lazy(), minerals.index
+    _schema = _frame.collect_schema()
+    _columns = _schema.names()
+
+    def _string(column):
+        return pl.col(column).cast(pl.String)
+
+    _formulas = _frame.select(_string("imaformula").drop_nulls().unique(maintain_order=True)).collect()
+    _formulas = _formulas["imaformula"].to_list()
+    _colors_text = (
+        pl.concat(
+            [_frame.select(_string(_col).str.strip_chars().alias("text")) for _col in _COLOR_COLS],
+        )
+        .filter(pl.col("text") != "")
+        .unique(maintain_order=True)
+        .collect()["text"]
+        .to_list()
+    )
+    _colors = pl.Series(
+        recognize_colors_batch(_colors_text, batch_size=batch_size, n_process=n_process),
+        strict=False,
+    )
+
+    _numeric = [
+        pl.when(pl.col(_col) != 0).then(pl.col(_col)).alias(_col)
+        for _col, _dtype in _schema.items() if _dtype.is_numeric()
+    ]
+    if _schema["discovery_year"] in (pl.String, pl.Null):
+        _numeric.append(_string("discovery_year").str.strip_chars().cast(pl.Float64, strict=False))
+    _prepared = [
+        _string("name").str.strip_chars(),
+        _decode_flags("ima_status", IMA_STATUS_CHOICES),
+        _decode_flags("ima_note", IMA_NOTES_CHOICES),
+        _nullif_empty(_string("description")),
+        _nullif_empty(_string("ima_symbol")),
+        _nullif_empty(_string("formula").str.strip_chars()),
+        _nullif_empty(
+            _string("imaformula")
+            .replace_strict(
+                pl.Series(_formulas, dtype=pl.String),
+                pl.Series(list(map(simpleformula, _formulas)), dtype=pl.String),
+                default=None,
+            )
+            .str.strip_chars()
+        ),
+        _nullif_empty(_string("note")),
+        _nullif_empty(_string("crystal_system").str.to_lowercase()),
+        _string("variety_of").str.strip_chars(),
+        _string("synonym_of").str.strip_chars(),
+        _string("polytype_of").str.strip_chars(),
+    ]
+
+    _context_columns = {}
+    _notes = []
+    for _context in ['physical', 'optical']:
+        _cols = [col for col in _columns if _context + '_' in col]
+        for _col in list(_cols):
+            _expr = pl.col(_col)
+            if _col in _STRIP_COLS:
+                _expr = _string(_col).str.strip_chars()
+            if _col in _ARRAY_COLS:
+                _expr = pl.when(_string(_col) != "").then(_string(_col).str.split(","))
+            if _col in _CAPITALIZE_COLS:
+                _expr = _capitalize(_expr.cast(pl.String))
+            if _col in _COLOR_COLS:
+                _notes.append(_capitalize(_expr).alias(_col + 'Note'))
+                _cols.append(_col + 'Note')
+                _expr = _nullif_empty(_expr).replace_strict(
+                    pl.Series(_colors_text, dtype=pl.String), _colors, default=None, return_dtype=_colors.dtype
+                )
+            if _col in _STRIP_COLS + _ARRAY_COLS + _CAPITALIZE_COLS + _COLOR_COLS:
+                _prepared.append(_expr.alias(_col))
+        _context_columns[_context] = _cols
+
+    _contexts = [
+        pl.when(pl.any_horizontal([pl.col(_col).is_not_null() for _col in _cols]))
+        .then(pl.struct([pl.col(_col).alias(_col.replace(_context + '_', '')) for _col in _cols]))
+        .alias(_context + '_context')
+        for _context, _cols in _context_columns.items()
+    ]
+
+    minerals_ = (
+        _frame.with_columns(_numeric)
+        .with_columns(_prepared + _notes)
+        .with_columns(_contexts)
+        .collect()
+    )
+
+    # pandas.to_numeric gives integers when every year is one
+    _years = minerals_["discovery_year"]
+    if _years.dtype == pl.Float64 and not _years.is_null().any() and (_years == _years.round()).all():
+        minerals_ = minerals_.with_columns(_years.cast(pl.Int64))
+
+    return _minerals_to_pandas(
+        minerals_,
+        _index,
+        {_context + '_context': _cols for _context, _cols in _context_columns.items()},
+    )
+
+
+def fillna_nan(frame):
+    """
+    Replace the nulls of a frame with NaN, keeping the object dtype of the string columns. A column
+    which is null in every row, e.g. in a chunk or a small incremental extract, would otherwise be
+    downcast to float64 and break the .str accessors of prepare_minerals
+    """
+    _objects = frame.columns[frame.dtypes == object]
+    frame = frame.fillna(value=np.nan)
+    frame[_objects] = frame[_objects].astype(object)
+    return frame
+
+
+def compact_minerals(minerals):
+    """
+    Drop the raw physical_*/optical_* columns once they are folded into the context columns
+    """
+    _columns = [
+        _col for _col in minerals.columns
+        if _col.startswith(('physical_', 'optical_')) and not _col.endswith('_context')
+    ]
+    return minerals.drop(columns=_columns)
+
+
+@traced("prepare_mineral_context")
+def prepare_mineral_context(minerals):
+    """
+    One row per mineral and context, NaN values of the contexts become null
+    :param minerals: name, physical_context and optical_context of prepared minerals
+    :return: pandas.DataFrame with name, data, context_id and data_hash, the md5 of data as stored
+        in a jsonb column
+    """
+    _contexts = []
+    for _context, _context_id in [('physical_context', 1), ('optical_context', 2)]:
+        _data = minerals[['name', _context]].dropna().rename(columns={_context: 'data'})
+        _data['context_id'] = _context_id
+        _contexts.append(_data)
+    contexts = pd.concat(_contexts, axis=0)
+    contexts['data'] = contexts['data'].apply(
+        lambda x: {k: v if not isinstance(v, float) or not np.isnan(v) else None for k, v in x.items()}
+    )
+    contexts['data_hash'] = contexts['data'].map(jsonb_hash)
+    return contexts
+
+
+@traced("prepare_minerals_formula")
 def prepare_minerals_formula(minerals):
     minerals_ = minerals.copy()
 
@@ -146,6 +369,7 @@ def prepare_minerals_formula(minerals):
     return minerals_formula
 
 
+@traced("prepare_minerals_relation_status")
 def prepare_minerals_relation_status(minerals):
     _minerals = minerals.copy()
     _minerals.dropna(how="all", inplace=True, subset=["variety_of", "synonym_of", "polytype_of"])
@@ -167,134 +391,85 @@ def prepare_minerals_relation_status(minerals):
     return _minerals
 
 
-# Utils functions from Pavel Martynov https://github.com/Medwar/mindatapi/blob/master/src/apps/api/utils.py
-def allgreektome(txt):
-    greek = {
-        '\\ualpha': 'Α', '\\alpha': 'α',
-        '\\ubeta': 'Β', '\\beta': 'β',
-        '\\ugamma': 'Γ', '\\gamma': 'γ',
-        '\\udelta': 'Δ', '\\delta': 'δ',
-        '\\uepsilon': 'Ε', '\\epsilon': 'ε',
-        '\\utheta': 'Θ', '\\theta': 'θ',
-        '\\zeta': 'ζ', '\\uzeta': 'Ζ',
-        '\\ueta': 'Η', '\\eta': 'η',
-
-        '\\uiota': 'Ι', '\\iota': 'ι',
-        '\\ukappa': 'Κ', '\\kappa': 'κ',
-
-        '\\ulambda': 'Λ', '\\lambda': 'λ',
-        '\\mu': 'μ', '\\umu': 'Μ',
-        '\\nu': 'ν', '\\unu': 'Ν',
-        '\\xi': 'ξ', '\\uxi': 'Ξ',
-        '\\omicron': 'ο', '\\uomicron': 'Ο',
-        '\\pi': 'π', '\\upi': 'Π',
-        '\\rho': 'ρ', '\\urho': 'Ρ',
-        '\\sigma': 'σ', '\\usigma': 'Σ',
-        '\\tau': 'τ', '\\utau': 'Τ',
-        '\\upsilon': 'υ', '\\uupsilon': 'Υ',
-        '\\phi': 'φ', '\\uphi': 'Φ',
-        '\\chi': 'χ', '\\uchi': 'Χ',
-        '\\psi': 'ψ', '\\upsi': 'Ψ',
-        '\\omega': 'ω', '\\uomega': 'Ω'
-    }
-    for k, v in greek.items():
-        txt.replace(k, v)
-    return txt
-
-
-def fixGroupFormula(txt):
-    for x in range(25):
-        match = '$'+chr(97+x)
-        rep = '<b>'+chr(65+x)+'</b>'
-        txt.replace(match, rep)
-    return txt
-
-
-def isGroupFormula(txt):
-    found = False
-    for x in range(25):
-        match = '$'+chr(97+x)
-        if match in txt:
-            found = True
-    return found
-
-
-def simpleformula(text):
-    text = text.strip()
-    text = strip_tags(text)
-    text = text.replace("[]", "&#9723;")\
-        .replace("≤", "<=")\
-        .replace("≥", ">=")
-    text = allgreektome(text)
-    text = fixGroupFormula(text)
-
-    extchr = False
-    big = True
-    anyc = False
-    insup = False
-    last_num = False
-    subs = ""
-    sups = ""
-    out = ""
-
-    for c in text:
-        if c == '&':
-            extchr = True
-        if c == ';':
-            extchr = False
-        if c == '^' and not extchr:
-            last_num = False
-            if big:
-                subs = ""
-                big = False
-            anyc = True
-        elif c == '#' and not extchr:
-            insup = not insup
-        elif insup:
-            sups = sups + c
-        else:
-            if not big and (c in "1234567890-+xyn@Σ<>=" or anyc):
-                if c == '@':
-                    c = "."
-                subs = subs + c
-                anyc = False
-            elif sups or subs:
-                if sups:
-                    out = out + "<sup>" + sups + "</sup>"
-                if subs:
-                    out = out + "<sub>" + subs + "</sub>"
-                big = True
-                sups = ""
-                subs = ""
-            if big:
-                if not last_num and c == ".":
-                    c = ' &middot; '
-                out = out + c
-                last_num = c.isnumeric()
-
-    if sups:
-        out = out + "<sup>" + sups + "</sup>"
-    if subs:
-        out = out + "<sub>" + subs + "</sub>"
-
-    out = fixGroupFormula(out)
-    return out
-
-
-def _prepare_rruff():
-    with open("data/real-formulas-rruff.json", "r") as f:
-        _formulas = json.load(f)
-    for _item in _formulas:
-        for index, _ in enumerate(_item['links']):
-            if _ == "https://":
-                _item['links'].pop(index)
-
-    for _item in _formulas:
-        for index, _ in enumerate(_item['links']):
-            if re.match(r".*_database_code_amcsd.*", _):
-                _item['amcsd_id'] = re.findall(r"_database_code_amcsd%20(\d+)", _)[0]
-
-    formulas = pd.DataFrame(_formulas)
+def _file_hash(path):
+    _hash = hashlib.md5(str(_RRUFF_CACHE_VERSION).encode("utf-8"))
+    with open(path, "rb") as f:
+        for _chunk in iter(lambda: f.read(1 << 20), b""):
+            _hash.update(_chunk)
+    return _hash.hexdigest()
+
+
+def _read_rruff(path, chunk_size=1 << 20):
+    """
+    Parse the RRUFF export, a JSON array of items, one item at a time into column buffers
+    :return: dict of column -> list, a key missing from an item is NaN
+    """
+    _decoder = json.JSONDecoder()
+    columns = {}
+    _rows = 0
+    _buffer = ""
+    _position = 0
+    with open(path, "r", encoding="utf-8") as f:
+        while True:
+            # the brackets, separators and whitespace between the items
+            while _position < len(_buffer) and _buffer[_position] in "[], \t\r\n":
+                _position += 1
+            _item = None
+            if _position < len(_buffer):
+                try:
+                    _item, _position = _decoder.raw_decode(_buffer, _position)
+                except json.JSONDecodeError:
+                    # the item continues in the next chunk
+                    pass
+            if _item is None:
+                _chunk = f.read(chunk_size)
+                if not _chunk:
+                    if _position < len(_buffer):
+                        raise ValueError("Incomplete RRUFF item at the end of %s" % path)
+                    break
+                _buffer = _buffer[_position:] + _chunk
+                _position = 0
+                continue
+
+            for _key, _value in _item.items():
+                if _key not in columns:
+                    columns[_key] = [np.nan] * _rows
+                columns[_key].append(_value)
+            _rows += 1
+            for _column in columns.values():
+                if len(_column) < _rows:
+                    _column.append(np.nan)
+    return columns
+
+
+def _clean_rruff_links(formulas):
+    """
+    Drop the empty https:// links and take the AMCSD id from the last AMCSD link of each item
+    """
+    _links = formulas['links'].explode()
+    formulas['amcsd_id'] = (
+        _links.str.extract(r"_database_code_amcsd%20(\d+)", expand=False).dropna().groupby(level=0).last()
+    )
+    _links = _links[_links.notna() & (_links != "https://")]
+    formulas['links'] = _links.groupby(level=0).agg(list).reindex(formulas.index)
+    formulas['links'] = formulas['links'].map(lambda x: x if isinstance(x, list) else [])
+    return formulas
+
+
+@traced("prepare_rruff")
+def _prepare_rruff(path=RRUFF_PATH):
+    """
+    The prepared RRUFF formulas are cached as Parquet in RRUFF_CACHE_PATH, keyed by the hash of
+    the export, so that an unchanged export is not parsed again
+    """
+    _hash = _file_hash(path)
+    _cache = os.path.join(RRUFF_CACHE_PATH, f"rruff.{_hash[:16]}.parquet")
+    if os.path.exists(_cache):
+        formulas = pd.read_parquet(_cache).fillna(value=np.nan)
+        formulas['links'] = formulas['links'].map(list)
+        return formulas
+
+    formulas = _clean_rruff_links(pd.DataFrame(_read_rruff(path)))
     formulas.replace(r"&nbsp;", "", regex=True, inplace=True)
     formulas.replace(r"\.$", "", regex=True, inplace=True)
     formulas.formula = formulas.formula.str.replace(r"_", "", regex=True)
@@ -326,8 +501,7 @@ def _prepare_rruff():
 
     _mask.formula = _mask.formula.str.strip()
     _mask.formula = _mask.formula.str.replace(r" +", "", regex=True)
-    _mask.formula = _mask.formula.str.replace(r"([A-Za-z\\+\\-\\)\]])([0-9\.Σ=]+(?![+-]))", r"\1<sub>\2</sub>", regex=True)
-    _mask.formula = _mask.formula.str.replace(r"(?<=[A-Za-z])([0-9]?[+-][0-9]?)", r"<sup>\1</sup>", regex=True)
+    _mask.formula = plainformula_column(_mask.formula)
 
     formulas.loc[~formulas.is_html] = _mask
     formulas['source_id'] = 3
@@ -386,9 +560,20 @@ def _prepare_rruff():
     # print(_formula)
     formulas.replace(r"^\s+$", np.nan, regex=True, inplace=True)
 
+    try:
+        os.makedirs(RRUFF_CACHE_PATH, exist_ok=True)
+        formulas.to_parquet(_cache + ".tmp", index=False)
+        os.replace(_cache + ".tmp", _cache)
+        for _previous in glob.glob(os.path.join(RRUFF_CACHE_PATH, "rruff.*.parquet")):
+            if _previous != _cache:
+                os.remove(_previous)
+    except Exception as e:
+        print("An error occurred when caching the RRUFF formulas: %s" % e)
+
     return formulas
 
 
+@traced("prepare_cod")
 def _prepare_cod(data):
     _cod_mr_mapping = pd.read_csv('data/cod-mr-mapping.csv')
 
@@ -396,11 +581,8 @@ def _prepare_cod(data):
     data.formula = data.formula.str.replace(r"[(^\-)(\-$)(\s+)]", "", regex=True)
     data.calculated_formula = data.calculated_formula.str.replace(r"[(^\-)(\-$)(\s+)]", "", regex=True)
 
-    data.formula = data.formula.str.replace(r"([A-Za-z\\+\\-\\)\]])([0-9\.Σ=]+(?![+-]))", r"\1<sub>\2</sub>", regex=True)
-    data.formula = data.formula.str.replace(r"(?<=[A-Za-z])([0-9]?[+-][0-9]?)", r"<sup>\1</sup>", regex=True)
-
-    data.calculated_formula = data.calculated_formula.str.replace(r"([A-Za-z\\+\\-\\)\]])([0-9\.Σ=]+(?![+-]))", r"\1<sub>\2</sub>", regex=True)
-    data.calculated_formula = data.calculated_formula.str.replace(r"(?<=[A-Za-z])([0-9]?[+-][0-9]?)", r"<sup>\1</sup>", regex=True)
+    data.formula = plainformula_column(data.formula)
+    data.calculated_formula = plainformula_column(data.calculated_formula)
 
     data.space_group = data.space_group.str.replace(r"\s+", "", regex=True)
     data.space_group = data.space_group.str.replace(r'-(\d)',
@@ -439,7 +621,12 @@ def _prepare_cod(data):
     return data
 
 
-def _add_alternative_name(data, alternative_names):
+@traced("add_alternative_name")
+def _add_alternative_name(data, aliases):
+    """
+    Replace the mineral names of COD or RRUFF entries with the ids of the minerals they resolve to
+    in the AliasIndex, the entries of unknown minerals are left out
+    """
     _columns = [
         'mineral_id',
         'cod_id',
@@ -466,68 +653,43 @@ def _add_alternative_name(data, alternative_names):
         'links',
         'note',
     ]
-    _alternative_names = alternative_names
-    _special_characters = _alternative_names[_alternative_names.name.str.contains(r'[^\x00-\x7F]+')][
-        ['name', 'mineral_id']]
-    _special_characters.drop_duplicates(inplace=True)
-    _special_characters['relation_name'] = _special_characters.name.str.normalize('NFKD').str.encode('ascii',
-                                                                                                     errors='ignore') \
-        .str.decode('utf-8')
-    _special_characters.loc[_special_characters.name.str.contains('ø'), 'relation_name'] = _special_characters[
-        'name'].str.replace('ø', 'o')
-    _special_characters['relation_id'] = _special_characters.mineral_id
-    _alternative_names = pd.concat([_alternative_names, _special_characters])
-    _alternative_names.drop_duplicates(subset=['mineral_id', 'relation_id'], inplace=True)
-    _alternative_names.sort_values(by=['name'], inplace=True)
-
-    _insert_chunk_0 = data.merge(
-        _alternative_names,
-        how="inner",
-        left_on="mineral_name",
-        right_on="name",
-    )
-    _insert_chunk_0 = _insert_chunk_0[_columns + ['name']]
-    _insert_chunk_0.drop_duplicates(
-        subset=['mineral_id', 'formula', 'a', 'b', 'c', 'alpha', 'beta', 'gamma', 'volume',
-                'reference', 'note'], inplace=True)
+    _matched = aliases.lookup(data['mineral_name'])
+    data = data.assign(mineral_id=_matched['mineral_id'], name=_matched['name'])
 
-    _residual = data[~data.mineral_name.isin(_insert_chunk_0.name)]
-
-    _insert_chunk_1 = _residual.merge(
-        _alternative_names,
-        how="left",
-        left_on="mineral_name",
-        right_on="relation_name",
-        indicator=True,
-    )
+    _insert_chunk_0 = data.loc[_matched['tier'] == EXACT, _columns + ['name']]
+    _insert_chunk_0 = _insert_chunk_0.drop_duplicates(
+        subset=['mineral_id', 'formula', 'a', 'b', 'c', 'alpha', 'beta', 'gamma', 'volume',
+                'reference', 'note'])
 
     # Activate this to check if there are any missing minerals
-    # _missing = _insert_chunk_1.loc[_insert_chunk_1['_merge'] == 'left_only']
-    # _missing.drop_duplicates(subset=['mineral_name'], inplace=True)
-    # _missing.sort_values(by=['mineral_name'], inplace=True)
+    # _missing = data.loc[_matched['tier'] < 0].drop_duplicates(subset=['mineral_name'])
     # _missing['corr_mineral_name'] = np.nan
-    # save missing minerals to a csv file
     # _missing[['cod_id', 'mineral_name', 'corr_mineral_name']].to_csv('data/_cod-mr-mapping.csv', index=False)
 
-    _insert_chunk_1.sort_values(by=['mineral_name', 'priority'], inplace=True)
-    _insert_chunk_1.drop_duplicates(subset=['relation_name', 'formula'], inplace=True, keep='first')
+    _insert_chunk_1 = data.loc[_matched['tier'] > EXACT]
+    _insert_chunk_1 = _insert_chunk_1.drop_duplicates(subset=['mineral_name', 'formula'], keep='first')
     _insert_chunk_1 = _insert_chunk_1[_columns + ['name']]
 
     insert = pd.concat([_insert_chunk_0, _insert_chunk_1])
     insert.sort_values(by=['name'], inplace=True)
     insert = insert[_columns]
-    insert = insert[insert.mineral_id.notnull()]
 
     return insert
 
 
-def prepare_mineral_structure(cod, alternative_names):
+@traced("prepare_mineral_structure")
+def prepare_mineral_structure(cod, alternative_names, cod_prepared=False):
+    """
+    :param alternative_names: output of get_alternative_names or an AliasIndex built from it
+    :param cod_prepared: cod was already prepared with _prepare_cod, e.g. by Migration.extract
+    """
     # cod = migrate.cod
-    _cod = _prepare_cod(cod)
+    _cod = cod if cod_prepared else _prepare_cod(cod)
     _rruff = _prepare_rruff()
+    _aliases = alternative_names if isinstance(alternative_names, AliasIndex) else AliasIndex(alternative_names)
 
-    cod = _add_alternative_name(_cod, alternative_names)
-    rruff = _add_alternative_name(_rruff, alternative_names)
+    cod = _add_alternative_name(_cod, _aliases)
+    rruff = _add_alternative_name(_rruff, _aliases)
 
     data = pd.concat([cod, rruff], ignore_index=True)
     data['_id'] = data.reset_index(drop=True).index
@@ -557,6 +719,7 @@ def prepare_mineral_structure(cod, alternative_names):
     return data
 
 
+@traced("prepare_chem_measurement")
 def prepare_chem_measurement():
     if not os.path.exists('data/generated/georoc.csv'):
         raise FileNotFoundError('File not found: data/generated/georoc.csv')
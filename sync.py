@@ -1,38 +1,128 @@
 # -*- coding: UTF-8 -*-
+import argparse
+
+from src import metrics
 from src.connectors import Migration
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Sync mineralogy.rocks db with mindat")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="pull only the mindat rows changed since the last successful run",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="stream the mindat minerals and prepare them in chunks of this many rows",
+    )
+    parser.add_argument(
+        "--reader",
+        choices=["sql", "arrow"],
+        default="sql",
+        help="read the source and target tables with pandas.read_sql or with connectorx into arrow",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["pandas", "polars"],
+        default="pandas",
+        help="prepare the mindat minerals with pandas or with a polars lazy plan",
+    )
+    parser.add_argument(
+        "--offline",
+        "--from-snapshot",
+        dest="offline",
+        action="store_true",
+        help="load the source extracts and target tables from data/generated/snapshots/, implies --dry-run",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="compute the changes and write them to db/reports/dry_run_* without updating the db",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="detect the changes server-side from a staged copy of the source instead of fetching the target tables",
+    )
+    parser.add_argument(
+        "--single-transaction",
+        action="store_true",
+        help="run the sync steps one at a time in one transaction, with a savepoint per step",
+    )
+    parser.add_argument(
+        "--add-row-hash",
+        action="store_true",
+        help="add the row_hash columns to the synced tables before the run, once, the tables are locked meanwhile",
+    )
+    args = parser.parse_args()
 
-    migrate = Migration(env="dev")
+    migrate = Migration(
+        env="dev",
+        incremental=args.incremental,
+        offline=args.offline,
+        dry_run=args.dry_run,
+        merge=args.merge,
+    )
 
     try:
         migrate.connect_db()
 
-        migrate.get_minerals()
-        # migrate.get_relations()
-        # migrate.get_cod()
+        if args.add_row_hash:
+            migrate.add_row_hash_columns()
+        migrate.check_row_hash_columns()
+
+        # Mindat, COD and MR are read concurrently, each source is prepared as soon as it arrives
+        migrate.extract(
+            reader=args.reader,
+            engine=args.engine,
+            chunksize=args.chunksize,
+            sources=[
+                "minerals",
+                # "relations",
+                # "cod",
+                "tables",
+            ],
+        )
         # migrate.cod.loc[migrate.cod['id'].isin([9000333, 7048271]), 'reference'].values
 
-        migrate.fetch_tables()
+        if args.single_transaction:
+            migrate.begin()
+
+        # independent steps run concurrently, see SYNC_DEPENDENCIES
+        migrate.sync(
+            [
+                # "sync_rruff_cod",
+                # "sync_mineral_log",
+                # "sync_mineral_status",
+                # "sync_mineral_relation",
+                # "sync_mineral_history",
+                # "sync_mineral_ima_status",
+                # "sync_mineral_ima_note",
+                "sync_mineral_context",
+                # "sync_mineral_crystallography",
+                # "sync_mineral_formula",
+                # "sync_mineral_relation_suggestion",
+            ]
+        )
+
+        if args.single_transaction:
+            migrate.commit()
 
-        # migrate.sync_rruff_cod()
-        # migrate.sync_mineral_log()
-        # migrate.sync_mineral_status()
-        # migrate.sync_mineral_relation()
-        # migrate.sync_mineral_history()
-        # migrate.sync_mineral_ima_status()
-        # migrate.sync_mineral_ima_note()
-        migrate.sync_mineral_context()
-        # migrate.sync_mineral_crystallography()
-        # migrate.sync_mineral_formula()
-        # migrate.sync_mineral_relation_suggestion()
+        # a dry run changes nothing, so the next run has to pick up the same rows. save_watermarks
+        # also keeps the previous watermarks when an extract, a step or a write failed
+        if not migrate.dry_run:
+            migrate.save_watermarks()
 
     except Exception as e:
         print("An error occurred: %s" % e)
 
     finally:
         migrate.disconnect_db()
+        print("Run summary saved to %s" % metrics.save_summary())
+        metrics.save_prometheus()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+"""
+Equivalence of src.formula with the previous per-row implementations of the formula markup
+"""
+import pandas as pd
+import pytest
+
+from src.benchmarks.formula import _generate, _legacy_plainformula, _legacy_simpleformula
+from src.formula import plainformula_column, simpleformula, simpleformula_column
+
+FORMULAS = [
+    "",
+    "  ",
+    "Ca^2#2+#(CO_3_)@H_2_O",
+    "CaCO_3_",
+    "Fe^2+^_3_Al_2_(SiO_4_)_3_",
+    "(Mg,Fe^2+^)_2_SiO_4_",
+    "Cu^2+^_5_(AsO_4_)_2_(OH)_4_·H_2_O",
+    "Na_2_Ca_4_(PO_4_)_3_F",
+    "(REE)_x_Ti_1-x_O_2_",
+    "Pb^n#4+#",
+    "Ca_2_[]Mg_5_Si_8_O_22_(OH)_2_",
+    "Zn_1≤x≤2_S",
+    "K(Mg,Fe)_3_AlSi_3_O_10_(OH)_2_ . 2H_2_O",
+    "CaSO_4_.2H_2_O",
+    "Ca.Mg",
+    "1.5H_2_O",
+    "Σ=2",
+    "Fe&#9723;_2_O_3_",
+    "Ca^2&amp;#2+#",
+    "&middot;#3+#",
+    "Al<sub>2</sub>SiO<sub>5</sub>",
+    "Fe<sup>3+</sup>O(OH)",
+    "<i>REE</i>PO_4_",
+    "Cu^2+^<sub>2</sub>CO_3_(OH)_2_",
+    "Mg^#2+#^_3_",
+    "H^@^2O",
+    "²½.O",
+    "Ca^",
+    "Ca#2+",
+    "Ca##",
+]
+
+
+@pytest.mark.parametrize("formula", FORMULAS)
+def test_simpleformula_matches_legacy(formula):
+    assert simpleformula(formula) == _legacy_simpleformula(formula)
+
+
+def test_simpleformula_matches_legacy_on_synthetic_formulas():
+    formulas = _generate(20000, seed=1)
+    assert simpleformula_column(formulas).equals(formulas.apply(_legacy_simpleformula))
+
+
+def test_simpleformula_column_keeps_nulls():
+    formulas = pd.Series(["Fe^2+^_3_", None, "Fe^2+^_3_"], dtype=object)
+    converted = simpleformula_column(formulas)
+    assert converted.dtype == object
+    assert converted[0] == converted[2] == simpleformula("Fe^2+^_3_")
+    assert pd.isna(converted[1])
+
+
+def test_plainformula_matches_legacy():
+    formulas = pd.Series(
+        ["Fe2+1.94Al0.77(BO3)3", "CaCO3", "Na0.5(Ca,Mg)2Σ=2", "Cu2+", "H2O", "(Mg0.9Fe0.1)2SiO4"]
+    )
+    formulas = pd.concat([formulas, _generate(5000, seed=2).str.replace(r"[_^#@]", "", regex=True)])
+    assert plainformula_column(formulas).equals(_legacy_plainformula(formulas))
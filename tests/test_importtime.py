@@ -0,0 +1,22 @@
+# -*- coding: UTF-8 -*-
+"""
+Import-time budget of the sync entry point, see src.benchmarks.importtime
+"""
+import subprocess
+import sys
+
+from src.benchmarks.importtime import BUDGET, MODULE, measure
+
+
+def test_import_within_budget():
+    total, children = measure(MODULE)
+    _slowest = ", ".join(
+        "%s %.3fs" % (_package, _seconds) for _package, _seconds in sorted(children, key=lambda c: -c[1])[:5]
+    )
+    assert total <= BUDGET, "import %s took %.3fs, budget %.1fs (%s)" % (MODULE, total, BUDGET, _slowest)
+
+
+def test_import_does_not_load_spacy():
+    # the spaCy model is loaded on the first NER call, importing the entry point must not pull it in
+    _check = "import sys, %s; sys.exit('spacy' in sys.modules)" % MODULE
+    assert subprocess.run([sys.executable, "-c", _check]).returncode == 0, "import %s loads spacy" % MODULE
@@ -0,0 +1,24 @@
+# -*- coding: UTF-8 -*-
+"""
+Run-wide counters of src.metrics
+"""
+import json
+
+from src import metrics
+
+
+def test_counters_are_reported_once_per_run(tmp_path):
+    metrics.reset()
+    metrics.count("colors_cache_hits", 3)
+    metrics.count("colors_cache_misses", 2)
+    metrics.count("colors_cache_hits", 4)
+
+    with open(metrics.save_summary(str(tmp_path / "run.json"))) as f:
+        assert json.load(f)["counters"] == {"colors_cache_hits": 7, "colors_cache_misses": 2}
+    with open(metrics.save_prometheus(str(tmp_path / "db_sync.prom"))) as f:
+        _lines = f.read().splitlines()
+    assert "db_sync_colors_cache_hits 7" in _lines
+    assert "db_sync_colors_cache_misses 2" in _lines
+
+    metrics.reset()
+    assert metrics.counters() == {}